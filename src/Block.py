@@ -1,6 +1,9 @@
+from hashlib import sha256
 from random import randint
 
-from toychain.src.utils.helpers import compute_hash, transaction_to_dict
+from toychain.src.utils.codec import encode_header
+from toychain.src.utils.helpers import compute_hash, encode_transaction
+from toychain.src.utils.merkle import hash_leaf, merkle_levels, merkle_root, merkle_proof, verify_merkle_proof
 from toychain.scs.deploy import Contract as State
 
 import logging
@@ -12,7 +15,7 @@ class Block:
     """
 
     def __init__(self, height, parent_hash, data, miner_id, timestamp, difficulty, total_diff, nonce=None,
-                 state_var=None, state = None):
+                 state_var=None, state = None, state_root = None):
         self.height = height
         self.number = height
         self.parent_hash = parent_hash
@@ -28,44 +31,131 @@ class Block:
         else:
             self.state = State(state_var)
 
+        # Commitment to the state, part of the header (see update_state_root)
+        self.state_root = state_root
+        if state_root is None:
+            self.state_root = self.state.state_hash
+
         self.nonce = nonce
         if nonce is None:
             self.nonce = randint(0, 1000)
 
-        self.transactions_root = self.transactions_hash()
+        # The block is sealed once created: hashes are computed here and cached
+        self._header_hash = None
+        self._merkle_levels = None
+        self.transactions_root = self.compute_transactions_root()
         self.hash = self.compute_block_hash()
 
     def compute_block_hash(self):
         """
-        computes the hash of the block header
+        computes the hash of the block header and refreshes the cached header hash
+        must be called again after a header field has been modified
         :return: hash of the block
         """
-        _list = [self.height, self.parent_hash, self.transactions_hash(), self.miner_id, self.timestamp,
-                 self.difficulty,
-                 self.total_difficulty, self.nonce]
-
-        self.hash = compute_hash(_list)
+        self.hash = sha256(encode_header(self)).hexdigest()
+        self._header_hash = None
 
         return self.hash
 
+    def compute_transactions_root(self):
+        """
+        computes the root of the Merkle tree built over the block transactions
+        :return: the hex root of the transactions tree
+        """
+        levels = merkle_levels([hash_leaf(encode_transaction(t)) for t in self.data])
+        return merkle_root(levels)
+
     def transactions_hash(self):
         """
-        computes the hash of the block transactions
-        :return: the hash of the transaction list
+        returns the cached hash of the block transactions
         """
-        transaction_list = [transaction_to_dict(t) for t in self.data]
-        self.transactions_root = compute_hash(transaction_list)
         return self.transactions_root
 
     def get_header_hash(self):
-        header = [self.parent_hash, self.transactions_hash(), self.timestamp, self.difficulty, self.nonce]
-        return compute_hash(header)
+        """
+        returns the hash used to compare block headers between nodes, computed once and cached
+        """
+        if self._header_hash is None:
+            header = [self.parent_hash, self.transactions_root, self.timestamp, self.difficulty, self.nonce]
+            self._header_hash = compute_hash(header)
+        return self._header_hash
+
+    def get_transaction_proof(self, transaction_id, index=None):
+        """
+        returns the Merkle inclusion proof of a transaction of this block, None if it is not in the block
+        the tree is only built (and kept) the first time a proof is requested
+
+        Args:
+            transaction_id: id of the transaction
+            index: position of the transaction in the block if already known (see Node.tx_index)
+        """
+        if index is None or index >= len(self.data) or self.data[index].id != transaction_id:
+            for index, transaction in enumerate(self.data):
+                if transaction.id == transaction_id:
+                    break
+            else:
+                return None
+
+        if self._merkle_levels is None:
+            self._merkle_levels = merkle_levels([hash_leaf(encode_transaction(t)) for t in self.data])
+        return merkle_proof(self._merkle_levels, index)
+
+    @staticmethod
+    def verify_transaction_proof(transaction, proof, transactions_root):
+        """
+        checks a proof returned by get_transaction_proof against the transactions root of a block header
+        """
+        return verify_merkle_proof(encode_transaction(transaction), proof, transactions_root)
+
+    def update_state_root(self):
+        """
+        commits the current state in the header, to be called once the transactions have been applied
+        :return: the new hash of the block
+        """
+        self.state_root = self.state.state_hash
+        return self.compute_block_hash()
 
     def increase_nonce(self):  ###### POW
         self.nonce += 1
+        self.compute_block_hash()
 
     def __repr__(self):
         """
         Translate the block object in a string object
         """
-        return f"## H: {self.height}, D: {self.difficulty}, TD: {self.total_difficulty}, P: {self.miner_id}, BH: {self.hash[0:5]}, TS:{self.timestamp}, #T:{len(self.data)}, SH:{self.state.state_hash[0:5]}##"
\ No newline at end of file
+        return f"## H: {self.height}, D: {self.difficulty}, TD: {self.total_difficulty}, P: {self.miner_id}, BH: {self.hash[0:5]}, TS:{self.timestamp}, #T:{len(self.data)}, SH:{self.state_root[0:5]}##"
+
+
+class BlockHeader:
+    """
+    Header of a block, downloaded and checked before the block itself (see ChainDownload)
+    Its hash is the hash of the block
+    """
+
+    def __init__(self, height, parent_hash, transactions_root, miner_id, timestamp, difficulty, total_difficulty,
+                 nonce, state_root):
+        self.height = height
+        self.parent_hash = parent_hash
+        self.transactions_root = transactions_root
+        self.miner_id = miner_id
+        self.timestamp = timestamp
+        self.difficulty = difficulty
+        self.total_difficulty = total_difficulty
+        self.nonce = nonce
+        self.state_root = state_root
+        self.hash = sha256(encode_header(self)).hexdigest()
+
+    @classmethod
+    def from_block(cls, block):
+        return cls(*header_to_list(block))
+
+    def to_list(self):
+        return header_to_list(self)
+
+
+def header_to_list(block):
+    """
+    Fields of the header of a block or BlockHeader, in the order of encode_header
+    """
+    return [block.height, block.parent_hash, block.transactions_root, block.miner_id, block.timestamp,
+            block.difficulty, block.total_difficulty, block.nonce, block.state_root]
@@ -0,0 +1,122 @@
+from toychain.src.Block import Block
+from toychain.src.Mempool import short_id
+from toychain.src.Transaction import Transaction
+
+SHORT_ID_SIZE = 8
+
+
+class CompactBlock:
+    """
+    Block as relayed to a peer: the header, the short ids of the transactions and only the transactions
+    the peer is unlikely to hold (prefilled). The receiver fills the other ones from its mempool,
+    requests the ones it misses, and checks the rebuilt block against the hash of the original.
+    The state is not relayed: the receiver applies the transactions to the state of the parent block
+    and checks the result against the state root of the header.
+
+    On the wire, the short ids of the transactions that are not prefilled are packed in bytes,
+    followed by a bitmap of the prefilled indexes and the prefilled transactions.
+    """
+
+    def __init__(self, hash, height, parent_hash, miner_id, timestamp, difficulty, total_difficulty, nonce,
+                 state_root, short_ids, prefilled):
+        """
+        Args:
+            short_ids: short ids of the transactions, None for the prefilled ones is allowed
+            prefilled: [[index, transaction], ...]
+        """
+        self.hash = hash
+        self.height = height
+        self.parent_hash = parent_hash
+        self.miner_id = miner_id
+        self.timestamp = timestamp
+        self.difficulty = difficulty
+        self.total_difficulty = total_difficulty
+        self.nonce = nonce
+        self.state_root = state_root
+        self.short_ids = short_ids
+
+        # Transactions of the block, None until found
+        self.data = [None] * len(short_ids)
+        for index, transaction in prefilled:
+            self.data[index] = transaction
+
+    @classmethod
+    def from_block(cls, block, known=()):
+        """
+        Args:
+            known: short ids of the transactions the peer holds, the others are prefilled
+        """
+        short_ids = [short_id(tx.id) for tx in block.data]
+        prefilled = [[index, tx] for index, tx in enumerate(block.data) if short_ids[index] not in known]
+        return cls(block.hash, block.height, block.parent_hash, block.miner_id, block.timestamp, block.difficulty,
+                   block.total_difficulty, block.nonce, block.state_root, short_ids, prefilled)
+
+    def to_list(self):
+        bitmap = bytearray((len(self.data) + 7) // 8)
+        for index, tx in enumerate(self.data):
+            if tx is not None:
+                bitmap[index // 8] |= 1 << (index % 8)
+        short_ids = b''.join(short.to_bytes(SHORT_ID_SIZE, 'big')
+                             for short, tx in zip(self.short_ids, self.data) if tx is None)
+        return [self.hash, self.height, self.parent_hash, self.miner_id, self.timestamp, self.difficulty,
+                self.total_difficulty, self.nonce, self.state_root, short_ids, bytes(bitmap),
+                [tx for tx in self.data if tx is not None]]
+
+    @classmethod
+    def from_list(cls, _list):
+        """
+        Raises a ValueError if the list is not a compact block: the bitmap must mark as many transactions
+        as are prefilled, and the packed short ids must fill the other indexes
+        """
+        if not isinstance(_list, (list, tuple)) or len(_list) != 12:
+            raise ValueError("Malformed compact block")
+        *header, packed_ids, bitmap, transactions = _list
+        if not isinstance(packed_ids, bytes) or not isinstance(bitmap, bytes) or not isinstance(transactions, list) \
+                or not all(isinstance(tx, Transaction) for tx in transactions) or len(packed_ids) % SHORT_ID_SIZE:
+            raise ValueError("Malformed compact block")
+        size = len(transactions) + len(packed_ids) // SHORT_ID_SIZE
+        if len(bitmap) != (size + 7) // 8:
+            raise ValueError(f"Bitmap of {len(bitmap)} bytes for {size} transactions")
+        indexes = [index for index in range(size) if bitmap[index // 8] >> (index % 8) & 1]
+        if len(indexes) != len(transactions) or sum(bin(byte).count('1') for byte in bitmap) != len(indexes):
+            raise ValueError(f"Bitmap of {len(indexes)} prefilled transactions for {len(transactions)}")
+        packed = iter(int.from_bytes(packed_ids[i:i + SHORT_ID_SIZE], 'big')
+                      for i in range(0, len(packed_ids), SHORT_ID_SIZE))
+        short_ids = [None if bitmap[index // 8] >> (index % 8) & 1 else next(packed) for index in range(size)]
+        return cls(*header, short_ids, list(zip(indexes, transactions)))
+
+    @property
+    def prefilled_count(self):
+        return sum(tx is not None for tx in self.data)
+
+    def fill(self, lookup):
+        """
+        Fills the missing transactions with lookup(short id) -> transaction or None
+        :return: indexes of the transactions still missing
+        """
+        missing = []
+        for index, transaction in enumerate(self.data):
+            if transaction is None:
+                transaction = lookup(self.short_ids[index])
+                if transaction is None:
+                    missing.append(index)
+                else:
+                    self.data[index] = transaction
+        return missing
+
+    def to_block(self, previous_state):
+        """
+        Returns the rebuilt block with its state, applied on the state of the parent block, None if it
+        does not match the original (transaction missing, collision of short ids, or other state root)
+        """
+        if any(tx is None for tx in self.data):
+            return None
+        block = Block(self.height, self.parent_hash, self.data, self.miner_id, self.timestamp, self.difficulty,
+                      self.total_difficulty - self.difficulty, self.nonce, state=previous_state.fork(),
+                      state_root=self.state_root)
+        if block.hash != self.hash:
+            return None
+        block.state.apply_transactions(block.data, block)
+        if block.state.state_hash != self.state_root:
+            return None
+        return block
@@ -0,0 +1,223 @@
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+
+DIGEST_MODULUS = 1 << 64
+_MASK = DIGEST_MODULUS - 1
+
+# Number of cells of the first sketch of a sync, multiplied by SKETCH_GROWTH after every decoding failure
+SKETCH_CELLS = 48
+SKETCH_GROWTH = 4
+# Cells of a sketch each short id is added to, one in each part of the sketch
+SKETCH_HASHES = 3
+# Short ids remembered per peer by KnownInventory, the oldest are forgotten first
+KNOWN_INVENTORY_SIZE = 10000
+
+
+def short_id(transaction_id):
+    """
+    64 bits id of a transaction, exchanged instead of the full id to reconcile mempools
+    """
+    return int.from_bytes(sha256(transaction_id.encode()).digest()[:8], 'big')
+
+
+def _mix(value, salt):
+    # splitmix64 finalizer
+    value = (value + salt * 0x9E3779B97F4A7C15) & _MASK
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK
+    return value ^ (value >> 31)
+
+
+def _cells_of(short, part_size):
+    return [i * part_size + _mix(short, i + 1) % part_size for i in range(SKETCH_HASHES)]
+
+
+def _check(short):
+    return _mix(short, SKETCH_HASHES + 1)
+
+
+def sketch(shorts, size):
+    """
+    Invertible Bloom lookup table of a set of short ids: size cells of (count, xor of the ids, xor of
+    their check values), flattened in a list. The difference of the sketches of two sets, of any size,
+    gives back the ids that are only in one of them, most of the time if there are fewer than size / 2.
+    """
+    part_size = max(size // SKETCH_HASHES, 1)
+    cells = [0] * (3 * part_size * SKETCH_HASHES)
+    for short in shorts:
+        check = _check(short)
+        for cell in _cells_of(short, part_size):
+            cells[3 * cell] += 1
+            cells[3 * cell + 1] ^= short
+            cells[3 * cell + 2] ^= check
+    return cells
+
+
+def sketch_difference(cells, other_cells):
+    """
+    Decodes the difference of two sketches of the same size
+    :return: (ids only in the first set, ids only in the second set), None if it cannot be decoded
+    """
+    if len(cells) != len(other_cells) or len(cells) % (3 * SKETCH_HASHES):
+        return None
+    cells = [a - b if i % 3 == 0 else a ^ b for i, (a, b) in enumerate(zip(cells, other_cells))]
+    part_size = len(cells) // (3 * SKETCH_HASHES)
+    first, second = [], []
+
+    # Peel the cells holding a single id, removing it from its other cells may uncover new ones
+    pending = list(range(len(cells) // 3))
+    peeled = set()
+    while pending:
+        cell = pending.pop()
+        count, short, check = cells[3 * cell:3 * cell + 3]
+        if count not in (1, -1) or _check(short) != check:
+            continue
+        if short in peeled:
+            # Only a forged sketch, with an id missing from some of its cells, gives an id twice
+            return None
+        peeled.add(short)
+        (first if count == 1 else second).append(short)
+        for other in _cells_of(short, part_size):
+            cells[3 * other] -= count
+            cells[3 * other + 1] ^= short
+            cells[3 * other + 2] ^= check
+            pending.append(other)
+
+    if any(cells):
+        return None
+    return first, second
+
+
+class Mempool(dict):
+    """
+    Pending transactions {tx_id: transaction}, with the short ids of the transactions
+    and an incremental digest of the content (sum of the short ids modulo DIGEST_MODULUS)
+
+    Two nodes with the same digest have the same mempool, so a mempool sync starts by comparing
+    digests. Otherwise the peer sends a sketch of its short ids (or their inventory, if smaller),
+    from which the missing transactions are found and requested.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.digest = 0
+        # {short id: tx_id}
+        self.short_ids = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, tx_id, transaction):
+        if tx_id not in self:
+            short = short_id(tx_id)
+            self.short_ids[short] = tx_id
+            self.digest = (self.digest + short) % DIGEST_MODULUS
+        super().__setitem__(tx_id, transaction)
+
+    def __delitem__(self, tx_id):
+        super().__delitem__(tx_id)
+        self._forget(tx_id)
+
+    def _forget(self, tx_id):
+        short = short_id(tx_id)
+        self.short_ids.pop(short, None)
+        self.digest = (self.digest - short) % DIGEST_MODULUS
+
+    def pop(self, tx_id, *default):
+        if tx_id in self:
+            self._forget(tx_id)
+        return super().pop(tx_id, *default)
+
+    def popitem(self):
+        tx_id, transaction = super().popitem()
+        self._forget(tx_id)
+        return tx_id, transaction
+
+    def setdefault(self, tx_id, transaction=None):
+        if tx_id not in self:
+            self[tx_id] = transaction
+        return self[tx_id]
+
+    def update(self, *args, **kwargs):
+        for tx_id, transaction in dict(*args, **kwargs).items():
+            self[tx_id] = transaction
+
+    def clear(self):
+        super().clear()
+        self.short_ids.clear()
+        self.digest = 0
+
+    def copy(self):
+        return dict(self)
+
+    def inventory(self):
+        """
+        Short ids of the transactions of the mempool
+        """
+        return list(self.short_ids)
+
+    def sketch(self, size):
+        return sketch(list(self.short_ids), size)
+
+    def reconcile(self, size):
+        """
+        Answer to a sync request of a peer with another digest: a sketch of the given size, or the
+        inventory if it is smaller or if size is None
+        """
+        if size is None or 3 * size >= len(self.short_ids):
+            return ["inventory", self.inventory()]
+        return ["sketch", self.sketch(size)]
+
+    def missing_from_sketch(self, cells):
+        """
+        Short ids of the peer sketch that are not in this mempool, None if it cannot be decoded
+        """
+        difference = sketch_difference(cells, self.sketch(len(cells) // 3))
+        if difference is None:
+            return None
+        return difference[0]
+
+    def missing(self, inventory):
+        """
+        Short ids of an inventory that are not in this mempool
+        """
+        return [short for short in inventory if short not in self.short_ids]
+
+    def get_short(self, shorts):
+        """
+        Transactions of the mempool with the given short ids
+        """
+        transactions = []
+        for short in shorts:
+            transaction = self.get(self.short_ids.get(short))
+            if transaction is not None:
+                transactions.append(transaction)
+        return transactions
+
+
+class KnownInventory:
+    """
+    Short ids of the transactions each peer is known to hold {enode: OrderedDict}, from the mempool
+    syncs and the blocks exchanged with it. Blocks are relayed to a peer without these transactions.
+
+    Updated from the server and node threads, peer() can be read without the lock.
+    """
+
+    def __init__(self, size=KNOWN_INVENTORY_SIZE):
+        self.size = size
+        self._peers = {}
+        self._lock = threading.Lock()
+
+    def peer(self, enode):
+        return self._peers.get(enode, {})
+
+    def add(self, enode, shorts):
+        with self._lock:
+            known = self._peers.setdefault(enode, OrderedDict())
+            for short in shorts:
+                known[short] = None
+            while len(known) > self.size:
+                known.popitem(last=False)
+
+    def forget(self, enode):
+        with self._lock:
+            self._peers.pop(enode, None)
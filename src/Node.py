@@ -1,9 +1,15 @@
-import urllib.parse, hashlib, json
+import urllib.parse, hashlib
+import random
 
-from toychain.src.connections.NodeServerThread import NodeServerThread
+from toychain.src.connections.AsyncNodeServer import AsyncNodeServer
+from toychain.src.connections.Loopback import LoopbackNetwork, LoopbackServer
+from toychain.src.connections.NodeServerThread import NodeServerThread, NodeServerThreadUDP
 from toychain.src.connections.Pingers import ChainPinger, MemPoolPinger
-from toychain.src.utils.helpers import CustomTimer, create_block_from_list
-from toychain.src.Block import Block
+from toychain.src.Mempool import Mempool, short_id
+from toychain.src.storage.BlockStore import BlockStore
+from toychain.src.utils import metrics
+from toychain.src.utils.constants import ASYNC_SERVER, TRANSPORT
+from toychain.src.utils.helpers import CustomTimer
 
 import logging
 logger = logging.getLogger('w3')
@@ -11,16 +17,33 @@ logger = logging.getLogger('w3')
 class Node:
     """
     Class representing a 'user' that has his id, his blockchain and his mem-pool
+    If chain_dir is given, the chain is kept in an on-disk BlockStore and reopened from there
+    If event_loop (EventLoopThread) is given, or ASYNC_SERVER is set, requests are answered by an
+    AsyncNodeServer on that loop, or on its own, instead of a NodeServerThread
+    transport selects how nodes exchange messages, "tcp" or "udp" (default TRANSPORT), or a LoopbackNetwork
+    shared by nodes of the same process
+    timer (CustomTimer) is shared by nodes stepped together by a Simulator, by default the node has its own
+    random is the generator of the draws of the node (block nonces, lotteries), seeded by a Simulator
     """
 
-    def __init__(self, id, host, port, consensus):
+    def __init__(self, id, host, port, consensus, chain_dir=None, event_loop=None, transport=None, timer=None):
         self.id = id
         self.chain = []
-        self.mempool = {}
+        self.mempool = Mempool()
 
-        # Transactions contained in the chain
+        # Transactions contained in the chain {tx_id: (height, index in block)}
         self.my_transaction_nonce = 0
-        self.previous_transactions_id = set()
+        self._tx_index = {}
+
+        if chain_dir is not None:
+            self.chain = BlockStore(chain_dir)
+            # Loaded from the store on first use
+            self._tx_index = None
+
+            # Only the blocks after the newest state checkpoint are replayed
+            replayed = self.chain.restore_tip()
+            if len(self.chain):
+                logger.info(f"Restored chain of {len(self.chain)} blocks from {chain_dir} ({replayed} blocks replayed)")
 
         self.host = host
         self.port = port
@@ -29,15 +52,29 @@ class Node:
 
         self.consensus = consensus
         # Initialize the genesis Block
-        self.chain.append(self.consensus.genesis)
+        if len(self.chain) == 0:
+            self.add_block(self.consensus.genesis)
+        elif self.chain[0].hash != self.consensus.genesis.hash:
+            raise ValueError(f"The chain stored in {chain_dir} does not start with the genesis block of the consensus")
 
         # {enode: node_info}
         self.peers = {}
 
-        self.custom_timer = CustomTimer()
+        self.custom_timer = timer if timer is not None else CustomTimer()
+        self.random = random.Random()
 
         # Sync Threads
-        self.node_server_thread = NodeServerThread(self, host, port, id)
+        transport = transport or TRANSPORT
+        if isinstance(transport, LoopbackNetwork):
+            self.node_server_thread = LoopbackServer(self, host, port, id, transport)
+        elif transport == "udp":
+            self.node_server_thread = NodeServerThreadUDP(self, host, port, id)
+        elif transport != "tcp":
+            raise ValueError(f"Unknown transport {transport}")
+        elif event_loop is not None or ASYNC_SERVER:
+            self.node_server_thread = AsyncNodeServer(self, host, port, id, event_loop)
+        else:
+            self.node_server_thread = NodeServerThread(self, host, port, id)
         self.message_handler = self.node_server_thread.message_handler
         self.mempool_sync_thread = MemPoolPinger(self)
         self.chain_sync_thread = ChainPinger(self)
@@ -45,8 +82,27 @@ class Node:
         self.syncing = False
         self.mining = False
         self.mining_thread = consensus.block_generation(self)
+        metrics.watch(self)
     
 
+    @property
+    def tx_index(self):
+        if self._tx_index is None:
+            self._tx_index = dict(self.chain.transaction_locations())
+        return self._tx_index
+
+    @property
+    def previous_transactions_id(self):
+        """
+        ids of the transactions contained in the chain, a read-only view of tx_index
+        """
+        return self.tx_index.keys()
+
+    @previous_transactions_id.setter
+    def previous_transactions_id(self, value):
+        # Formerly a set updated by the consensus, the chain is now the only source of the ids
+        raise AttributeError("previous_transactions_id follows the chain, add the blocks with Node.add_block")
+
     @property
     def sc(self):
         return self.get_block('latest').state
@@ -56,9 +112,13 @@ class Node:
         Executes a time step for this node
         """
         self.custom_timer.step()
+        self.node_server_thread.process_answers()
+        self.message_handler.announcer.process()
+        self.message_handler.download.start()
         self.mempool_sync_thread.step()
         self.chain_sync_thread.step()
         self.mining_thread.step()
+        self.message_handler.announcer.flush()
     
     def start(self):
         self.start_mining()
@@ -67,6 +127,7 @@ class Node:
     def stop(self):
         self.stop_mining()
         self.stop_tcp()
+        metrics.unwatch(self)
 
     def start_mining(self):
         print(f"Node {self.id} started mining")
@@ -103,6 +164,8 @@ class Node:
         logger.info("Destroyed")
         self.stop_tcp()
         self.stop_mining()
+        if isinstance(self.chain, BlockStore):
+            self.chain.close()
 
     def get_block_number(self):
         """
@@ -124,59 +187,126 @@ class Node:
             except IndexError:
                 return None
 
+    def get_block_hash(self, height):
+        """
+        returns the hash of the block at the referred height, None if there is none
+        a stored chain reads it without rebuilding the state of the block
+        """
+        if not 0 <= height < len(self.chain):
+            return None
+        if isinstance(self.chain, BlockStore):
+            return self.chain.block_hash(height)
+        return self.chain[height].hash
+
+    def add_block(self, block):
+        """
+        Appends a block to the chain and indexes its transactions
+        """
+        self.chain.append(block)
+        self.index_block(block)
+
+    def index_block(self, block):
+        for index, transaction in enumerate(block.data):
+            self.tx_index[transaction.id] = (block.height, index)
+
+    def unindex_block(self, block):
+        for transaction in block.data:
+            location = self.tx_index.get(transaction.id)
+            if location is not None and location[0] == block.height:
+                del self.tx_index[transaction.id]
+
     def sync_mempool(self, transactions):
         """
         Synchronises the mempool with a list of transaction objects
         """
+        added = []
         for transaction in transactions:
-            if transaction.id not in self.previous_transactions_id:
+            if transaction.id not in self.previous_transactions_id and transaction.id not in self.mempool:
                 self.add_to_mempool(transaction)
+                added.append(transaction)
+        self.message_handler.announcer.add_transactions(added)
 
-    def sync_chain(self, chain_repr, height):
+    @metrics.timed("toychain_sync_chain_seconds")
+    def sync_chain(self, chain, height):
         """
-        Adds the partial chain received to the blockchain
+        Adds the partial chain received to the blockchain, rebuilding the compact blocks
+        with the transactions of the mempool and of the blocks they replace
 
         Args:
-            chain_repr(list[str]): list of block representation from a partial chain received
+            chain(list[CompactBlock]): compact blocks of a partial chain received
             height: the height at which the partial chain is supposed to be inserted
+        :return: {index in chain: indexes of the transactions missing from the compact block} if some
+                 are not found locally, the chain is then merged once they are filled in
         """
-        logger.info("Merging chains")
-        chain = []
-        # Reconstruct the partial chain
-        for block_repr in chain_repr:
-            block_vars = create_block_from_list(block_repr)
-            chain.append(Block(*block_vars))
+        lookup = self.transaction_lookup(height)
+        missing = {}
+        for i, compact in enumerate(chain):
+            indexes = compact.fill(lookup)
+            if indexes:
+                missing[i] = indexes
+        if missing:
+            return missing
+
+        # The states are rebuilt by applying the blocks on the state of the block they follow
+        previous = self.get_block(height)
+        blocks = []
+        for compact in chain:
+            block = compact.to_block(previous.state) if previous is not None else None
+            if block is None:
+                logger.warning(f"Node {self.id} could not rebuild the compact blocks received")
+                return None
+            blocks.append(block)
+            previous = block
+        chain = blocks
 
+        logger.info("Merging chains")
         for block in chain:
             block.reception = self.custom_timer.time()
         # if chain[-1].total_difficulty < self.get_block('last').total_difficulty:
         #     return
 
-        if not self.verify_chain(chain):
+        if not self.verify_chain(chain, height):
             return
 
         if chain[0].parent_hash == self.get_block(height).hash:
-            # update mempool
+            # Replace self chain with the other chain
+            removed = self.chain[height+1:]
+            for block in removed:
+                self.unindex_block(block)
+            del self.chain[height+1:]
+
+            # Append the received blocks and update mempool
             for block in chain:
+                self.add_block(block)
                 for transaction in block.data:
                     self.mempool.pop(transaction.id, None)
-                    self.previous_transactions_id.add(transaction.id)
 
             # retrieving possible missed transactions
-            for block in self.chain[height+1:]:
+            for block in removed:
                 for transaction in block.data:
-                    if transaction.id not in self.previous_transactions_id:
+                    if transaction.id not in self.tx_index:
                         self.add_to_mempool(transaction)
 
-            # Replace self chain with the other chain
-            del self.chain[height+1:]
-            self.chain.extend(chain)
             logger.info(f"Node {self.id} has updated its chain, total difficulty : {self.get_block('last').total_difficulty}, n = {chain[-1].state.state_variables.get('n')}")
             for block in self.chain[-5:]:
                 logger.info(f"{block.__repr__()}   ##{len(block.data)}##  {block.state.state_variables}")
         else:
             logger.info("Chain does not fit here")
 
+    def transaction_lookup(self, height):
+        """
+        Finds transactions by short id in the mempool and in the blocks above height
+        :return: lookup(short id) -> transaction or None
+        """
+        replaced = {short_id(transaction.id): transaction for block in self.chain[height+1:] for transaction in block.data}
+
+        def lookup(short):
+            transaction = self.mempool.get(self.mempool.short_ids.get(short))
+            if transaction is None:
+                transaction = replaced.get(short)
+            return transaction
+        return lookup
+
     def add_peer(self, enode):
         # if len(self.peers) > 5:
         #     print('max peers reached')
@@ -194,17 +324,28 @@ class Node:
     def remove_peer(self, enode):
         if self.peers.pop(enode, None):
             logger.debug(f"Node {self.id} removing peer at {enode}")
+            self.node_server_thread.disconnect(enode)
+            self.node_server_thread.message_handler.known.forget(enode)
 
     def node_info(self):
         info = {"enode": self.enode, "id": self.id, "ip": self.host, "port": self.port}
         return info
 
-    def verify_chain(self, chain):
-        return self.consensus.verify_chain(chain, self.get_block('last').state)
+    @metrics.timed("toychain_verify_chain_seconds")
+    def verify_chain(self, chain, height=None):
+        """
+        Verifies a partial chain following the block at the given height (default the last one)
+        """
+        previous = self.get_block('last' if height is None else height)
+        if previous is None:
+            return False
+        return self.consensus.verify_chain(chain, previous.state)
 
     def send_transaction(self, transaction):
         logger.info(f"Sending transaction {transaction}")
         self.add_to_mempool(transaction)
+        self.message_handler.announcer.add_transactions([transaction])
+        self.node_server_thread.wake()
         return transaction.id
 
     def get_transaction(self, transaction_id):
@@ -214,19 +355,29 @@ class Node:
         """
         transaction = self.mempool.get(transaction_id, None)
         if not transaction:
-            for block in self.chain:
-                for t in block.data:
-                    if t.id == transaction_id:
-                        return t
+            location = self.tx_index.get(transaction_id)
+            if location is not None:
+                height, index = location
+                return self.chain[height].data[index]
         return transaction
 
+    def get_transaction_proof(self, transaction_id):
+        """
+        Returns the height of the block containing the transaction and its Merkle inclusion proof,
+        None if the transaction is not in the chain
+        A client holding only the block headers checks it with Block.verify_transaction_proof
+        """
+        location = self.tx_index.get(transaction_id)
+        if location is None:
+            return None
+        height, index = location
+        return height, self.chain[height].get_transaction_proof(transaction_id, index)
+
     def get_transaction_receipt(self, transaction_id):
         """
         returns whether the specified transaction is in the chain
         """
-        if transaction_id in self.previous_transactions_id:
-            return True
-        return False
+        return transaction_id in self.tx_index
 
     def get_all_transactions(self):
         """
@@ -237,8 +388,15 @@ class Node:
             all_txs.extend(block.data)
         return all_txs
 
-    def get_last_signed_block(self):
-        for block in reversed(self.chain):
+    def get_last_signed_block(self, depth=None):
+        """
+        returns the height of the last block signed by the node among the last depth blocks (all by default), 0 if none
+        a stored chain only reads the miner of the blocks, without rebuilding their states
+        """
+        length = len(self.chain)
+        lowest = 0 if depth is None else max(length - depth, 0)
+        for height in reversed(range(lowest, length)):
+            block = self.chain.header(height) if isinstance(self.chain, BlockStore) else self.chain[height]
             if block.miner_id == self.enode:
                 return block.height
         return 0
@@ -254,17 +412,8 @@ class Node:
         return int(self.chain[-1].total_difficulty)
 
     def mempool_hash(self, astype = None, digest_size = 1):
-        # Step 1: Convert each transaction to a serialized JSON string
-        serialized_mempool = [json.dumps(txn, sort_keys=True) for txn in self.mempool]
-        
-        # Step 2: Sort the serialized transactions to ensure order doesn't matter
-        serialized_mempool.sort()
-        
-        # Step 3: Concatenate the sorted serialized transactions
-        combined = ''.join(serialized_mempool)
-        
-        # Step 4: Hash the combined string using SHA-256
-        blake2s_hash = hashlib.blake2s(combined.encode(), digest_size=digest_size)
+        # Hash of the incremental digest of the mempool, it does not depend on the order of the transactions
+        blake2s_hash = hashlib.blake2s(self.mempool.digest.to_bytes(8, 'big'), digest_size=digest_size)
         if astype == 'string' or astype == 'str' or astype == str:
             return blake2s_hash.hexdigest()
         if astype == 'integer' or astype == 'int' or astype == int:
@@ -0,0 +1,305 @@
+import abc
+import heapq
+import logging
+import multiprocessing
+import pickle
+import traceback
+from collections import defaultdict
+
+from toychain.src.Simulator import Simulator
+
+logger = logging.getLogger('w3')
+
+
+class Scenario(abc.ABC):
+    """
+    Swarm simulated by a ShardedSimulator, each process has its own copy (it must be picklable if the
+    processes are not forked)
+
+    Its size nodes, numbered from 0, are created by create_node on the Simulator of their shard and
+    connected to the nodes given by peers. control is called after every step with the nodes of the
+    shard only, to send transactions for instance: give them explicit ids (see Transaction), or two
+    runs cannot give the same chains. result is what is kept of a node at the end.
+    """
+    size = 0
+
+    @abc.abstractmethod
+    def create_node(self, simulator, index):
+        """
+        Creates the node index with simulator.add_node
+        """
+
+    def peers(self, index):
+        """
+        Indices of the peers of the node index
+        """
+        return []
+
+    def control(self, nodes, time):
+        """
+        Called after every step with the nodes of the shard {index: node}
+        """
+
+    def result(self, node):
+        last = node.get_block('last')
+        return last.height, last.hash
+
+
+class _Records(logging.Handler):
+    """
+    Log records of a shard with the time of the simulation at which they were emitted
+    """
+
+    def __init__(self, timer, level):
+        super().__init__(level)
+        self.timer = timer
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((self.timer.time(), record.name, record.levelname, record.getMessage()))
+
+
+class _Shard(Simulator):
+    """
+    Simulator of the nodes of one shard, the events for the nodes of the other shards are kept in
+    an outbox until the end of the window
+    """
+
+    def __init__(self, index, latency, loss, seed):
+        super().__init__(latency, loss, seed)
+        self.index = index
+        # {enode: index of its shard} of all the nodes
+        self.shards = {}
+        # {index of a shard: [event]}
+        self.outbox = defaultdict(list)
+        self.remote_events = 0
+
+    def listening(self, enode):
+        shard = self.shards.get(enode, self.index)
+        return enode in self.servers if shard == self.index else True
+
+    def send_event(self, delay, origin, enode, event):
+        shard = self.shards.get(enode, self.index)
+        if shard == self.index:
+            super().send_event(delay, origin, enode, event)
+        else:
+            # The latency of the messages between nodes is 1 step or more, the event is due after the window
+            self.outbox[shard].append((self.timer.time() + delay, origin.node.enode, next(origin.events), enode, event))
+            self.remote_events += 1
+
+
+class _ShardRunner:
+    """
+    Nodes of one shard and their Simulator, driven by the ShardedSimulator through a pipe or directly
+    """
+
+    def __init__(self, scenario, index, indices, latency, loss, seed, log_level):
+        self.scenario = scenario
+        self.shard = _Shard(index, latency, loss, seed)
+        self.indices = indices
+        self.nodes = {}
+        self.records = None
+        if log_level is not None:
+            self.records = _Records(self.shard.timer, log_level)
+            root = logging.getLogger()
+            root.addHandler(self.records)
+            self.root_level = root.level
+            if root.getEffectiveLevel() > log_level:
+                root.setLevel(log_level)
+
+    def create(self):
+        """
+        :return: enodes of the nodes of the shard {index: enode}
+        """
+        for index in self.indices:
+            self.nodes[index] = self.scenario.create_node(self.shard, index)
+        return {index: node.enode for index, node in self.nodes.items()}
+
+    def start(self, enodes, shards):
+        """
+        Connects the nodes to their peers and starts them
+        Args:
+            enodes: enodes of all the nodes {index: enode}
+            shards: {enode: index of its shard}
+        """
+        self.shard.shards = shards
+        for index, node in self.nodes.items():
+            for peer in self.scenario.peers(index):
+                if peer != index:
+                    node.add_peer(enodes[peer])
+        self.shard.start()
+
+    def run(self, steps, inbox):
+        """
+        Runs a window of steps after adding the events sent by the other shards
+        :return: events for the other shards {index of a shard: pickled events}
+        """
+        for events in inbox:
+            for event in pickle.loads(events):
+                heapq.heappush(self.shard._events, event)
+        for _ in range(steps):
+            self.shard.step()
+            self.scenario.control(self.nodes, self.shard.timer.time())
+        outbox = {shard: pickle.dumps(events, pickle.HIGHEST_PROTOCOL) for shard, events in self.shard.outbox.items()}
+        self.shard.outbox.clear()
+        return outbox
+
+    def stop(self):
+        """
+        :return: results of the nodes {index: result}, log records, node steps and events sent to other shards
+        """
+        self.shard.stop()
+        records = []
+        if self.records is not None:
+            logging.getLogger().removeHandler(self.records)
+            logging.getLogger().setLevel(self.root_level)
+            records = self.records.records
+        results = {index: self.scenario.result(node) for index, node in self.nodes.items()}
+        return results, records, self.shard.node_steps, self.shard.remote_events
+
+
+def _serve(connection, *args):
+    """
+    Process of a shard: calls the methods of its _ShardRunner received through connection
+    """
+    try:
+        runner = _ShardRunner(*args)
+        while True:
+            method, arguments = connection.recv()
+            connection.send(("ok", getattr(runner, method)(*arguments)))
+            if method == "stop":
+                break
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+class ShardedSimulator:
+    """
+    Simulation of a swarm split in shards of nodes, each stepped by a Simulator in its own process
+
+    The nodes of the Scenario are split in shards of contiguous indices, the shards advance in
+    lock-step: messages between nodes take latency steps (1 or more), so the shards can run latency
+    steps apart from each other, the events a shard sends meanwhile to the others are only due after
+    that. At the end of each window of latency steps, the events for other shards are exchanged in
+    one pickled batch per shard, forwarded as is by this process.
+
+    As events are handled in the same order whatever the order of the nodes (see LoopbackNetwork),
+    and every node draws from its own generator, the nodes end as in a run with shards=1, which
+    steps a single Simulator in this process. At the end, results holds the results of the nodes
+    (Scenario.result) by index, and logs the records of the level log_level (time, logger, level,
+    message) ordered by time, then by content, so that they are the same for any number of shards.
+    """
+
+    def __init__(self, scenario, shards=1, latency=1, loss=0, seed=0, log_level=None):
+        if latency < 1:
+            raise ValueError("Nodes of different shards need a latency of 1 step or more")
+        self.scenario = scenario
+        self.latency = latency
+        self.shard_count = max(1, min(shards, scenario.size))
+
+        size = scenario.size
+        arguments = [(scenario, shard, range(shard * size // self.shard_count, (shard + 1) * size // self.shard_count),
+                      latency, loss, seed, log_level) for shard in range(self.shard_count)]
+        self._runners = None
+        self._connections = []
+        self._processes = []
+        if self.shard_count == 1:
+            self._runners = [_ShardRunner(*arguments[0])]
+        else:
+            for shard_arguments in arguments:
+                connection, worker_connection = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_serve, args=(worker_connection,) + shard_arguments,
+                                                  daemon=True)
+                process.start()
+                worker_connection.close()
+                self._connections.append(connection)
+                self._processes.append(process)
+
+        # Pickled events for every shard, from the last window
+        self._inboxes = [[] for _ in range(self.shard_count)]
+        self.time = 0
+        self.results = {}
+        self.logs = []
+        self.node_steps = 0
+        self.remote_events = 0
+
+    def _call(self, method, arguments):
+        """
+        Calls a method of the runners of all the shards, arguments(shard) gives the arguments for a shard
+        :return: answers of the shards
+        """
+        if self._runners is not None:
+            return [getattr(runner, method)(*arguments(shard)) for shard, runner in enumerate(self._runners)]
+        for shard, connection in enumerate(self._connections):
+            try:
+                connection.send((method, arguments(shard)))
+            except OSError as e:
+                self._lost(shard, e)
+        answers = []
+        for shard, connection in enumerate(self._connections):
+            try:
+                status, answer = connection.recv()
+            except (EOFError, OSError) as e:
+                self._lost(shard, e)
+            if status == "error":
+                self._terminate()
+                raise RuntimeError(f"Shard {shard} failed:\n{answer}")
+            answers.append(answer)
+        return answers
+
+    def _lost(self, shard, error):
+        """
+        Stops the simulation when the process of a shard has died (killed, out of memory, ...)
+        """
+        process = self._processes[shard]
+        process.join(1)
+        code = process.exitcode
+        self._terminate()
+        raise RuntimeError(f"Process of shard {shard} exited with code {code}") from error
+
+    def start(self):
+        """
+        Creates the nodes in their shards, connects them to their peers and starts them
+        """
+        enodes = {}
+        shards = {}
+        for shard, shard_enodes in enumerate(self._call("create", lambda shard: ())):
+            enodes.update(shard_enodes)
+            shards.update({enode: shard for enode in shard_enodes.values()})
+        self._call("start", lambda shard: (enodes, shards))
+
+    def run(self, steps):
+        while steps > 0:
+            window = min(self.latency, steps)
+            inboxes = self._inboxes
+            self._inboxes = [[] for _ in range(self.shard_count)]
+            for outbox in self._call("run", lambda shard: (window, inboxes[shard])):
+                for shard, events in outbox.items():
+                    self._inboxes[shard].append(events)
+            self.time += window
+            steps -= window
+
+    def stop(self):
+        """
+        Stops the nodes and gathers their results
+        """
+        for results, records, node_steps, remote_events in self._call("stop", lambda shard: ()):
+            self.results.update(results)
+            self.logs.extend(records)
+            self.node_steps += node_steps
+            self.remote_events += remote_events
+        # Sorted by time, then by content: the records of a step are in the same order whatever the shards
+        self.logs.sort()
+        self.results = dict(sorted(self.results.items()))
+        self._terminate()
+
+    def _terminate(self):
+        for connection in self._connections:
+            connection.close()
+        for process in self._processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+                process.join(1)
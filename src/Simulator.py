@@ -0,0 +1,125 @@
+from toychain.src.Node import Node
+from toychain.src.connections.Loopback import LoopbackNetwork, WAKE
+
+import logging
+logger = logging.getLogger('w3')
+
+
+class Simulator(LoopbackNetwork):
+    """
+    Swarm of nodes of one process stepped together on a LoopbackNetwork, waking only the nodes that
+    have something to do
+
+    Stepping every node at every time step (Node.step) costs nodes x steps, although a node mostly
+    counts down the intervals of its pingers and checks that it cannot produce a block yet. Here the
+    nodes share the timer of the network, and its queue of events holds the time at which each
+    component of a node is due next (see next_run of the pingers and block generations). At each
+    step a node is only stepped if one of its components is due, or if it has received a message or
+    an answer, or sent a transaction, so the cost of a simulation follows its events.
+
+    A node stepped does what Node.step does, in the same order, with only the components due. The
+    block generation is due again whenever the chain of the node changes. The nodes are created with
+    add_node and must not be stepped with Node.step.
+
+    Every node draws from its own generator (Node.random), seeded with seed and its enode, and so do
+    the losses of the messages it sends: with a latency of 1 step or more, a simulation gives the
+    same result whatever the order in which the nodes are stepped.
+    """
+
+    def __init__(self, latency=0, loss=0, seed=0):
+        super().__init__(latency, loss, seed)
+        self.seed = seed
+        self.nodes = []
+        # Servers of the nodes to step at the next step {server: None}, in the order they were woken
+        self._woken = {}
+        # Time at which the components of the nodes are due {component: time}
+        self._due = {}
+        # Number of nodes stepped since the start
+        self.node_steps = 0
+
+    def add_node(self, id, host, port, consensus, **kwargs):
+        """
+        Creates a node of the simulation, it is started with start or start_node
+        """
+        node = Node(id, host, port, consensus, transport=self, timer=self.timer, **kwargs)
+        node.random.seed(f"{self.seed}/{node.enode}")
+        self.nodes.append(node)
+        return node
+
+    def start(self):
+        for node in self.nodes:
+            self.start_node(node)
+
+    def stop(self):
+        for node in self.nodes:
+            self.stop_node(node)
+
+    def start_node(self, node):
+        """
+        Starts the mining and syncing of a node, its components are due from the next step
+        """
+        node.start()
+        for component in self._components(node):
+            self._schedule(node, component)
+
+    def stop_node(self, node):
+        node.stop()
+        for component in self._components(node):
+            self._due.pop(component, None)
+
+    @staticmethod
+    def _components(node):
+        # In the order of Node.step
+        return node.mempool_sync_thread, node.chain_sync_thread, node.mining_thread
+
+    def _schedule(self, node, component):
+        due = component.next_run() if component.flag else None
+        if due is None:
+            self._due.pop(component, None)
+            return
+        self._due[component] = due
+        if due > self.timer.time():
+            self.send_event(due - self.timer.time(), node.node_server_thread, node.enode, (WAKE,))
+
+    def wake(self, server):
+        self._woken[server] = None
+
+    def lost(self, origin):
+        return self.loss > 0 and origin.node.random.random() < self.loss
+
+    def step(self):
+        """
+        Advances the time by one step, delivers the messages arriving and steps the nodes woken
+        The nodes woken meanwhile are stepped at the next step
+        """
+        super().step()
+        woken, self._woken = self._woken, {}
+        for server in woken:
+            self.step_node(server.node)
+
+    def run(self, steps):
+        for _ in range(steps):
+            self.step()
+
+    def step_node(self, node):
+        """
+        Executes a time step for a node, as Node.step with only the components due
+        """
+        self.node_steps += 1
+        now = self.timer.time()
+        tip = node.chain[-1].hash
+
+        node.node_server_thread.process_answers()
+        node.message_handler.announcer.process()
+        node.message_handler.download.start()
+        # The chain merged from the answers may let the node produce a block now
+        if node.chain[-1].hash != tip:
+            self._schedule(node, node.mining_thread)
+
+        for component in self._components(node):
+            due = self._due.get(component)
+            if due is not None and due <= now:
+                component.run()
+                self._schedule(node, component)
+
+        node.message_handler.announcer.flush()
@@ -1,9 +1,245 @@
+import copy
+from collections.abc import MutableMapping
+from hashlib import shake_256
+
+from toychain.src.utils import metrics
+from toychain.src.utils.codec import encode
 from toychain.src.utils.helpers import compute_hash
 
 import logging
 logger = logging.getLogger('sc')
 
+# Number of layers after which a fork flattens the shared entries into a new base
+MAX_DEPTH = 32
+
+_MISSING = object()
+_DELETED = object()
+_IMMUTABLE_TYPES = (int, float, str, bool, bytes, tuple, type(None))
+
+# Number of 16 bits lanes of the hash of the entries of a StateMap (LtHash16, see StateMap)
+DIGEST_LANES = 1024
+# Masks of the even and odd lanes of a digest packed in an integer, and 2**16 above each lane
+_EVEN = int.from_bytes(b'\x00\x00\xff\xff' * (DIGEST_LANES // 2), 'big')
+_ODD = _EVEN << 16
+_BIAS = int.from_bytes(b'\x00\x01\x00\x00' * (DIGEST_LANES // 2), 'big')
+
+
+def entry_hash(key, value):
+    return int.from_bytes(shake_256(encode([key, value])).digest(2 * DIGEST_LANES), 'big')
+
+
+def _add(a, b):
+    # Lane by lane modulo 2**16: the carry of a lane falls in the next lane, masked out
+    return ((a & _EVEN) + (b & _EVEN)) & _EVEN | ((a & _ODD) + (b & _ODD)) & _ODD
+
+
+def _sub(a, b):
+    # 2**16 is added to each lane first, so that no lane borrows from the next one
+    return ((a & _EVEN) + _BIAS - (b & _EVEN)) & _EVEN | ((a & _ODD) + (_BIAS << 16) - (b & _ODD)) & _ODD
+
+
+class StateMap(MutableMapping):
+    """
+    Copy-on-write mapping holding a state variable of the contract (balances, all_hellos, ...)
+
+    The mapping is a stack of layers: a fork shares every layer of its parent and only
+    stores the keys written since, so the state of a new block costs O(keys touched) instead
+    of a deepcopy. Mutable values (lists, dicts, ...) found in a shared layer are copied into
+    the own layer the first time they are accessed with [], so they can be modified in place.
+
+    The content is committed by a homomorphic multiset hash, LtHash16 (Lewi et al., 2019): the hash
+    of an entry is a vector of DIGEST_LANES integers modulo 2**16 and the digest is the sum of the
+    hashes of the entries, in the group of such vectors, see digest(). Finding two sets of entries
+    with the same digest amounts to a short integer solution of a lattice problem. A sum of 256
+    bits hashes modulo 2**256 (or a 256 bits prime) would not do: the generalized birthday attack
+    of Wagner finds such sets with about 2**32 hashes. Shared layers are never modified, so their
+    digest and the hashes of their entries are cached and only the own layer is hashed again after
+    a change.
+    """
+    __slots__ = ('_layer', '_parent', '_depth', '_digest', '_hashes')
+
+    def __init__(self, data=None, parent=None):
+        self._layer = dict(data) if data else {}
+        self._parent = parent
+        self._depth = parent._depth + 1 if parent is not None else 0
+        self._digest = parent._digest if parent is not None else None
+        self._hashes = None
+
+    def _lookup(self, key):
+        node = self._parent
+        while node is not None:
+            value = node._layer.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            node = node._parent
+        return _MISSING
+
+    def __getitem__(self, key):
+        value = self._layer.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._lookup(key)
+            if value is _MISSING or value is _DELETED:
+                raise KeyError(key)
+            if not isinstance(value, _IMMUTABLE_TYPES):
+                # Copy on access: the shared value must never be modified
+                value = copy.deepcopy(value)
+                self._layer[key] = value
+                self._digest = None
+        elif value is _DELETED:
+            raise KeyError(key)
+        elif not isinstance(value, _IMMUTABLE_TYPES):
+            # The caller may modify the value in place
+            self._digest = None
+        return value
+
+    def __setitem__(self, key, value):
+        self._layer[key] = value
+        self._digest = None
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self._lookup(key) is _MISSING:
+            del self._layer[key]
+        else:
+            self._layer[key] = _DELETED
+        self._digest = None
+
+    def _entry_hash(self, key):
+        """
+        Returns the cached hash of an entry of a shared layer, 0 if the key is absent
+        """
+        node = self
+        while node is not None:
+            value = node._layer.get(key, _MISSING)
+            if value is not _MISSING:
+                if value is _DELETED:
+                    return 0
+                if node._hashes is None:
+                    node._hashes = {}
+                h = node._hashes.get(key)
+                if h is None:
+                    h = node._hashes[key] = entry_hash(key, value)
+                return h
+            node = node._parent
+        return 0
+
+    def digest(self):
+        """
+        Returns the hash of the content of the mapping, the lanes packed in an integer
+        Once computed, it is only updated with the entries changed in the own layer
+        """
+        if self._digest is None:
+            acc = 0
+            if self._parent is None:
+                for key, value in self._layer.items():
+                    if value is not _DELETED:
+                        acc = _add(acc, entry_hash(key, value))
+            else:
+                acc = self._parent.digest()
+                for key, value in self._layer.items():
+                    previous = self._parent._entry_hash(key)
+                    if previous:
+                        acc = _sub(acc, previous)
+                    if value is not _DELETED:
+                        acc = _add(acc, entry_hash(key, value))
+            self._digest = acc
+        return self._digest
+
+    def __contains__(self, key):
+        value = self._layer.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._lookup(key)
+        return value is not _MISSING and value is not _DELETED
+
+    def _flatten(self):
+        """
+        Returns a plain dict with the entries of all the layers, without copying the values
+        """
+        layers = []
+        node = self
+        while node is not None:
+            layers.append(node._layer)
+            node = node._parent
+        merged = {}
+        for layer in reversed(layers):
+            merged.update(layer)
+        return {k: v for k, v in merged.items() if v is not _DELETED}
+
+    def __iter__(self):
+        return iter(self._flatten())
+
+    def __len__(self):
+        return len(self._flatten())
+
+    # Read-only views, the values must not be modified through them
+    def items(self):
+        return self._flatten().items()
+
+    def values(self):
+        return self._flatten().values()
+
+    def fork(self):
+        """
+        Returns a copy of the mapping in O(1) (amortized), sharing all its current entries
+        Both mappings stay writable: the entries written so far are moved to a frozen layer
+        shared by the two of them
+        """
+        if self._depth >= MAX_DEPTH:
+            base = StateMap(self._flatten())
+            base._digest = self._digest
+        elif not self._layer and self._parent is not None:
+            return StateMap(parent=self._parent)
+        else:
+            base = StateMap.__new__(StateMap)
+            base._layer, base._parent, base._depth = self._layer, self._parent, self._depth
+            base._digest, base._hashes = self._digest, None
+
+        # The parent is replaced first so that concurrent readers never miss an entry
+        self._parent = base
+        self._layer = {}
+        self._depth = base._depth + 1
+        return StateMap(parent=base)
+
+    def __copy__(self):
+        return self.fork()
+
+    def __deepcopy__(self, memo):
+        return self.fork()
+
+    def __reduce__(self):
+        return StateMap, (self._flatten(),)
+
+    def __repr__(self):
+        return repr(self._flatten())
+
+
 class StateMixin:
+    def __setattr__(self, name, value):
+        # Mappings of the contract are stored as copy-on-write StateMaps
+        if type(value) is dict:
+            value = StateMap(value)
+        object.__setattr__(self, name, value)
+
+    def fork(self):
+        """
+        Returns a copy of the contract state to be modified by a new block
+        Every mapping shares its unchanged entries with this state
+        """
+        child = object.__new__(type(self))
+        for name, value in vars(self).items():
+            if name == 'msg' or name == 'block':
+                continue
+            if isinstance(value, StateMap):
+                value = value.fork()
+            elif not isinstance(value, _IMMUTABLE_TYPES):
+                value = copy.deepcopy(value)
+            object.__setattr__(child, name, value)
+        return child
+
+    def __deepcopy__(self, memo):
+        return self.fork()
+
     @property
     def getBalances(self):
         return self.balances
@@ -26,8 +262,76 @@ class StateMixin:
 
     @property
     def state_hash(self):
-        return compute_hash(self.state.values())
+        """
+        Hash of the state variables, the mappings contribute their incremental digest
+        so the cost is O(entries changed since the last call)
+        """
+        variables = []
+        for name, value in sorted(self.state.items()):
+            if isinstance(value, StateMap):
+                value = value.digest()
+            variables.append([name, value])
+        return compute_hash(variables)
     
+    @metrics.timed("toychain_apply_transactions_seconds")
+    def apply_transactions(self, txs, block):
+        """
+        Applies the transactions of a block in order, with the same result as apply_transaction on each one
+        Runs of plain transfers (no function in data) are applied in a batch by _apply_transfers
+        """
+        run = []
+        for tx in txs:
+            if tx.data and 'function' in tx.data and 'inputs' in tx.data:
+                if run:
+                    self._apply_transfers(run, block)
+                    run = []
+                self.apply_transaction(tx, block)
+            else:
+                run.append(tx)
+        if run:
+            self._apply_transfers(run, block)
+
+    def _apply_transfers(self, txs, block):
+        """
+        Applies transfers on a dense list of the balances of the addresses involved (address -> index),
+        written back to the balances mapping once at the end
+        """
+        balances = self.balances
+        ids = {}
+        current = []
+        accepted = 0
+        for tx in txs:
+            sender = ids.get(tx.sender)
+            if sender is None:
+                sender = ids[tx.sender] = len(current)
+                current.append(balances.get(tx.sender, 0))
+            receiver = ids.get(tx.receiver)
+            if receiver is None:
+                receiver = ids[tx.receiver] = len(current)
+                current.append(balances.get(tx.receiver, 0))
+
+            value = tx.value
+            if value and current[sender] < value:
+                logger.info("Insufficient Balance")
+                continue
+            current[sender] -= value
+            current[receiver] += value
+            accepted += 1
+
+        # Addresses are added in the order of their first use, as setdefault would
+        for address, i in ids.items():
+            if address not in balances:
+                balances[address] = current[i]
+            else:
+                previous = balances[address]
+                if current[i] != previous or type(current[i]) is not type(previous):
+                    balances[address] = current[i]
+
+        self.n += accepted
+        self.msg = txs[-1]
+        self.block = block
+
+    @metrics.timed("toychain_apply_transaction_seconds")
     def apply_transaction(self, tx, block):
         self.msg = tx
         self.block = block
@@ -1,12 +1,16 @@
+import sys
 from uuid import uuid4
 
 class Transaction:
-    def __init__(self, sender, receiver = 0, value = 0, data={}, timestamp=None, nonce=None, id=None):
-        self.source = str(sender)
-        self.sender = str(sender)
+    """
+    Compact transaction: no per-instance __dict__, and the addresses are interned so that every
+    transaction of a node from/to the same robot shares one string
+    """
+    __slots__ = ('sender', 'receiver', 'value', 'data', 'timestamp', 'nonce', 'id')
 
-        self.destination = str(receiver)
-        self.receiver    = str(receiver)
+    def __init__(self, sender, receiver = 0, value = 0, data={}, timestamp=None, nonce=None, id=None):
+        self.sender   = sys.intern(str(sender))
+        self.receiver = sys.intern(str(receiver))
 
         self.value = value
 
@@ -18,5 +22,39 @@ class Transaction:
         if not id:
             self.id = str(uuid4())
 
+    # Former duplicated attributes, kept as aliases
+    @property
+    def source(self):
+        return self.sender
+
+    @property
+    def destination(self):
+        return self.receiver
+
+    def to_dict(self):
+        return {"sender": self.sender, "receiver": self.receiver, "value": self.value, "data": self.data,
+                "timestamp": self.timestamp, "nonce": self.nonce, "id": self.id}
+
+    @classmethod
+    def from_dict(cls, _dict):
+        """
+        Builds a transaction from to_dict() output, or from the former vars() representation
+        which used the 'source' and 'destination' keys
+        """
+        sender = _dict["sender"] if "sender" in _dict else _dict["source"]
+        receiver = _dict["receiver"] if "receiver" in _dict else _dict["destination"]
+        return cls(sender, receiver, _dict["value"], _dict["data"], _dict["timestamp"], _dict["nonce"], _dict["id"])
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        # Also accepts the state of transactions pickled before __slots__ (a plain vars() dict)
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **(state[1] or {}))
+        other = Transaction.from_dict(state)
+        for slot in self.__slots__:
+            setattr(self, slot, getattr(other, slot))
+
     def __str__(self):
-        return f"hash: {self.id}, to: {self.receiver}, from: {self.sender}, value: {self.value}"
\ No newline at end of file
+        return f"hash: {self.id}, to: {self.receiver}, from: {self.sender}, value: {self.value}"
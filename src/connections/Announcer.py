@@ -0,0 +1,132 @@
+import queue
+from collections import OrderedDict
+
+from toychain.src.Mempool import short_id
+from toychain.src.utils import metrics
+from toychain.src.utils.constants import ANNOUNCE_TAG, MEMPOOL_GET_TAG, ANNOUNCE_MEMORY, ANNOUNCE_QUEUE
+
+import logging
+logger = logging.getLogger('w3')
+
+
+class Announcer:
+    """
+    Push announcements of the new blocks and transactions of a node to its peers
+
+    Once per step, the node announces its tip if it has changed (block produced or chain merged) and
+    the short ids of the transactions added to its mempool. A peer fetches what it lacks: the chain by
+    a download (see ChainDownload), the transactions from the mempool of the announcer. What a node
+    gains is announced again to its own peers, the ids already seen (last ANNOUNCE_MEMORY) are dropped,
+    so that every announcement is relayed once by each node. The chain and mempool pingers remain
+    as a slower fallback.
+
+    Announcements are received on the server threads and queued, they are handled by process on the
+    thread of the node. At most ANNOUNCE_QUEUE wait, the next ones are dropped: the chain and mempool
+    pingers catch up with what they held. An announcement is only accepted from the address of the
+    peer it names (see the sent_by method of the servers). The total difficulty announced is a claim
+    ranking the peers to download from, the headers received are checked by the consensus before
+    any block is merged.
+    """
+
+    def __init__(self, message_handler):
+        self.message_handler = message_handler
+        self.node = message_handler.node
+        self.node_server = message_handler.node_server
+
+        self.received = queue.Queue(ANNOUNCE_QUEUE)
+        # {block hash or short id: enode of the peer that announced it, None if it is local}
+        self.seen = OrderedDict()
+        self.announced_tip = None
+        self.transactions = []
+
+    def first_seen(self, key, enode=None):
+        """
+        Records an announced id, returns False if it was already seen
+        """
+        if key in self.seen:
+            return False
+        self.seen[key] = enode
+        if len(self.seen) > ANNOUNCE_MEMORY:
+            self.seen.popitem(last=False)
+        return True
+
+    def add_transactions(self, transactions):
+        """
+        Transactions to announce at the next flush
+        """
+        self.transactions.extend(short_id(transaction.id) for transaction in transactions)
+
+    def handle_request(self, msg, peer=None):
+        """
+        Queues an announcement received from the address peer, None if it was handed over in the process
+        """
+        enode = msg["sender"]
+        if peer is not None and not self.sent_by(enode, peer):
+            logger.warning(f"Node {self.node.id} received an announcement from {peer} in the name of {enode}")
+            if metrics.enabled:
+                metrics.inc("toychain_invalid_messages_total", kind="announcement")
+            return
+        try:
+            self.received.put_nowait((enode, msg["data"]))
+        except queue.Full:
+            if metrics.enabled:
+                metrics.inc("toychain_dropped_announcements_total")
+
+    def sent_by(self, enode, peer):
+        try:
+            return isinstance(enode, str) and self.node_server.sent_by(enode, peer)
+        except ValueError:
+            # Port of the enode out of range
+            return False
+
+    def process(self):
+        """
+        Handles the announcements received since the last call
+        """
+        while True:
+            try:
+                enode, (block, shorts) = self.received.get_nowait()
+            except queue.Empty:
+                return
+
+            if block is not None:
+                block_hash, height, total_difficulty = block
+                if self.first_seen(block_hash, enode) \
+                        and total_difficulty > self.node.get_block('last').total_difficulty:
+                    self.message_handler.download.add_source(enode, total_difficulty)
+
+            if shorts:
+                self.message_handler.known.add(enode, shorts)
+                missing = [short for short in shorts if self.first_seen(short, enode)
+                           and short not in self.node.mempool.short_ids]
+                if missing:
+                    request = self.message_handler.construct_message(missing, MEMPOOL_GET_TAG, enode)
+                    self.node_server.submit(enode, request)
+
+    def flush(self):
+        """
+        Announces the new tip and transactions to the peers that did not announce them
+        """
+        tip = self.node.get_block('last')
+        block = None
+        if self.announced_tip is None:
+            self.announced_tip = tip.hash
+        elif tip.hash != self.announced_tip:
+            self.announced_tip = tip.hash
+            self.first_seen(tip.hash)
+            block = [tip.hash, tip.height, tip.total_difficulty]
+
+        shorts = self.transactions
+        self.transactions = []
+        for short in shorts:
+            self.first_seen(short)
+        if block is None and not shorts:
+            return
+
+        for enode in list(self.node.peers):
+            peer_block = block if block is not None and self.seen.get(block[0]) != enode else None
+            peer_shorts = [short for short in shorts if self.seen.get(short) != enode]
+            if peer_block is None and not peer_shorts:
+                continue
+            request = self.message_handler.construct_message([peer_block, peer_shorts], ANNOUNCE_TAG, enode)
+            self.node_server.submit(enode, request)
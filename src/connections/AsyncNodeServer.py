@@ -0,0 +1,134 @@
+import asyncio
+import queue
+import threading
+
+from toychain.src.connections.ConnectionPool import ConnectionPool
+from toychain.src.connections.Framing import FRAME_HEADER, MessageAssembler, check_frame_size, message_frames
+from toychain.src.connections.MessageHandler import MessageHandler, message_type
+from toychain.src.connections.NodeServerThread import RequestMixin
+from toychain.src.utils import metrics
+from toychain.src.utils.codec import DecodeError
+from toychain.src.utils.constants import REQUEST_TIMEOUT
+
+
+class EventLoopThread(threading.Thread):
+    """
+    Thread running an asyncio event loop, it can serve the AsyncNodeServer of any number of nodes
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def call(self, coroutine, timeout=None):
+        """
+        Runs a coroutine in the loop and returns its result
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class AsyncNodeServer(RequestMixin):
+    """
+    Server answering to requests with asyncio, usable in place of the NodeServerThread of a node
+
+    Every connection is a task of the event loop, so one thread serves all the peers. The loop can be
+    shared by the servers of many nodes of the process (see EventLoopThread), otherwise the server
+    runs its own. Requests are dispatched to MessageHandler.handle_request as with NodeServerThread
+    and the same framing is used (see Framing.py). handle_request runs in the default executor of the
+    loop, so that a long request (a range of blocks to encode, a chain to search) does not hold the
+    connections of the other peers, and of the other nodes sharing the loop.
+    """
+
+    def __init__(self, node, host, port, id, event_loop=None):
+        self.id = id
+        self.node = node
+        self.host = host
+        self.port = port
+
+        self.message_handler = MessageHandler(self)
+        self.pool = ConnectionPool(REQUEST_TIMEOUT)
+        self.answers = queue.SimpleQueue()
+
+        self.event_loop = event_loop
+        self._own_loop = event_loop is None
+        self._server = None
+        self._writers = set()
+
+        print("Node " + str(self.id) + " starting on port " + str(self.port))
+
+    def start(self):
+        if self.event_loop is None:
+            self.event_loop = EventLoopThread()
+        if self._own_loop and not self.event_loop.is_alive():
+            self.event_loop.start()
+        self._server = self.event_loop.call(self._start_server())
+
+    async def _start_server(self):
+        return await asyncio.start_server(self.handle_connection, self.host, self.port, reuse_address=True)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Answers the requests received on a connection until the peer closes it
+        """
+        self._writers.add(writer)
+        assembler = MessageAssembler()
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                length, request_id, flags = FRAME_HEADER.unpack(header)
+                check_frame_size(length)
+                payload = await reader.readexactly(length)
+                complete, request = assembler.feed(request_id, flags, payload)
+                if not complete:
+                    continue
+
+                # Send the answer, other connections are served while it is built and drains
+                answer = await asyncio.get_running_loop().run_in_executor(None, self.message_handler.handle_request,
+                                                                          request, peer)
+                sent = 0
+                for data in message_frames(request_id, answer):
+                    writer.write(data)
+                    sent += len(data)
+                    await writer.drain()
+                if metrics.enabled:
+                    # Requests are sent in one frame
+                    label = message_type(request)
+                    metrics.observe("toychain_request_bytes", FRAME_HEADER.size + length, metrics.SIZE_BUCKETS,
+                                    type=label)
+                    metrics.observe("toychain_answer_bytes", sent, metrics.SIZE_BUCKETS, type=label)
+
+        except DecodeError as e:
+            print(f"Invalid request received by node {self.id}: {e}")
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _stop_server(self):
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self._server.wait_closed()
+
+    def stop(self):
+        if self._server is not None:
+            self.event_loop.call(self._stop_server())
+            self._server = None
+            print("Node " + str(self.id) + " stopped")
+        self.pool.close()
+        if self._own_loop and self.event_loop is not None:
+            self.event_loop.stop()
+            self.event_loop = None
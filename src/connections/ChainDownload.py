@@ -0,0 +1,306 @@
+from toychain.src.Block import BlockHeader
+from toychain.src.CompactBlock import CompactBlock
+from toychain.src.utils.constants import HEADERS_TAG, BLOCK_REQUEST_TAG, BLOCK_TXS_TAG, HEADERS_BATCH, \
+    BODY_RANGE, BODY_WINDOW, BODY_FAILURES, SYNC_REQUEST_TIMEOUT
+
+import logging
+logger = logging.getLogger('w3')
+
+
+class ChainDownload:
+    """
+    Headers-first download of the chain of a peer with more total difficulty
+
+    The common block is found with a block locator (see MessageHandler.locator), then the headers
+    from the common block to the tip of the peer are requested by batches of
+    HEADERS_BATCH, each one checked by the consensus against its parent. Meanwhile the blocks of the
+    headers received are requested by ranges of BODY_RANGE, at most BODY_WINDOW ranges in flight,
+    spread over the peers ahead of the local chain (sources). The compact blocks received must match their
+    headers. They are merged in order as soon as they outweigh the local chain. A source is dropped after
+    BODY_FAILURES failed requests in a row, the download is abandoned when no source is left.
+
+    The peers ahead found while no download is in progress are candidates: start, called once the
+    answers and announcements received are handled, downloads from the heaviest of them. While the
+    chain sync requests of the node are waiting for their answer (at most SYNC_REQUEST_TIMEOUT), the
+    candidates wait as well, so that the peers of a chain sync give a single download (and a single
+    locator) whatever the order of their answers.
+
+    Every answer is bounded by HEADERS_BATCH headers or BODY_RANGE blocks, whatever the gap.
+    All the methods run on the thread of the node (answers and pingers).
+    """
+
+    def __init__(self, message_handler):
+        self.message_handler = message_handler
+        self.node = message_handler.node
+        self.node_server = message_handler.node_server
+        # Peers ahead found since the last start {enode: total difficulty}
+        self.candidates = {}
+        self.reset()
+
+    def reset(self):
+        # Peer the headers are downloaded from, None if no download is in progress
+        self.header_source = None
+        self.headers_future = None
+        self.headers_complete = False
+        # Height of the common block, and headers of the blocks after it
+        self.fork_height = None
+        self.headers = []
+        # Transactions of the mempool and of the local blocks after the common block, by short id
+        self.lookup = None
+        # Peers the blocks are requested from {enode: total difficulty}, and their failed requests in a row
+        self.sources = {}
+        self.failures = {}
+        # Number of blocks merged in the chain
+        self.merged = 0
+        # Ranges of blocks by index of their first header in self.headers:
+        # requested {index: (enode, future)}, waiting for missing transactions {index: (future, compact blocks)},
+        # received
+        self.in_flight = {}
+        self.pending = {}
+        self.bodies = {}
+
+    @property
+    def active(self):
+        return self.header_source is not None
+
+    def add_source(self, enode, total_difficulty):
+        """
+        Adds a peer with more total difficulty to the candidates of the next download (see start), or
+        to the sources of the download in progress
+        """
+        if self.active and self.stalled():
+            logger.warning(f"Node {self.node.id} chain download from {self.header_source} stalled")
+            self.reset()
+
+        if not self.active:
+            self.candidates[enode] = total_difficulty
+        elif total_difficulty > self.node.get_block('last').total_difficulty:
+            # A peer on another chain is dropped at its first answer not matching the headers
+            self.sources[enode] = total_difficulty
+            self.request_bodies()
+
+    def start(self):
+        """
+        Starts a download from the heaviest candidate ahead of the local chain, the others are sources
+        """
+        if self.active:
+            self.candidates = {}
+            return
+        if any(not future.done() for future in self.node.chain_sync_thread.in_flight.values()):
+            return
+        candidates, self.candidates = self.candidates, {}
+        local = self.node.get_block('last').total_difficulty
+        candidates = {enode: difficulty for enode, difficulty in candidates.items() if difficulty > local}
+        if not candidates:
+            return
+        self.header_source = max(candidates, key=candidates.get)
+        self.sources.update(candidates)
+        self.request_headers(self.message_handler.locator())
+
+    def stalled(self):
+        """
+        Whether the headers request failed, or no source of the blocks is still a peer
+        """
+        if self.headers_future is not None and self.headers_future.done() and self.headers_future.exception() is not None:
+            return True
+        return not any(enode in self.node.peers for enode in self.sources)
+
+    def request_headers(self, locator):
+        request = self.message_handler.construct_message([locator, HEADERS_BATCH], HEADERS_TAG, self.header_source)
+        self.headers_future = self.node_server.submit(self.header_source, request, SYNC_REQUEST_TIMEOUT)
+
+    def handle_headers(self, enode, answer):
+        """
+        Checks and keeps the headers received, requests the next batch and the blocks
+        """
+        if enode != self.header_source:
+            return
+        height, headers = answer
+        if headers is None:
+            # No common block with the peer, or the last header received left its chain
+            self.reset()
+            return
+
+        count = len(headers)
+        headers = [BlockHeader(*fields) for fields in headers]
+        if not self.headers:
+            # The common block of the locator may be below the fork, the blocks the node has are skipped
+            skip = 0
+            while skip < count and self.node.get_block_hash(headers[skip].height) == headers[skip].hash:
+                skip += 1
+            if skip:
+                height = headers[skip - 1].height
+                headers = headers[skip:]
+            if not headers and count == HEADERS_BATCH:
+                self.request_headers([(self.node.get_block_hash(height), height)])
+                return
+
+            self.fork_height = height
+            parent = self.node.get_block(height)
+            if parent is None:
+                self.reset()
+                return
+            self.lookup = self.node.transaction_lookup(height)
+        else:
+            parent = self.headers[-1]
+
+        for header in headers:
+            if not self.node.consensus.verify_header(header, parent):
+                logger.warning(f"Node {self.node.id} received an invalid header from {enode}: {header.to_list()}")
+                self.reset()
+                return
+            self.headers.append(header)
+            parent = header
+
+        if count == HEADERS_BATCH:
+            self.request_headers([(parent.hash, parent.height)])
+        else:
+            self.headers_future = None
+            self.headers_complete = True
+            if not self.headers or self.headers[-1].total_difficulty <= self.node.get_block('last').total_difficulty:
+                # If the chains have equal difficulties, the node keeps its own
+                self.reset()
+                return
+        self.request_bodies()
+
+    def request_bodies(self):
+        """
+        Requests the next ranges of blocks, up to BODY_WINDOW in flight, the failed requests are sent again
+        """
+        for index, (enode, future) in list(self.in_flight.items()):
+            if future.done() and future.exception() is not None:
+                del self.in_flight[index]
+                self.failed(enode)
+        for index, (future, chain) in list(self.pending.items()):
+            if future.done() and future.exception() is not None:
+                del self.pending[index]
+
+        sources = [enode for enode in self.sources if enode in self.node.peers]
+        if not sources:
+            # No peer left to download the blocks from, the next peer ahead starts a new download
+            logger.warning(f"Node {self.node.id} chain download from {self.header_source} has no source left")
+            self.reset()
+            return
+
+        index = self.merged
+        while index < len(self.headers) and len(self.in_flight) < BODY_WINDOW:
+            end = min(index + BODY_RANGE, len(self.headers))
+            if end - index < BODY_RANGE and not self.headers_complete:
+                break
+            if index not in self.in_flight and index not in self.pending and index not in self.bodies:
+                enode = sources[index // BODY_RANGE % len(sources)]
+                header = self.headers[index]
+                request = self.message_handler.construct_message([header.height, header.hash, end - index],
+                                                                 BLOCK_REQUEST_TAG, enode)
+                self.in_flight[index] = (enode, self.node_server.submit(enode, request, SYNC_REQUEST_TIMEOUT))
+            index = end
+
+    def failed(self, enode):
+        """
+        Counts a failed block request of a source, and drops it after BODY_FAILURES in a row
+        """
+        self.failures[enode] = self.failures.get(enode, 0) + 1
+        if self.failures[enode] >= BODY_FAILURES:
+            logger.warning(f"Node {self.node.id} drops {enode} from the sources of its chain download")
+            self.sources.pop(enode, None)
+
+    def handle_bodies(self, enode, answer):
+        """
+        Checks the compact blocks received against their headers, and fills them from the mempool
+        """
+        height, chain = answer
+        if not self.active:
+            return
+        index = height - self.fork_height - 1
+        if self.in_flight.get(index, (None,))[0] != enode:
+            return
+        del self.in_flight[index]
+        self.failures.pop(enode, None)
+
+        if chain is not None:
+            try:
+                chain = [CompactBlock.from_list(compact) for compact in chain]
+            except ValueError as e:
+                logger.warning(f"Node {self.node.id} received malformed blocks from {enode}: {e}")
+                chain = None
+        if chain is not None:
+            headers = self.headers[index:index + BODY_RANGE]
+            if len(chain) != len(headers) or any(compact.hash != header.hash for compact, header in zip(chain, headers)):
+                chain = None
+        if chain is None:
+            # The peer no longer has these blocks
+            self.sources.pop(enode, None)
+            if enode == self.header_source:
+                self.reset()
+                return
+            self.request_bodies()
+            return
+
+        missing = [[compact.height, compact.hash, compact.fill(self.lookup)] for compact in chain]
+        missing = [entry for entry in missing if entry[2]]
+        if missing:
+            request = self.message_handler.construct_message(missing, BLOCK_TXS_TAG, enode)
+            self.pending[index] = (self.node_server.submit(enode, request, SYNC_REQUEST_TIMEOUT), chain)
+            return
+
+        self.bodies[index] = chain
+        self.merge()
+
+    def handle_block_transactions(self, enode, answer):
+        """
+        Fills the compact blocks waiting for missing transactions with the transactions received
+        """
+        if not answer:
+            return
+        for index, (future, chain) in self.pending.items():
+            if any(compact.hash == answer[0][0] for compact in chain):
+                break
+        else:
+            return
+        del self.pending[index]
+
+        compacts = {compact.hash: compact for compact in chain}
+        for block_hash, transactions in answer:
+            compact = compacts.get(block_hash)
+            missing = [] if compact is None else [i for i, transaction in enumerate(compact.data) if transaction is None]
+            if transactions is None or len(missing) != len(transactions):
+                # The range is requested again
+                self.request_bodies()
+                return
+            for i, transaction in zip(missing, transactions):
+                compact.data[i] = transaction
+
+        self.bodies[index] = chain
+        self.merge()
+
+    def merge(self):
+        """
+        Merges the blocks received that follow the merged ones, once they outweigh the local chain
+        """
+        chain = []
+        index = self.merged
+        while index in self.bodies:
+            chain += self.bodies[index]
+            index += len(self.bodies[index])
+
+        if chain and self.headers_complete and index == len(self.headers) and self.merged == 0 \
+                and chain[-1].total_difficulty <= self.node.get_block('last').total_difficulty:
+            # The local chain has grown meanwhile, the node keeps its own
+            self.reset()
+            return
+
+        if chain and chain[-1].total_difficulty > self.node.get_block('last').total_difficulty:
+            for index in range(self.merged, index, BODY_RANGE):
+                del self.bodies[index]
+            self.node.sync_chain(chain, self.fork_height + self.merged)
+            if self.node.get_block('last').hash != chain[-1].hash:
+                logger.warning(f"Node {self.node.id} could not merge the blocks downloaded from {self.header_source}")
+                self.reset()
+                return
+            self.merged += len(chain)
+
+        if self.headers_complete and self.merged == len(self.headers):
+            logger.info(f"Node {self.node.id} downloaded {self.merged} blocks from {len(self.sources)} peers")
+            self.reset()
+        else:
+            self.request_bodies()
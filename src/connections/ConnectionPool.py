@@ -0,0 +1,216 @@
+import itertools
+import socket
+import struct
+import threading
+import time
+
+from toychain.src.connections.Framing import FrameReader, MessageAssembler, send_message
+from toychain.src.utils.codec import DecodeError
+
+import logging
+logger = logging.getLogger('w3')
+
+class Connection:
+    """
+    Long-lived connection to a peer, shared by the threads sending it requests
+
+    Every request is tagged with an id and the peer answers with the same id (see Framing.py).
+    A reader thread reads the socket and hands the answers to the threads waiting for them. The
+    deadline of a request only concerns its own thread: the answers arriving after it are dropped,
+    and the connection is only closed on an error of the socket (or a send blocked for timeout). A
+    malformed answer closes it too: the reader stops, the requests waiting fail, and on_close(connection)
+    is called.
+    """
+
+    def __init__(self, address, timeout, on_close=None):
+        """
+        timeout bounds the connection and every send, the requests have their own
+        """
+        self.address = address
+        self.on_close = on_close
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # The reader waits for the answers without timeout, a peer that stops reading still fails the sends
+        self.sock.settimeout(None)
+        seconds = int(timeout)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                             struct.pack('ll', seconds, int((timeout - seconds) * 1e6)))
+
+        self.closed = False
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._reader = FrameReader(self.sock)
+        self._assembler = MessageAssembler()
+        # {request id: [answer]}, empty while waiting
+        self._pending = {}
+        self._error = None
+
+        self._thread = threading.Thread(target=self._read, name=f"connection-{address[1]}", daemon=True)
+        self._thread.start()
+
+    def request(self, message, timeout):
+        """
+        Sends a request and waits for its answer
+        Raises socket.timeout if it does not arrive in time, or an OSError if the connection fails,
+        it must then be discarded
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if self.closed:
+                raise self._closed_error()
+            request_id = next(self._ids)
+            self._pending[request_id] = []
+        try:
+            try:
+                with self._send_lock:
+                    send_message(self.sock, request_id, message)
+            except OSError:
+                # Part of a frame may have been sent, the stream is unusable
+                self.close()
+                raise
+            return self._wait_answer(request_id, deadline)
+        finally:
+            with self._condition:
+                self._pending.pop(request_id, None)
+
+    def _wait_answer(self, request_id, deadline):
+        with self._condition:
+            while not self._pending[request_id]:
+                if self.closed:
+                    raise self._closed_error()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout(f"No answer from {self.address}")
+                self._condition.wait(remaining)
+            return self._pending[request_id][0]
+
+    def _read(self):
+        """
+        Reads the answers until the connection is closed
+        """
+        try:
+            while True:
+                frame = self._reader.read_frame()
+                if frame is None:
+                    raise ConnectionResetError(f"Connection to {self.address} closed by the peer")
+                answer_id, flags, payload = frame
+
+                # Answers of requests that gave up waiting are dropped
+                with self._condition:
+                    waiting = answer_id in self._pending
+                if not waiting:
+                    self._assembler.discard(answer_id)
+                    continue
+                complete, answer = self._assembler.feed(answer_id, flags, payload)
+                if not complete:
+                    continue
+
+                with self._condition:
+                    if answer_id in self._pending:
+                        self._pending[answer_id].append(answer)
+                        self._condition.notify_all()
+        except Exception as e:
+            # Failure of the socket, or an answer that cannot be decoded: the stream is unusable
+            if not self.closed:
+                if isinstance(e, (OSError, DecodeError)):
+                    logger.debug(f"Connection to {self.address} failed: {e!r}")
+                else:
+                    logger.warning(f"Malformed answer from {self.address}: {e!r}")
+            self._error = e
+        finally:
+            self.close()
+            if self.on_close is not None:
+                self.on_close(self)
+
+    def _closed_error(self):
+        error = ConnectionResetError(f"Connection to {self.address} is closed")
+        error.__cause__ = self._error
+        return error
+
+    def close(self):
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            self._condition.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class ConnectionPool:
+    """
+    One persistent Connection per peer address, opened on the first request and reopened after a failure
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def request(self, address, message, timeout=None):
+        """
+        Sends a request to the peer and returns its answer
+        A request failing on a reused connection (peer restarted, idle connection dropped) is sent
+        again once on a new connection
+        """
+        timeout = self.timeout if timeout is None else timeout
+        connection, reused = self._get(address)
+        try:
+            return connection.request(message, timeout)
+        except socket.timeout:
+            # Only this request gave up, the other requests of the connection go on
+            if connection.closed:
+                self._discard(address, connection)
+            raise
+        except OSError:
+            self._discard(address, connection)
+            if not reused:
+                raise
+        logger.debug(f"Reconnecting to {address}")
+        connection, _ = self._get(address)
+        try:
+            return connection.request(message, timeout)
+        except OSError:
+            self._discard(address, connection)
+            raise
+
+    def _get(self, address):
+        with self._lock:
+            connection = self._connections.get(address)
+            if connection is not None and not connection.closed:
+                return connection, True
+        connection = Connection(address, self.timeout, lambda closed: self._evict(address, closed))
+        with self._lock:
+            # Another thread may have connected meanwhile
+            existing = self._connections.get(address)
+            if existing is not None and not existing.closed:
+                connection.close()
+                return existing, True
+            self._connections[address] = connection
+        return connection, False
+
+    def _discard(self, address, connection):
+        connection.close()
+        self._evict(address, connection)
+
+    def _evict(self, address, connection):
+        with self._lock:
+            if self._connections.get(address) is connection:
+                del self._connections[address]
+
+    def close(self, address=None):
+        """
+        Closes the connection to one peer, or all of them
+        """
+        with self._lock:
+            if address is None:
+                connections = list(self._connections.values())
+                self._connections.clear()
+            else:
+                connections = [self._connections.pop(address)] if address in self._connections else []
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,273 @@
+import heapq
+import itertools
+import queue
+import random
+import socket
+
+from toychain.src.connections.MessageHandler import MessageHandler
+from toychain.src.connections.NodeServerThread import RequestMixin
+from toychain.src.utils.codec import Stream
+from toychain.src.utils.constants import REQUEST_TIMEOUT
+from toychain.src.utils.helpers import CustomTimer
+
+import logging
+logger = logging.getLogger('w3')
+
+# Kinds of the events of a LoopbackNetwork
+REQUEST = 0
+ANSWER = 1
+EXPIRE = 2
+WAKE = 3
+
+
+def _resolve(message):
+    """
+    Reads the Streams of a message (see MessageHandler.handle_block_request), they are only found at
+    the top level of its data
+    """
+    if message is not None and isinstance(message.get("data"), (list, tuple)):
+        data = message["data"]
+        if any(isinstance(item, Stream) for item in data):
+            message = dict(message, data=[list(item) if isinstance(item, Stream) else item for item in data])
+    return message
+
+
+class LoopbackFuture:
+    """
+    Answer of a request on a LoopbackNetwork, with the methods of concurrent.futures.Future the
+    nodes use. Only the thread stepping the network sets it, so it needs no lock.
+    """
+    __slots__ = ('_done', '_result', '_exception')
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        return self._exception
+
+    def set_result(self, result):
+        self._result = result
+        self._done = True
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done = True
+
+
+class LoopbackNetwork:
+    """
+    Network between the nodes of one process, messages are handed from node to node in memory
+
+    There are no sockets, threads or encoding: a request is passed to the MessageHandler of the
+    receiver and its answer back to the sender. Time counts the calls to step: a request is handled
+    latency steps after it is sent and its answer handled latency steps later by the sender, or right
+    away if latency is 0. Each way, a message is lost with probability loss, drawn from a generator
+    seeded with seed, so that a simulation stepped in the same order is repeated exactly. A request
+    without answer fails after its timeout, counted in steps as well.
+
+    Messages and timeouts are events for a node (enode), numbered by the node they come from. Events
+    due at the same step are handled in the order of (enode of origin, number), whatever the order
+    in which the nodes were stepped, so that the nodes can be split over processes (see ShardedSimulator).
+    """
+
+    def __init__(self, latency=0, loss=0, seed=0):
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.timer = CustomTimer()
+
+        # {enode: LoopbackServer}
+        self.servers = {}
+        # Requests waiting for their answer {(enode of the sender, number): (server of the sender, enode, future,
+        # whether the answer is queued for process_answers)}
+        self._pending = {}
+        # Events to come (time, enode of origin, number, enode of the node it is for, event)
+        self._events = []
+
+    def step(self):
+        """
+        Advances the time by one step and delivers the messages arriving
+        To call once per round of Node.step of the nodes
+        """
+        self.timer.step()
+        now = self.timer.time()
+        while self._events and self._events[0][0] <= now:
+            _, _, _, enode, event = heapq.heappop(self._events)
+            self.handle_event(enode, event)
+
+    def send_event(self, delay, origin, enode, event):
+        """
+        Schedules an event from the server origin for the node enode delay steps from now, or handles
+        it right away if delay is 0
+        """
+        if delay <= 0:
+            self.handle_event(enode, event)
+        else:
+            heapq.heappush(self._events, (self.timer.time() + delay, origin.node.enode, next(origin.events), enode, event))
+
+    def handle_event(self, enode, event):
+        kind = event[0]
+        if kind == REQUEST:
+            self._deliver(enode, event[1], event[2])
+        elif kind == ANSWER:
+            self._answer(event[1], event[2])
+        elif kind == EXPIRE:
+            self._expire(event[1])
+        elif kind == WAKE:
+            server = self.servers.get(enode)
+            if server is not None:
+                self.wake(server)
+
+    def lost(self, origin):
+        """
+        Whether a message sent by the server origin is lost
+        """
+        return self.loss > 0 and self.random.random() < self.loss
+
+    def listening(self, enode):
+        return enode in self.servers
+
+    def wake(self, server):
+        """
+        Called when a node has received something to handle. The nodes of a LoopbackNetwork are all
+        stepped anyway, see Simulator
+        """
+
+    def request(self, sender, enode, message, timeout=None):
+        """
+        Sends a request from the server sender and steps the network until its answer, for the blocking
+        send_request. The request and its answer have the latency and losses of the others, and the
+        request fails after its timeout. On a Simulator, the nodes woken meanwhile are stepped as well,
+        so it must not be called while the network is stepped.
+        :return: the answer
+        """
+        future = self._send(sender, enode, message, timeout, queued=False)
+        while not future.done():
+            self.step()
+        return future.result()
+
+    def submit(self, sender, enode, message, timeout=None):
+        """
+        Sends a request from the server sender to the node enode, its answer is queued in the answers
+        of the sender
+        :return: LoopbackFuture of the answer
+        """
+        return self._send(sender, enode, message, timeout, queued=True)
+
+    def _send(self, sender, enode, message, timeout, queued):
+        future = LoopbackFuture()
+        if not self.listening(enode):
+            future.set_exception(ConnectionRefusedError(f"No node listening at {enode}"))
+            if queued:
+                sender.answers.put((enode, future))
+                self.wake(sender)
+            return future
+
+        request_id = (sender.node.enode, next(sender.requests))
+        self._pending[request_id] = (sender, enode, future, queued)
+        if not self.lost(sender):
+            self.send_event(self.latency, sender, enode, (REQUEST, request_id, message))
+        if not future.done():
+            self.send_event(REQUEST_TIMEOUT if timeout is None else timeout, sender, sender.node.enode,
+                            (EXPIRE, request_id))
+        return future
+
+    def _deliver(self, enode, request_id, message):
+        server = self.servers.get(enode)
+        if server is None:
+            return
+        answer = _resolve(server.message_handler.handle_request(message, request_id[0]))
+        self.wake(server)
+        if not self.lost(server):
+            self.send_event(self.latency, server, request_id[0], (ANSWER, request_id, answer))
+
+    def _answer(self, request_id, answer):
+        pending = self._pending.pop(request_id, None)
+        if pending is not None:
+            sender, enode, future, queued = pending
+            future.set_result(answer)
+            if queued:
+                sender.answers.put((enode, future))
+                self.wake(sender)
+
+    def _expire(self, request_id):
+        pending = self._pending.pop(request_id, None)
+        if pending is not None:
+            sender, enode, future, queued = pending
+            future.set_exception(socket.timeout(f"No answer from {enode}"))
+            if queued:
+                sender.answers.put((enode, future))
+                self.wake(sender)
+
+    def close(self, enode=None):
+        # There are no connections to close
+        pass
+
+
+class LoopbackServer(RequestMixin):
+    """
+    Server of a node on a LoopbackNetwork, usable in place of the NodeServerThread of a node
+
+    Requests are handled by the MessageHandler of the receiver on the thread stepping the network,
+    the answers are handed to the sender by process_answers as with the other servers. Nodes are
+    addressed by their enode.
+    """
+
+    def __init__(self, node, host, port, id, network):
+        self.id = id
+        self.node = node
+        self.host = host
+        self.port = port
+
+        self.message_handler = MessageHandler(self)
+        self.network = network
+        self.pool = network
+        self.answers = queue.SimpleQueue()
+        # Numbers of the requests and events sent by the node
+        self.requests = itertools.count()
+        self.events = itertools.count()
+
+        print("Node " + str(self.id) + " starting on port " + str(self.port))
+
+    def start(self):
+        self.network.servers[self.node.enode] = self
+
+    def stop(self):
+        if self.network.servers.get(self.node.enode) is self:
+            del self.network.servers[self.node.enode]
+            print("Node " + str(self.id) + " stopped")
+
+    def send_request(self, enode, request):
+        """
+        Sends a request through the network and handles the answer, the network is stepped meanwhile
+        """
+        self.message_handler.handle_answer(self.network.request(self, enode, request))
+
+    def submit(self, enode, request, timeout=None):
+        """
+        Sends a request through the network, its answer is handled by a later process_answers call
+        :return: Future of the answer
+        """
+        return self.network.submit(self, enode, request, timeout)
+
+    def wake(self):
+        self.network.wake(self)
+
+    @staticmethod
+    def _address(enode):
+        return enode
+
+    @staticmethod
+    def sent_by(enode, peer):
+        # Requests are delivered with the enode of their sender
+        return enode == peer
@@ -1,22 +1,73 @@
-from toychain.src.utils import constants
-from toychain.src.utils.constants import MEMPOOL_SYNC_TAG, CHAIN_SYNC_TAG, BLOCK_REQUEST_TAG, DEBUG
-from toychain.src.utils.helpers import dict_to_transaction, transaction_to_dict, block_to_list
+from itertools import islice
+
+from toychain.src.Block import header_to_list
+from toychain.src.CompactBlock import CompactBlock
+from toychain.src.connections.Announcer import Announcer
+from toychain.src.connections.ChainDownload import ChainDownload
+from toychain.src.Mempool import SKETCH_GROWTH, KnownInventory, short_id
+from toychain.src.utils import constants, metrics
+from toychain.src.utils.codec import Stream
+from toychain.src.utils.constants import MEMPOOL_SYNC_TAG, CHAIN_SYNC_TAG, BLOCK_REQUEST_TAG, MEMPOOL_GET_TAG, \
+    BLOCK_TXS_TAG, HEADERS_TAG, ANNOUNCE_TAG, HEADERS_BATCH, BODY_RANGE, LOCATOR_DENSE, DEBUG
 
 import logging
 logger = logging.getLogger('w3')
 
+
+MESSAGE_TYPES = frozenset([MEMPOOL_SYNC_TAG, CHAIN_SYNC_TAG, BLOCK_REQUEST_TAG, MEMPOOL_GET_TAG, BLOCK_TXS_TAG,
+                           HEADERS_TAG, ANNOUNCE_TAG])
+
+
+def message_type(message):
+    """
+    Type of a message as labelled in the metrics, "unknown" for anything but the known types, so
+    that peers cannot add series
+    """
+    kind = message.get("type") if isinstance(message, dict) else None
+    return kind if isinstance(kind, str) and kind in MESSAGE_TYPES else "unknown"
+
+
+def _message_type(handler, message, peer=None):
+    # Labels of the metrics of a message
+    return {"type": message_type(message)}
+
+
+def _sequence(value, length=None):
+    return isinstance(value, (list, tuple)) and (length is None or len(value) == length)
+
+
+def _count(value):
+    # Height, index or number of items
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def _short_ids(value):
+    return _sequence(value) and all(isinstance(short, int) for short in value)
+
+
 class MessageHandler:
     def __init__(self, node_server):
         self.node_server = node_server
         self.node = node_server.node
         self.enode = self.node.enode
 
-    def handle_request(self, msg):
+        # Transactions held by each peer, left out of the blocks relayed to it
+        self.known = KnownInventory()
+        # Headers-first download of the chains of the peers ahead
+        self.download = ChainDownload(self)
+        # Announcements of new blocks and transactions, sent and received
+        self.announcer = Announcer(self)
+
+    @metrics.timed("toychain_request_seconds", _message_type)
+    def handle_request(self, msg, peer=None):
         """
         Returns a message containing the requested information
+        :param peer: address of the connection the request came from, as given by the server
         """
-        if not self.check_message_validity(msg):
+        if not self.check_message_validity(msg) or not self.check_request_data(msg["type"], msg["data"]):
             logger.error("invalid message")
+            if metrics.enabled:
+                metrics.inc("toychain_invalid_messages_total", kind="request")
             return
 
         if DEBUG:
@@ -25,24 +76,47 @@ class MessageHandler:
         msg_type = msg["type"]
 
         if msg_type == MEMPOOL_SYNC_TAG:
-            transaction_list = list(self.node.mempool.values())
-            content = []
-            for t in transaction_list:
-                content.append(transaction_to_dict(t))
+            # Sketch or inventory of the short ids, only if the digests of the mempools differ
+            digest, size = msg["data"]
+            content = None
+            if digest != self.node.mempool.digest:
+                content = self.node.mempool.reconcile(size)
+            else:
+                self.known.add(msg["sender"], list(self.node.mempool.short_ids))
             return self.construct_message(content, MEMPOOL_SYNC_TAG)
 
+        elif msg_type == MEMPOOL_GET_TAG:
+            content = self.node.mempool.get_short(msg["data"])
+            self.known.add(msg["sender"], msg["data"])
+            return self.construct_message(content, MEMPOOL_GET_TAG)
+
         elif msg_type == CHAIN_SYNC_TAG:
             last_block = self.node.get_block('last')
             content = (last_block.get_header_hash(), last_block.total_difficulty)
             return self.construct_message(content, CHAIN_SYNC_TAG)
 
+        elif msg_type == ANNOUNCE_TAG:
+            self.announcer.handle_request(msg, peer)
+            return self.construct_message(None, ANNOUNCE_TAG)
+
+        elif msg_type == HEADERS_TAG:
+            content = self.handle_headers_request(msg["data"])
+            return self.construct_message(content, HEADERS_TAG)
+
         elif msg_type == BLOCK_REQUEST_TAG:
-            content = self.handle_block_request(msg["data"])
+            content = self.handle_block_request(msg["data"], msg["sender"])
             return self.construct_message(content, BLOCK_REQUEST_TAG)
 
+        elif msg_type == BLOCK_TXS_TAG:
+            content = self.handle_block_transactions_request(msg["data"])
+            return self.construct_message(content, BLOCK_TXS_TAG)
+
+    @metrics.timed("toychain_answer_seconds", _message_type)
     def handle_answer(self, msg):
         if not self.check_message_validity(msg):
             logger.error("invalid message")
+            if metrics.enabled:
+                metrics.inc("toychain_invalid_messages_total", kind="answer")
             return
 
         if DEBUG:
@@ -53,10 +127,20 @@ class MessageHandler:
             self.handle_chain_sync_answer(msg)
 
         elif msg_type == MEMPOOL_SYNC_TAG:
+            self.handle_mempool_inventory(msg)
+
+        elif msg_type == MEMPOOL_GET_TAG:
+            self.known.add(msg["sender"], [short_id(transaction.id) for transaction in msg["data"]])
             self.update_mempool(msg["data"])
 
+        elif msg_type == HEADERS_TAG:
+            self.download.handle_headers(msg["sender"], msg["data"])
+
         elif msg_type == BLOCK_REQUEST_TAG:
-            self.handle_block_answer(msg)
+            self.download.handle_bodies(msg["sender"], msg["data"])
+
+        elif msg_type == BLOCK_TXS_TAG:
+            self.download.handle_block_transactions(msg["sender"], msg["data"])
 
     def check_message_validity(self, message):
         mandatory_keys = ["data", "type", "receiver", "sender"]
@@ -69,15 +153,64 @@ class MessageHandler:
         logger.error(f"Invalid message {message}")
         return False
 
+    @staticmethod
+    def check_request_data(msg_type, data):
+        """
+        Whether the data of a request has the shape its handler expects, heights and indexes are not negative
+        """
+        if msg_type == MEMPOOL_SYNC_TAG:
+            return _sequence(data, 2) and isinstance(data[0], int) and (data[1] is None or _count(data[1]))
+        if msg_type == MEMPOOL_GET_TAG:
+            return _short_ids(data)
+        if msg_type == ANNOUNCE_TAG:
+            if not _sequence(data, 2):
+                return False
+            block, shorts = data
+            if block is not None and not (_sequence(block, 3) and isinstance(block[0], str) and _count(block[1])
+                                          and _count(block[2])):
+                return False
+            return not shorts or _short_ids(shorts)
+        if msg_type == HEADERS_TAG:
+            return _sequence(data, 2) and _sequence(data[0]) and _count(data[1]) \
+                and all(_sequence(entry, 2) and _count(entry[1]) for entry in data[0])
+        if msg_type == BLOCK_REQUEST_TAG:
+            return _sequence(data, 3) and _count(data[0]) and _count(data[2])
+        if msg_type == BLOCK_TXS_TAG:
+            return _sequence(data) and all(_sequence(entry, 3) and _count(entry[0]) and _sequence(entry[2])
+                                           and all(_count(index) for index in entry[2]) for entry in data)
+        return True
+
     def construct_message(self, data, msg_type, receiver=None):
         message = {"type": msg_type, "receiver": receiver, "sender": self.enode, "data": data}
         return message
 
     def update_mempool(self, transactions):
-        _list = []
-        for d in transactions:
-            _list.append(dict_to_transaction(d))
-        self.node.sync_mempool(_list)
+        self.node.sync_mempool(transactions)
+
+    def handle_mempool_inventory(self, message):
+        """
+        Requests the transactions of the peer sketch or inventory missing from the mempool
+        """
+        if message["data"] is None:
+            # Mempools are synchronised
+            return
+        kind, content = message["data"]
+        if kind == "sketch":
+            missing = self.node.mempool.missing_from_sketch(content)
+            if missing is not None:
+                self.known.add(message["sender"], missing)
+            else:
+                # Too many differences for this sketch, a larger one is requested
+                size = len(content) // 3 * SKETCH_GROWTH
+                request = self.construct_message([self.node.mempool.digest, size], MEMPOOL_SYNC_TAG, message["sender"])
+                self.node_server.submit(message["sender"], request)
+                return
+        else:
+            self.known.add(message["sender"], content)
+            missing = self.node.mempool.missing(content)
+        if missing:
+            request = self.construct_message(missing, MEMPOOL_GET_TAG, message["sender"])
+            self.node_server.submit(message["sender"], request)
 
     def handle_chain_sync_answer(self, message):
         last_block = self.node.get_block('last')
@@ -90,52 +223,92 @@ class MessageHandler:
         if last_block.total_difficulty <= message["data"][1]:
             # If the chains have equal sizes, node keeps his
             # If the chain of the node is longer than the received one, let him do the work
-            self.request_block(len(self.node.chain), message["sender"])
+            self.download.add_source(message["sender"], message["data"][1])
         else:
             if constants.DEBUG:
                 logger.debug(f"Node {self.node.id} has a current diff of {last_block.total_difficulty}")
 
-    def request_block(self, current_height, enode):
+    def locator(self):
         """
-        Sends the last 5 blocks header hash
+        Hash and height of blocks of the chain to find the common block with a peer: the last
+        LOCATOR_DENSE blocks, then every 2, 4, 8... blocks below them, down to the genesis block
         """
-        content = []
-        # Sends the block header + height of the last 5 blocks before the precised height
-        for block in reversed(self.node.chain[max(0, current_height - 5):current_height]):
-            content.append((block.get_header_hash(), block.height))
-
-        request = self.construct_message(content, BLOCK_REQUEST_TAG, enode)
-        self.node_server.send_request(enode, request)
-
-    def handle_block_request(self, block_info_list):
-        """
-        Checks if one of the indicated blocks is in its chain
-        """
-        for block_info in block_info_list:
-            block_header_hash = block_info[0]
-            height = block_info[1]
-            potential_common_block = self.node.get_block(height)
-            if potential_common_block is None:
-                return None, None
-            if block_header_hash == potential_common_block.get_header_hash():
-                # Common block found
-                partial_chain = []
-                i = height + 1
-                while i < len(self.node.chain):
-                    partial_chain.append(block_to_list(self.node.get_block(i)))
-                    i += 1
-                return height, partial_chain
-        return height, None
-
-    def handle_block_answer(self, msg):
-        data = msg["data"]
-        height = data[0]
-        chain = data[1]
-
-        if height is None:
-            return
+        locator = []
+        height = self.node.get_block_number()
+        step = 1
+        while height > 0:
+            locator.append((self.node.get_block_hash(height), height))
+            if len(locator) >= LOCATOR_DENSE:
+                step *= 2
+            height -= step
+        locator.append((self.node.get_block_hash(0), 0))
+        return locator
+
+    def common_block(self, locator):
+        """
+        Finds the highest block of the locator that is in the chain
+        :return: (its height, True), (None, False) if none is in the chain
+        """
+        for block_hash, height in locator:
+            if self.node.get_block_hash(height) == block_hash:
+                return height, True
+        return None, False
+
+    def handle_headers_request(self, data):
+        """
+        Headers of at most HEADERS_BATCH blocks following the common block of the locator
+        """
+        locator, count = data
+        height, found = self.common_block(locator)
+        if not found:
+            return None, None
+        headers = [header_to_list(block) for block in islice(self.iter_blocks(height + 1), min(count, HEADERS_BATCH))]
+        return height, headers
+
+    def handle_block_request(self, data, enode):
+        """
+        Streams a range of blocks as compact blocks, given the height and hash of its first block
+        and the number of blocks. None instead of the blocks if the first one is not in the chain
+        """
+        height, block_hash, count = data
+        block = self.node.get_block(height)
+        if block is None or block.hash != block_hash:
+            return height, None
+        return height, Stream(islice(self.iter_compact_blocks(height, enode), min(count, BODY_RANGE)))
+
+    def iter_blocks(self, height):
+        """
+        Yields the blocks from the given height to the end of the chain, read as they are sent
+        Stops if the chain is reorganised meanwhile, so that the blocks sent always link up
+        """
+        previous = self.node.get_block(height - 1)
+        while previous is not None:
+            block = self.node.get_block(height)
+            if block is None or block.parent_hash != previous.hash:
+                return
+            yield block
+            previous = block
+            height += 1
 
-        if chain is None:
-            self.request_block(height, msg["sender"])
-        elif len(chain) > 0:
-            self.node.sync_chain(chain, height)
+    def iter_compact_blocks(self, height, enode):
+        """
+        Yields the blocks from the given height as compact blocks for a peer, without the transactions it holds
+        """
+        for block in self.iter_blocks(height):
+            compact = CompactBlock.from_block(block, self.known.peer(enode))
+            self.known.add(enode, compact.short_ids)
+            yield compact.to_list()
+
+    def handle_block_transactions_request(self, requested):
+        """
+        Transactions of blocks of the chain [[block hash, transactions], ...], given [[height, block hash,
+        indexes of the transactions], ...]. None instead of the transactions of a block no longer in the chain
+        """
+        content = []
+        for height, block_hash, indexes in requested:
+            block = self.node.get_block(height)
+            if block is None or block.hash != block_hash or any(index >= len(block.data) for index in indexes):
+                content.append([block_hash, None])
+            else:
+                content.append([block_hash, [block.data[index] for index in indexes]])
+        return content
@@ -1,100 +1,125 @@
-import pickle
 import threading
 
+import queue
 import socket
 import time
 import urllib.parse
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 
-from toychain.src.connections.MessageHandler import MessageHandler
+from toychain.src.connections.ConnectionPool import ConnectionPool
+from toychain.src.connections.Framing import FRAME_HEADER, FrameReader, MessageAssembler, send_message
+from toychain.src.connections.MessageHandler import MessageHandler, message_type
+from toychain.src.connections.ReliableUDP import ReliableUDP
+from toychain.src.utils import metrics
+from toychain.src.utils.codec import DecodeError
+from toychain.src.utils.constants import REQUEST_TIMEOUT, REQUEST_WORKERS
 
-class NodeServerThreadUDP(threading.Thread):
+import logging
+logger = logging.getLogger('w3')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def request_executor():
     """
-    Minimalist UDP-based node server thread with automatic message chunking and reassembly
+    Thread pool sending the background requests of every node of the process
     """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(REQUEST_WORKERS, thread_name_prefix='request')
+    return _executor
 
-    CHUNK_SIZE = 1024  # Define the chunk size for UDP packets
+class RequestMixin:
+    """
+    Requests to the peers through the pooled connections of the server (self.pool)
 
-    def __init__(self, node, host, port, id):
-        super().__init__()
-        self.id = id
-        self.node = node
-        self.host = host
-        self.port = port
-        self.message_handler = MessageHandler(self)
-        self.terminate_flag = threading.Event()
-        print(f"Node {self.id} starting on port {self.port}")
+    send_request blocks until the answer is handled. submit sends the request from the shared
+    request_executor and queues its answer in self.answers, process_answers then hands the
+    queued answers to the MessageHandler on the thread of the node.
+    """
 
-    def run(self):
-        """ Listen for incoming UDP messages """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind((self.host, self.port))
+    def send_request(self, enode, request):
+        """
+        Sends a request and handles the answer
+        """
+        address = self._address(enode)
 
-        while not self.terminate_flag.is_set():
-            try:
-                sock.settimeout(5)
+        try:
+            answer = self.pool.request(address, request)
+        except DecodeError as e:
+            print(f"Invalid answer from address : {address}")
+            raise e
+        except Exception as e:
+            print(f"Error requesting address : {address}")
+            raise e
 
-                # Receive data and client address
-                data, client_address = self.receive_large_message(sock)
-                if data:
-                    request = pickle.loads(data)
-                    answer = self.message_handler.handle_request(request)
-                    self.send_large_message(sock, pickle.dumps(answer), client_address)
+        self.message_handler.handle_answer(answer)
 
-            except socket.timeout:
-                pass
+    def submit(self, enode, request, timeout=None):
+        """
+        Sends a request in the background, its answer is handled by a later process_answers call
+        :return: Future of the answer
+        """
+        future = request_executor().submit(self.pool.request, self._address(enode), request, timeout)
+        future.add_done_callback(lambda f: self.answers.put((enode, f)))
+        return future
+
+    def process_answers(self):
+        """
+        Handles the answers received since the last call, a failed request or a malformed answer only
+        concerns its peer
+        """
+        while True:
+            try:
+                enode, future = self.answers.get_nowait()
+            except queue.Empty:
+                return
+            error = future.exception()
+            if error is not None:
+                logger.warning(f"Node {self.id} request to {enode} failed: {error!r}")
+                if metrics.enabled:
+                    metrics.inc("toychain_failed_requests_total", error=type(error).__name__)
+                continue
+            try:
+                self.message_handler.handle_answer(future.result())
             except Exception as e:
-                raise e
+                logger.error(f"Node {self.id} could not handle the answer of {enode}: {e!r}")
+                if metrics.enabled:
+                    metrics.inc("toychain_invalid_messages_total", kind="answer")
 
-            sleep(0.00001)
+    def wake(self):
+        """
+        Called when the node has something new to send, its thread steps it anyway
+        """
 
-        sock.close()
-        print(f"Node {self.id} stopped")
+    def disconnect(self, enode):
+        """
+        Closes the pooled connection to a peer
+        """
+        self.pool.close(self._address(enode))
 
-    def send_request(self, enode, request):
-        """ Send a request via UDP and receive the response """
+    @staticmethod
+    def _address(enode):
         parsed_enode = urllib.parse.urlparse(enode)
-        address = (parsed_enode.hostname, parsed_enode.port)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-        # Send the request in chunks
-        self.send_large_message(sock, pickle.dumps(request), address)
-
-        # Receive the response in chunks
-        data = self.receive_large_message(sock)[0]
-        if data:
-            answer = pickle.loads(data)
-            self.message_handler.handle_answer(answer)
-
-        sock.close()
-
-    def send_large_message(self, sock, data, address):
-        """ Send large messages by splitting them into chunks """
-        chunks = [data[i:i + self.CHUNK_SIZE] for i in range(0, len(data), self.CHUNK_SIZE)]
-        for chunk in chunks:
-            sock.sendto(chunk, address)
-        # Send an empty chunk to indicate the end of transmission
-        sock.sendto(b'', address)
-
-    def receive_large_message(self, sock):
-        """ Reassemble large messages received in chunks and return the data and client address """
-        data = bytearray()
-        client_address = None
-        while True:
-            chunk, address = sock.recvfrom(self.CHUNK_SIZE)
-            if not client_address:
-                client_address = address  # Capture the client address from the first packet
-            if not chunk:  # Empty chunk signals end of transmission
-                break
-            data.extend(chunk)
-        return data if data else None, client_address
+        return parsed_enode.hostname, parsed_enode.port
 
-    def stop(self):
-        self.terminate_flag.set()
+    def sent_by(self, enode, peer):
+        """
+        Whether a request received from the address peer can come from the node enode
+        A node connects from another port than the one it listens on, only the host is compared
+        """
+        return self._address(enode)[0] == peer[0]
 
-class NodeServerThread(threading.Thread):
+
+class NodeServerThread(RequestMixin, threading.Thread):
     """
     Thread answering to requests, every node has one
+
+    Connections between nodes are persistent: requests to a peer go through one pooled connection,
+    and every accepted connection is served by its own thread for as long as the peer keeps it open.
+    Messages are framed with their length and a request id, large answers are streamed (see Framing.py).
     """
 
     def __init__(self, node, host, port, id):
@@ -105,28 +130,35 @@ class NodeServerThread(threading.Thread):
         self.node = node
         self.host = host
         self.port = port
-        self.max_packet = 6000000
 
         self.message_handler = MessageHandler(self)
+        self.pool = ConnectionPool(REQUEST_TIMEOUT)
+        self.answers = queue.SimpleQueue()
 
         self.terminate_flag = threading.Event()
+        self._clients_lock = threading.Lock()
+        self._clients = set()
 
         print("Node " + str(self.id) + " starting on port " + str(self.port))
 
     def run(self):
         """
-        Waiting for one other Node to connect
+        Accepts the connections of the other nodes
         """
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.host, self.port))
+        self.sock.listen(socket.SOMAXCONN)
+        self.sock.settimeout(1)
 
         while not self.terminate_flag.is_set():
           try:
-            self.sock.settimeout(5)
-            self.sock.listen(1)
             client_sock, client_address = self.sock.accept()
-            self.handle_connection(client_sock)
+            client_sock.settimeout(None)
+            client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._clients_lock:
+                self._clients.add(client_sock)
+            threading.Thread(target=self.handle_connection, args=(client_sock,), daemon=True).start()
 
           except socket.timeout:
             pass
@@ -134,82 +166,87 @@ class NodeServerThread(threading.Thread):
           except Exception as e:
             raise e
 
-          sleep(0.00001)
-
-        self.sock.shutdown(True)
         self.sock.close()
+        with self._clients_lock:
+            clients = list(self._clients)
+        for client_sock in clients:
+            try:
+                client_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.pool.close()
         print("Node " + str(self.id) + " stopped")
 
     def handle_connection(self, sock):
         """
-        Answer with the asked information
+        Answers the requests received on a connection until the peer closes it
         """
+        reader = FrameReader(sock)
+        assembler = MessageAssembler()
+        try:
+            peer = sock.getpeername()
+            while not self.terminate_flag.is_set():
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                complete, request = assembler.feed(*frame)
+                if not complete:
+                    continue
+
+                # Send the answer
+                answer = self.message_handler.handle_request(request, peer)
+                sent = send_message(sock, frame[0], answer)
+                if metrics.enabled:
+                    # Requests are sent in one frame
+                    label = message_type(request)
+                    metrics.observe("toychain_request_bytes", FRAME_HEADER.size + len(frame[2]), metrics.SIZE_BUCKETS,
+                                    type=label)
+                    metrics.observe("toychain_answer_bytes", sent, metrics.SIZE_BUCKETS, type=label)
+
+        except DecodeError as e:
+            print(f"Invalid request received by node {self.id}: {e}")
+        except OSError:
+            pass
+        finally:
+            with self._clients_lock:
+                self._clients.discard(sock)
+            sock.close()
 
-        # Receive request
-        data = self.receive(sock)
-        # data = sock.recv(4096)
-        request = pickle.loads(data)
+    def stop(self):
+        self.terminate_flag.set()
 
-        # Send the answer
-        answer = self.message_handler.handle_request(request)
-        self.send(pickle.dumps(answer), sock)
 
-    def send_request(self, enode, request):
-        """
-        Sends a request and returns the answer
-        """
-        parsed_enode = urllib.parse.urlparse(enode)
-        address = (parsed_enode.hostname, parsed_enode.port)
-        
-        # Send the request
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-          sock.connect(address)
-          self.send(pickle.dumps(request), sock)
+class NodeServerThreadUDP(RequestMixin, threading.Thread):
+    """
+    Thread answering to requests over UDP, usable in place of the NodeServerThread of a node
 
-        except Exception as e:
-          print(f"Error Connecting to Address : {address}")
-          raise e
-          
-        # Get the answer
-        try:
-            data = self.receive(sock)
-        except:
-            print("Error receiving data")
+    Messages are sent as acknowledged datagrams, lost ones are sent again (see ReliableUDP.py), so
+    there is no connection to set up or keep open. On lossy links, a lost datagram only delays the
+    chunk it carries instead of the whole stream of a TCP connection.
+    """
 
-        try:
-          answer = pickle.loads(data)
-        except EOFError as e:
-          print(data)
-          raise e
-        self.message_handler.handle_answer(answer)
+    def __init__(self, node, host, port, id):
+        super().__init__()
+        self.id = id
+        self.node = node
+        self.host = host
+        self.port = port
 
-        sock.close()
+        self.message_handler = MessageHandler(self)
+        self.pool = ReliableUDP(host, port, self.message_handler.handle_request, REQUEST_TIMEOUT)
+        self.answers = queue.SimpleQueue()
 
-    def stop(self):
-        self.terminate_flag.set()
+        self.terminate_flag = threading.Event()
+        print(f"Node {self.id} starting on port {self.port}")
+
+    def run(self):
+        self.pool.serve(self.terminate_flag)
+        self.pool.stop()
+        print(f"Node {self.id} stopped")
 
-    def send(self, data, sock):
-        sock.sendall(data)
+    def sent_by(self, enode, peer):
+        # Datagrams are sent from the address the node listens on
+        return self._address(enode) == peer
 
-    def receive(self, sock):
-        data = []
-        sock.settimeout(50)  # Set a timeout for the socket to prevent getting stuck indefinitely
-        try:
-            while True:
-                packet = sock.recv(4096)
-                if not packet:
-                    break  # No more data to receive
-                if len(packet) > self.max_packet:
-                    self.max_packet = len(packet)
-                data.append(packet)
-                if len(packet) < 4096:
-                    break  # End of the message
-        except socket.timeout:
-            print("Socket timed out. No more data to receive.")
-        except socket.error as e:
-            print(f"Socket error occurred: {e}")
-        finally:
-            sock.settimeout(None)  # Reset the timeout to the default (blocking mode)
-       
-        return b"".join(data)
\ No newline at end of file
+    def stop(self):
+        self.terminate_flag.set()
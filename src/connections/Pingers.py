@@ -1,7 +1,10 @@
 import copy
 from time import sleep
 
-from toychain.src.utils.constants import MEMPOOL_SYNC_INTERVAL, CHAIN_SYNC_INTERVAL, MEMPOOL_SYNC_TAG, CHAIN_SYNC_TAG
+from toychain.src.Mempool import SKETCH_CELLS
+
+from toychain.src.utils.constants import MEMPOOL_SYNC_INTERVAL, CHAIN_SYNC_INTERVAL, MEMPOOL_SYNC_TAG, CHAIN_SYNC_TAG, \
+    SYNC_REQUEST_TIMEOUT
 
 class ChainPinger():
     def __init__(self, node, interval=CHAIN_SYNC_INTERVAL):
@@ -14,20 +17,18 @@ class ChainPinger():
         self.flag  = False
         self.sleep = 0
 
+        # {enode: Future of the last request}
+        self.in_flight = {}
+
     def run(self):
         peer_list = copy.copy(self.node.peers) # To avoid iterating on a changing size object
-        try:
-            for peer in peer_list:
-                self.launch_sync(peer)
 
-            self.sleep = self.interval# + (int(self.node.id)+ int(self.node.custom_timer.time())) % 10
+        # Requests are sent to all the peers at once, answers are handled by Node.step
+        self.in_flight = {peer: future for peer, future in self.in_flight.items() if peer in peer_list}
+        for peer in peer_list:
+            self.launch_sync(peer)
 
-        except (ConnectionAbortedError, BrokenPipeError) as e:
-            print(e)
-
-        except Exception as e:
-            self.stop()
-            raise e
+        self.sleep = self.interval# + (int(self.node.id)+ int(self.node.custom_timer.time())) % 10
             
     def step(self):
         if self.flag:
@@ -36,6 +37,12 @@ class ChainPinger():
             else:
                 self.run()
 
+    def next_run(self):
+        """
+        Time of the next step that runs the pinger, for a Simulator
+        """
+        return self.node.custom_timer.time() + self.sleep + 1
+
     def start(self):
         self.flag = True
 
@@ -43,8 +50,12 @@ class ChainPinger():
         self.flag = False
 
     def launch_sync(self, enode):
+        # A peer still answering the previous request is skipped
+        future = self.in_flight.get(enode)
+        if future is not None and not future.done():
+            return
         request = self.message_handler.construct_message("", CHAIN_SYNC_TAG, enode)
-        self.node_server.send_request(enode, request)
+        self.in_flight[enode] = self.node_server.submit(enode, request, SYNC_REQUEST_TIMEOUT)
 
 
 class MemPoolPinger():
@@ -57,20 +68,18 @@ class MemPoolPinger():
         self.flag  = False
         self.sleep = 0
 
+        # {enode: Future of the last request}
+        self.in_flight = {}
+
     def run(self):
         peer_list = copy.copy(self.node.peers)  # To avoid iterating on a changing size object
-        try:
-            for peer in peer_list:
-                self.launch_sync(peer)
-
-            self.sleep = self.interval# + (int(self.node.id)+ int(self.node.custom_timer.time())) % 10
 
-        except (ConnectionAbortedError, BrokenPipeError) as e:
-            print(e)
+        # Requests are sent to all the peers at once, answers are handled by Node.step
+        self.in_flight = {peer: future for peer, future in self.in_flight.items() if peer in peer_list}
+        for peer in peer_list:
+            self.launch_sync(peer)
 
-        except Exception as e:
-            self.stop()
-            raise e
+        self.sleep = self.interval# + (int(self.node.id)+ int(self.node.custom_timer.time())) % 10
 
     def step(self):
         if self.flag:
@@ -79,6 +88,12 @@ class MemPoolPinger():
             else:
                 self.run()
 
+    def next_run(self):
+        """
+        Time of the next step that runs the pinger, for a Simulator
+        """
+        return self.node.custom_timer.time() + self.sleep + 1
+
     def start(self):
         self.flag = True
 
@@ -86,8 +101,12 @@ class MemPoolPinger():
         self.flag = False
 
     def launch_sync(self, enode):
-        request = self.message_handler.construct_message("", MEMPOOL_SYNC_TAG, enode)
-        self.node_server.send_request(enode, request)
+        # A peer still answering the previous request is skipped
+        future = self.in_flight.get(enode)
+        if future is not None and not future.done():
+            return
+        request = self.message_handler.construct_message([self.node.mempool.digest, SKETCH_CELLS], MEMPOOL_SYNC_TAG, enode)
+        self.in_flight[enode] = self.node_server.submit(enode, request, SYNC_REQUEST_TIMEOUT)
 
 
 
@@ -0,0 +1,352 @@
+import itertools
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from struct import Struct
+
+from toychain.src.connections.Framing import MAX_FRAME_SIZE
+from toychain.src.utils.codec import encode, decode
+
+import logging
+logger = logging.getLogger('w3')
+
+# Datagram header: kind, message id, sequence number, number of chunks of the message, and time
+# stamp (microseconds) of the sender of a chunk, echoed by its ACK to measure the round trip time
+PACKET_HEADER = Struct('<BQIII')
+_STAMP_MASK = (1 << 32) - 1
+DATA = 0
+ACK = 1
+# ACK datagrams carry the number of chunks received in sequence, and a bitmap of the next ACK_BITS ones
+ACK_BITMAP = Struct('<Q')
+ACK_BITS = 64
+
+# Payload of a datagram, it fits in the MTU of most links
+CHUNK_SIZE = 1200
+# Chunks of a message sent and not acknowledged at once
+WINDOW = 32
+# Retransmission timeout: twice the smoothed round trip time, within these bounds (seconds)
+# It doubles while the peer acknowledges nothing
+MIN_RTO = 0.02
+MAX_RTO = 2.0
+INITIAL_RTO = 0.2
+# A chunk is sent again without waiting for the timeout once this many following chunks are acknowledged
+FAST_RETRANSMIT = 3
+# Ids of the messages received last, acknowledged again if their chunks are sent again
+COMPLETED_MEMORY = 4096
+# Largest message, in chunks: as large as the largest frame of a TCP connection
+MAX_CHUNKS = MAX_FRAME_SIZE // CHUNK_SIZE + 1
+# Messages being received at the same time, the chunks of new ones are dropped beyond
+MAX_INCOMING = 1024
+# Seconds between two purges of the messages whose sender stopped sending chunks
+PURGE_INTERVAL = 1.0
+
+# Header of a message: request id, and whether it is a request or an answer
+MESSAGE_HEADER = Struct('<QB')
+REQUEST = 0
+ANSWER = 1
+
+
+def _stamp(now):
+    return int(now * 1e6) & _STAMP_MASK
+
+
+class _Transfer:
+    """
+    Chunks of a message being sent, acknowledged by the receiver
+    """
+
+    def __init__(self, count):
+        self.count = count
+        # Chunks received in sequence, and the ones received after them
+        self.base = 0
+        self.acked = set()
+
+
+class _Reassembly:
+    """
+    Chunks of a message being received
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.chunks = {}
+        self.base = 0
+        self.last = time.monotonic()
+
+
+class ReliableUDP:
+    """
+    Requests and answers between nodes over UDP, with the request() interface of ConnectionPool
+
+    Every message gets an id and is split in chunks of CHUNK_SIZE, numbered in sequence. The sender
+    keeps up to WINDOW chunks unacknowledged, the receiver acknowledges every chunk with the number
+    of chunks received in sequence and a bitmap of the following ones, so that only the lost chunks
+    are sent again, after a timeout adapted to the round trip time of the peer. Chunks of concurrent
+    messages interleave freely, they are reassembled by (address, message id).
+
+    One thread reads the socket (serve), requests are handled on a thread pool by handler(message, address),
+    which returns the answer. Chunks announcing more than MAX_CHUNKS, or another number of chunks than
+    the first chunk of their message, are dropped, and the messages that stopped receiving chunks for
+    the timeout are forgotten.
+    """
+
+    def __init__(self, host, port, handler, timeout, workers=4, loss=0):
+        """
+        Args:
+            loss: probability to drop an outgoing datagram, to simulate a lossy link
+        """
+        self.handler = handler
+        self.timeout = timeout
+        self.loss = loss
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.5)
+        self._workers = ThreadPoolExecutor(workers, thread_name_prefix='udp')
+
+        # Message ids start at random, a restarted node does not reuse the ids of its previous run
+        self._message_ids = itertools.count(random.getrandbits(48))
+        self._request_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        # {(address, message id): _Transfer}
+        self._transfers = {}
+        # {(address, message id): _Reassembly}, and the ids of the messages completed last
+        self._incoming = {}
+        self._completed = OrderedDict()
+        # {(address, request id): Future of the answer}, only the peer requested can answer
+        self._pending = {}
+        # {address: smoothed round trip time}
+        self._rtt = {}
+        self.closed = False
+
+    def _sendto(self, data, address):
+        if self.loss and random.random() < self.loss:
+            return
+        try:
+            self.sock.sendto(data, address)
+        except OSError:
+            pass
+
+    # Sending
+
+    def send(self, address, data, timeout=None):
+        """
+        Sends a message and returns once all its chunks are acknowledged
+        Raises socket.timeout if the peer does not acknowledge them in time
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        message_id = next(self._message_ids)
+        chunks = [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)] or [b'']
+        count = len(chunks)
+        if count > MAX_CHUNKS:
+            raise ValueError(f"Message of {len(data)} bytes, the peer accepts at most {MAX_CHUNKS} chunks")
+        key = (address, message_id)
+        transfer = _Transfer(count)
+        # {seq: time sent last}
+        sent_at = {}
+        retries = 0
+        progress = 0
+
+        with self._condition:
+            self._transfers[key] = transfer
+            try:
+                while transfer.base < count:
+                    if self.closed:
+                        raise ConnectionResetError("UDP endpoint closed")
+                    now = time.monotonic()
+                    if now > deadline:
+                        raise socket.timeout(f"No acknowledgement from {address}")
+                    rtt = self._rtt.get(address, INITIAL_RTO)
+                    rto = min(MAX_RTO, self._rto(address) * 2 ** retries)
+                    highest = max(transfer.acked, default=transfer.base - 1)
+
+                    # Chunks of the window never sent, unacknowledged for longer than the timeout,
+                    # or that following chunks overtook
+                    timed_out = False
+                    for seq in range(transfer.base, min(transfer.base + WINDOW, count)):
+                        if seq in transfer.acked:
+                            continue
+                        if seq in sent_at:
+                            elapsed = now - sent_at[seq]
+                            if elapsed >= rto:
+                                timed_out = True
+                            elif seq + FAST_RETRANSMIT > highest or elapsed < rtt:
+                                continue
+                        sent_at[seq] = now
+                        self._sendto(PACKET_HEADER.pack(DATA, message_id, seq, count, _stamp(now)) + chunks[seq],
+                                     address)
+
+                    self._condition.wait(rto)
+                    acknowledged = transfer.base + len(transfer.acked)
+                    if acknowledged > progress:
+                        progress = acknowledged
+                        retries = 0
+                    elif timed_out:
+                        retries += 1
+            finally:
+                del self._transfers[key]
+
+    def _rto(self, address):
+        rtt = self._rtt.get(address)
+        if rtt is None:
+            return INITIAL_RTO
+        return min(MAX_RTO, max(MIN_RTO, 2 * rtt))
+
+    def _update_rtt(self, address, sample):
+        rtt = self._rtt.get(address)
+        self._rtt[address] = sample if rtt is None else 0.875 * rtt + 0.125 * sample
+
+    def request(self, address, message, timeout=None):
+        """
+        Sends a request and waits for its answer
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        key = (address, next(self._request_ids))
+        future = Future()
+        with self._lock:
+            self._pending[key] = future
+        try:
+            self.send(address, MESSAGE_HEADER.pack(key[1], REQUEST) + encode(message), deadline - time.monotonic())
+            try:
+                answer = future.result(max(deadline - time.monotonic(), 0))
+            except FutureTimeout:
+                raise socket.timeout(f"No answer from {address}")
+            return decode(memoryview(answer)[MESSAGE_HEADER.size:])
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def close(self, address=None):
+        """
+        There are no connections to close, the estimated round trip time of the peer is forgotten
+        """
+        with self._lock:
+            if address is None:
+                self._rtt.clear()
+            else:
+                self._rtt.pop(address, None)
+
+    # Receiving
+
+    def serve(self, terminate_flag):
+        """
+        Reads the socket until terminate_flag is set
+        """
+        purged = time.monotonic()
+        while not terminate_flag.is_set():
+            if time.monotonic() - purged >= PURGE_INTERVAL:
+                self._forget_stale()
+                purged = time.monotonic()
+            try:
+                packet, address = self.sock.recvfrom(PACKET_HEADER.size + CHUNK_SIZE + ACK_BITMAP.size)
+            except socket.timeout:
+                continue
+            except OSError:
+                if self.closed:
+                    break
+                continue
+            if len(packet) < PACKET_HEADER.size:
+                continue
+            kind, message_id, seq, count, stamp = PACKET_HEADER.unpack_from(packet)
+            if kind == ACK:
+                self._handle_ack(address, message_id, seq, stamp, packet)
+            elif kind == DATA:
+                self._handle_data(address, message_id, seq, count, stamp, packet[PACKET_HEADER.size:])
+
+    def _handle_ack(self, address, message_id, base, stamp, packet):
+        if len(packet) < PACKET_HEADER.size + ACK_BITMAP.size:
+            return
+        bitmap = ACK_BITMAP.unpack_from(packet, PACKET_HEADER.size)[0]
+        with self._condition:
+            transfer = self._transfers.get((address, message_id))
+            if transfer is None:
+                return
+            self._update_rtt(address, ((_stamp(time.monotonic()) - stamp) & _STAMP_MASK) / 1e6)
+            if base > transfer.base:
+                transfer.base = base
+                transfer.acked = {seq for seq in transfer.acked if seq >= base}
+            for bit in range(ACK_BITS):
+                if bitmap >> bit & 1:
+                    transfer.acked.add(base + 1 + bit)
+            self._condition.notify_all()
+
+    def _handle_data(self, address, message_id, seq, count, stamp, chunk):
+        if not 0 < count <= MAX_CHUNKS or seq >= count:
+            return
+        key = (address, message_id)
+        message = None
+        with self._lock:
+            if key in self._completed:
+                if self._completed[key] != count:
+                    return
+                base, bitmap = count, 0
+            else:
+                reassembly = self._incoming.get(key)
+                if reassembly is None:
+                    if len(self._incoming) >= MAX_INCOMING:
+                        return
+                    reassembly = self._incoming[key] = _Reassembly(count)
+                elif reassembly.count != count:
+                    return
+                reassembly.chunks[seq] = chunk
+                reassembly.last = time.monotonic()
+                while reassembly.base in reassembly.chunks:
+                    reassembly.base += 1
+                base = reassembly.base
+                bitmap = 0
+                for bit in range(ACK_BITS):
+                    if base + 1 + bit in reassembly.chunks:
+                        bitmap |= 1 << bit
+
+                if base == count:
+                    del self._incoming[key]
+                    self._completed[key] = count
+                    if len(self._completed) > COMPLETED_MEMORY:
+                        self._completed.popitem(last=False)
+                    message = b''.join(reassembly.chunks[i] for i in range(count))
+
+        self._sendto(PACKET_HEADER.pack(ACK, message_id, base, count, stamp) + ACK_BITMAP.pack(bitmap), address)
+        if message is not None:
+            self._deliver(address, message)
+
+    def _deliver(self, address, message):
+        if len(message) < MESSAGE_HEADER.size:
+            return
+        request_id, kind = MESSAGE_HEADER.unpack_from(message)
+        if kind == ANSWER:
+            with self._lock:
+                future = self._pending.get((address, request_id))
+            if future is not None and not future.done():
+                future.set_result(message)
+        else:
+            self._workers.submit(self._answer, address, request_id, message)
+
+    def _answer(self, address, request_id, message):
+        try:
+            request = decode(memoryview(message)[MESSAGE_HEADER.size:])
+            answer = self.handler(request, address)
+            self.send(address, MESSAGE_HEADER.pack(request_id, ANSWER) + encode(answer))
+        except Exception as e:
+            logger.warning(f"UDP request from {address} failed: {e!r}")
+
+    def _forget_stale(self):
+        # Messages that stopped receiving chunks, their sender has given up
+        limit = time.monotonic() - self.timeout
+        with self._lock:
+            for key in [key for key, reassembly in self._incoming.items() if reassembly.last < limit]:
+                del self._incoming[key]
+
+    def stop(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        for future in list(self._pending.values()):
+            if not future.done():
+                future.set_exception(ConnectionResetError("UDP endpoint closed"))
+        self._workers.shutdown(wait=False)
+        self.sock.close()
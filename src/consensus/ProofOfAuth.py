@@ -1,9 +1,8 @@
-import copy
 import threading
 from random import randint
 from time import time, sleep
 
-from toychain.src.utils import constants
+from toychain.src.utils import constants, metrics
 from toychain.src.utils.helpers import gen_enode
 from toychain.src.Block import Block, State
 
@@ -35,6 +34,8 @@ class ProofOfAuthority:
 
         # Boolean to check or not the block states
         self.trust = True
+        # Maximum number of transactions in a block produced, None for no limit
+        self.block_size = None
 
     def verify_chain(self, chain, previous_state):
         last_block = chain[0]
@@ -68,6 +69,24 @@ class ProofOfAuthority:
             i += 1
         return True
 
+    def verify_header(self, header, parent):
+        """
+        Checks a block header (Block or BlockHeader) against the header of its parent, before the block
+        itself is downloaded
+        """
+        if header.parent_hash != parent.hash or header.height != parent.height + 1:
+            return False
+        if header.total_difficulty != parent.total_difficulty + header.difficulty:
+            return False
+        if header.timestamp - parent.timestamp < BLOCK_PERIOD // 2:
+            return False
+        if header.miner_id not in self.auth_signers:
+            return False
+
+        if header.height % self.signer_count == self.auth_signers.index(header.miner_id):
+            return header.difficulty == DIFF_INTURN
+        return header.difficulty == DIFF_NOTURN
+
     def verify_block(self, block, previous_state):
         # Verify signer
         if block.miner_id in self.auth_signers:
@@ -77,16 +96,18 @@ class ProofOfAuthority:
 
         # Verify block state
         if not self.trust:
-            s = copy.deepcopy(previous_state)
-            for transaction in block.data:
-                s.apply_transaction(transaction)
-            if s.state_hash != block.state.state_hash:
+            s = previous_state.fork()
+            s.apply_transactions(block.data, block)
+            if s.state_hash != block.state_root:
                 logger.error(f"Invalid state {previous_state.state_variables}")
                 logger.error(f"{s.state_variables}")
                 logger.error(f"{block.state.state_variables}")
                 logger.error(f"{block.data}")
                 return False
 
+            # Keep the replayed state, it shares its unchanged entries with the previous block
+            block.state = s
+
         # Check Total Difficulty
         if block.height % self.signer_count == signer_index:
             expected_diff = DIFF_INTURN
@@ -127,61 +148,87 @@ class ProofOfAuth():
         if self.index == -1: self.stop()
 
         timestamp = self.timer.time()
-        last_block = copy.deepcopy(self.node.get_block('last'))
-        last_signed_block = self.node.get_last_signed_block()
+        last_block = self.node.get_block('last')
         next_block_number = last_block.height+1
 
-        # No signing if already signed in last N/2+1 blocks
-        if last_signed_block == 0:
-            pass
-        elif next_block_number - last_signed_block < (self.signer_count + 1) // 2 + (self.signer_count + 1) % 2:  
+        due = self.next_run()
+        if due is None or timestamp < due:
             return
+        self.produce_block(timestamp, next_block_number)
 
-        # If it is my turn to sign (diff = DIFF_INTURN)
+    @metrics.timed("toychain_block_production_seconds")
+    def produce_block(self, timestamp, next_block_number):
+        # If it is my turn to sign (diff = DIFF_INTURN), else out of turn signature (diff = DIFF_NOTURN)
         if next_block_number % self.signer_count == self.index:
             difficulty = DIFF_INTURN
-
-        # If it is not my turn, wait (t = DELAY_NOTURN)
-        elif DELAY_NOTURN == None or timestamp-last_block.timestamp-self.period < DELAY_NOTURN:
-            return
-        
-        # After wait, do out of turn signature (diff = DIFF_NOTURN)
         else:
             difficulty = DIFF_NOTURN
-        
-        if next_block_number > last_block.height and timestamp > (last_block.timestamp + self.period - 1):
 
-            # Get the current block, state and mempool
-            previous_block = copy.deepcopy(self.node.get_block('last'))
-            previous_state = previous_block.state
-            mempool = list((self.node.mempool.copy().values()))
+        # Get the current block, a copy of its state and the mempool
+        previous_block = self.node.get_block('last')
+        state = previous_block.state.fork()
+        mempool = list((self.node.mempool.copy().values()))
+
+        # Filter out transactions already on the blockchain
+        data = [tx for tx in mempool if tx.id not in self.node.previous_transactions_id]
+
+        # Transactions beyond the block size stay in the mempool for the next blocks
+        block_size = self.consensus.block_size
+        left = data[block_size:] if block_size is not None else []
+        data = data[:block_size]
+
+        # Generate the new block
+        block = Block(
+                    next_block_number, 
+                    previous_block.hash, 
+                    data,
+                    self.node.enode,
+                    timestamp, 
+                    difficulty, 
+                    previous_block.total_difficulty, 
+                    nonce = self.node.random.randint(0, 1000),
+                    state = state)
+
+        # Apply transactions to obtain the new state variables
+        block.state.apply_transactions(block.data, block)
+        block.update_state_root()
+
+        # Update the blockchain and mempool
+        self.node.add_block(block)
+        self.node.mempool.clear()
+        self.node.mempool.update((tx.id, tx) for tx in left)
+
+        logger.info(f"Block produced by Node {self.node.id}: ")
+        logger.info(f"{repr(block)}")
+        logger.info(f"{block.state.state_variables} \n")
+
+    def next_run(self):
+        """
+        Time from which run produces a block on the current chain, None if it cannot before the chain changes
+        A Simulator only runs the block generation then, instead of at every step
+        """
+        if self.index == -1:
+            return None
+
+        last_block = self.node.get_block('last')
+        next_block_number = last_block.height+1
 
-            # Filter out transactions already on the blockchain
-            data = [tx for tx in mempool if tx.id not in self.node.previous_transactions_id]
-            
-            # Generate the new block
-            block = Block(
-                        next_block_number, 
-                        previous_block.hash, 
-                        data,
-                        self.node.enode,
-                        timestamp, 
-                        difficulty, 
-                        previous_block.total_difficulty, 
-                        state = previous_state)
-
-            # Apply transactions to obtain the new state variables
-            for transaction in block.data:
-                block.state.apply_transaction(transaction, block)
-
-            # Update the blockchain and mempool
-            self.node.chain.append(block)
-            self.node.previous_transactions_id.update([tx.id for tx in block.data])
-            self.node.mempool.clear()
-
-            logger.info(f"Block produced by Node {self.node.id}: ")
-            logger.info(f"{repr(block)}")
-            logger.info(f"{block.state.state_variables} \n")
+        # No signing if already signed in last N/2+1 blocks, older blocks are not looked at
+        window = (self.signer_count + 1) // 2 + (self.signer_count + 1) % 2
+        last_signed_block = self.node.get_last_signed_block(depth=window - 1)
+        if last_signed_block == 0:
+            pass
+        elif next_block_number - last_signed_block < window:
+            return None
+
+        due = last_block.timestamp + self.period
+
+        # If it is not my turn, wait (t = DELAY_NOTURN)
+        if next_block_number % self.signer_count != self.index:
+            if DELAY_NOTURN == None:
+                return None
+            due = max(due, last_block.timestamp + self.period + DELAY_NOTURN)
+        return due
 
     def step(self):
         if self.flag:
@@ -236,18 +283,17 @@ class ProofOfAuthThread(threading.Thread):
 
                 difficulty = DIFF_NOTURN
 
-            previous_block = copy.deepcopy(self.node.get_block('last'))
+            previous_block = self.node.get_block('last')
             if block_number > previous_block.height and timestamp > (previous_block.timestamp + self.period - 1):
                 data = list((self.node.mempool.copy().values()))
-                previous_state_var = previous_block.state.state_variables
                 block = Block(block_number, previous_block.hash, data,
                               self.node.enode,
-                              timestamp, difficulty, previous_block.total_difficulty, state_var=previous_state_var)
+                              timestamp, difficulty, previous_block.total_difficulty, state=previous_block.state.fork())
 
-                for transaction in block.data:
-                    block.state.apply_transaction(transaction, block)
+                block.state.apply_transactions(block.data, block)
+                block.update_state_root()
 
-                self.node.chain.append(block)
+                self.node.add_block(block)
                 self.node.mempool.clear()
                 logger.info(f"Block produced by Node {self.node.id}: ")
                 logger.info(f"{repr(block)}")
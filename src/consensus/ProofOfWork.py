@@ -1,9 +1,9 @@
-import copy
 import threading
+from math import log
 from random import randint
 from time import time, sleep
 
-from toychain.src.utils import constants
+from toychain.src.utils import constants, metrics
 from toychain.src.utils.helpers import gen_enode
 
 from toychain.src.Block import Block, State
@@ -27,6 +27,8 @@ class ProofOfWork:
         # Boolean to check or not the block states
         self.trust = True
         self.trust_mining = True # must be true for virtual mining
+        # Maximum number of transactions in a block produced, None for no limit
+        self.block_size = None
 
     def verify_chain(self, chain, previous_state):
         last_block = chain[0]
@@ -53,19 +55,41 @@ class ProofOfWork:
             i += 1
         return True
 
+    def verify_header(self, header, parent):
+        """
+        Checks a block header (Block or BlockHeader) against the header of its parent, before the block
+        itself is downloaded
+        """
+        if header.parent_hash != parent.hash or header.height != parent.height + 1:
+            return False
+        if header.total_difficulty != parent.total_difficulty + header.difficulty:
+            return False
+
+        # Verify the difficulty of the mining
+        if not self.trust_mining:
+            target_string = '1' * (256 - header.difficulty)
+            target_string = target_string.zfill(256)
+            binary_hash = bin(int(header.hash, 16))[3:]
+            if target_string <= binary_hash:
+                return False
+
+        return True
+
     def verify_block(self, block, previous_state):
 
         # Verify block state
         if not self.trust:
-            s = copy.deepcopy(previous_state)
-            for transaction in block.data:
-                s.apply_transaction(transaction)
-            if s.state_hash != block.state.state_hash:
+            s = previous_state.fork()
+            s.apply_transactions(block.data, block)
+            if s.state_hash != block.state_root:
                 logging.error(f"Invalid state {previous_state.state_variables}")
                 logging.error(f"{s.state_variables}")
                 logging.error(f"{block.data}")
                 return False
 
+            # Keep the replayed state, it shares its unchanged entries with the previous block
+            block.state = s
+
         # Verify the difficulty of the mining
         if not self.trust_mining:
             target_string = '1' * (256 - block.difficulty)
@@ -94,26 +118,38 @@ class VirtualMining():
 
         self.flag = False
         self.sleep = 0
+        # Winning draw of the lottery drawn in advance by next_run
+        self.draw = None
         
     def run(self):
         """
         Perform Virtual Mining (lottery)
         """
 
-        difficulty = randint(0, DIFF_CAP)
+        difficulty, self.draw = self.draw, None
+        if difficulty is None:
+            difficulty = self.node.random.randint(0, DIFF_CAP)
         if difficulty <= ROBOT_HASHPOWER*MINING_DIFFICULTY:  
             return
+        self.produce_block(difficulty)
 
+    @metrics.timed("toychain_block_production_seconds")
+    def produce_block(self, difficulty):
         # I won the mining lottery 
         print('CREATED A BLOCK')
         timestamp = self.timer.time()      
-        previous_block = copy.deepcopy(self.node.get_block('last'))
-        previous_state = previous_block.state
+        previous_block = self.node.get_block('last')
+        state = previous_block.state.fork()
         mempool = list((self.node.mempool.copy().values()))
 
         # Filter out transactions already on the blockchain
         data = [tx for tx in mempool if tx.id not in self.node.previous_transactions_id]
 
+        # Transactions beyond the block size stay in the mempool for the next blocks
+        block_size = self.node.consensus.block_size
+        left = data[block_size:] if block_size is not None else []
+        data = data[:block_size]
+
         # Generate the new block
         block = Block(
                     previous_block.height+1, 
@@ -123,21 +159,36 @@ class VirtualMining():
                     timestamp, 
                     difficulty, 
                     previous_block.total_difficulty, 
-                    state = previous_state)
+                    nonce = self.node.random.randint(0, 1000),
+                    state = state)
 
         # Apply transactions to obtain the new state variables
-        for transaction in block.data:
-            block.state.apply_transaction(transaction, block)
+        block.state.apply_transactions(block.data, block)
+        block.update_state_root()
 
         # Update the blockchain and mempool
-        self.node.chain.append(block)
-        self.node.previous_transactions_id.update([tx.id for tx in block.data])
+        self.node.add_block(block)
         self.node.mempool.clear()
+        self.node.mempool.update((tx.id, tx) for tx in left)
 
         logger.info(f"Block produced by Node {self.node.id}: ")
         logger.info(f"{repr(block)}")
         logger.info(f"{block.state.state_variables} \n")
 
+    def next_run(self):
+        """
+        Time of the next step at which the lottery is won, for a Simulator: the number of steps until
+        then follows the geometric distribution of the draws at every step, the winning draw is kept for run
+        """
+        losing = ROBOT_HASHPOWER*MINING_DIFFICULTY + 1
+        if losing > DIFF_CAP:
+            return None
+        steps = 1
+        if losing > 0:
+            steps += int(log(1.0 - self.node.random.random()) / log(losing / (DIFF_CAP + 1)))
+        self.draw = self.node.random.randint(max(losing, 0), DIFF_CAP)
+        return self.timer.time() + steps
+
     def step(self):
         if self.flag:
             if self.sleep > 0:
@@ -165,11 +216,10 @@ class VirtualMining():
         block.total_difficulty = previous_block.total_difficulty + self.difficulty
 
         # Reset the state variables and apply them
-        block.state.state_variables = previous_block.state.state_variables
-        for transaction in block.data:
-            block.state.apply_transaction(transaction)
+        block.state = previous_block.state.fork()
+        block.state.apply_transactions(block.data, block)
 
-        block.compute_block_hash()
+        block.update_state_root()
 
 class Mining():
     """
@@ -192,9 +242,9 @@ class Mining():
         """
         timestamp = self.timer.time()
 
-        # Get the current block, state and mempool
-        previous_block = copy.deepcopy(self.node.get_block('last'))
-        previous_state = previous_block.state
+        # Get the current block, a copy of its state and the mempool
+        previous_block = self.node.get_block('last')
+        state = previous_block.state.fork()
         mempool = list((self.node.mempool.copy().values()))
 
         # Filter out transactions already on the blockchain
@@ -209,12 +259,12 @@ class Mining():
                     timestamp, 
                     self.difficulty, 
                     previous_block.total_difficulty, 
-                    nonce=randint(0,1000),
-                    state = previous_state)
+                    nonce=self.node.random.randint(0,1000),
+                    state = state)
 
         # Apply transactions to obtain the new state variables
-        for transaction in block.data:
-            block.state.apply_transaction(transaction, block)
+        block.state.apply_transactions(block.data, block)
+        block.update_state_root()
 
         attempt = 0
         while attempt < 10:
@@ -231,7 +281,7 @@ class Mining():
                 block.increase_nonce()
 
             else:
-                self.node.chain.append(block)
+                self.node.add_block(block)
                 self.node.mempool.clear()
                 logging.info(f"Block produced by Node {self.node.id}: ")
                 logging.info(f"{repr(block)}")
@@ -254,11 +304,10 @@ class Mining():
         block.total_difficulty = previous_block.total_difficulty + self.difficulty
 
         # Reset the state variables and apply them
-        block.state.state_variables = previous_block.state.state_variables
-        for transaction in block.data:
-            block.state.apply_transaction(transaction)
+        block.state = previous_block.state.fork()
+        block.state.apply_transactions(block.data, block)
 
-        block.compute_block_hash()
+        block.update_state_root()
 
 class MiningThread(threading.Thread):
     """
@@ -281,14 +330,14 @@ class MiningThread(threading.Thread):
         """
         timestamp = self.timer.time()
 
-        previous_block = copy.deepcopy(self.node.get_block('last'))
+        previous_block = self.node.get_block('last')
         data = list((self.node.mempool.copy().values()))
-        state_var = previous_block.state.state_variables
         block = Block(len(self.node.chain), previous_block.compute_block_hash(), data, self.node.id, timestamp,
-                      self.difficulty, previous_block.total_difficulty, nonce=randint(0,1000), state_var=state_var)
+                      self.difficulty, previous_block.total_difficulty, nonce=randint(0,1000),
+                      state=previous_block.state.fork())
 
         while not self.flag.is_set():
-            previous_block = copy.deepcopy(self.node.get_block('last'))
+            previous_block = self.node.get_block('last')
             self.update_block(block, previous_block)
 
             target_string = '1' * (256 - self.difficulty)
@@ -302,7 +351,7 @@ class MiningThread(threading.Thread):
                 block.increase_nonce()
 
             else:
-                self.node.chain.append(block)
+                self.node.add_block(block)
                 self.node.mempool.clear()
                 logging.info(f"Block produced by Node {self.node.id}: ")
                 logging.info(f"{repr(block)}")
@@ -325,8 +374,7 @@ class MiningThread(threading.Thread):
         block.total_difficulty = previous_block.total_difficulty + self.difficulty
 
         # Reset the state variables and apply them
-        block.state.state_variables = previous_block.state.state_variables
-        for transaction in block.data:
-            block.state.apply_transaction(transaction)
+        block.state = previous_block.state.fork()
+        block.state.apply_transactions(block.data, block)
 
-        block.compute_block_hash()
+        block.update_state_root()
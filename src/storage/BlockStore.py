@@ -0,0 +1,347 @@
+import mmap
+import os
+import threading
+from bisect import bisect_right
+from struct import Struct
+
+from toychain.src.storage.Checkpoint import list_checkpoints, read_checkpoint, write_checkpoint, remove_checkpoints
+from toychain.src.utils.codec import encode, encode_block, decode
+
+import logging
+logger = logging.getLogger('store')
+
+INDEX_MAGIC = b'TCIX'
+INDEX_VERSION = 1
+
+# Index header: magic, version, number of blocks
+_HEADER = Struct('<4sIQ')
+# Index record of a block: end offset in blocks.dat, end offset in txids.dat
+_RECORD = Struct('<QQ')
+
+INITIAL_CAPACITY = 1024
+CACHE_SIZE = 64
+CHECKPOINT_INTERVAL = 100
+
+
+class BlockStore:
+    """
+    Append-only on-disk storage of a chain, usable in place of the Node.chain list
+
+    blocks.dat: encoded blocks, appended one after the other
+    txids.dat:  ids of the transactions of every block, to rebuild the transaction index without decoding blocks
+    index.dat:  memory-mapped array of the end offsets of every block in both files (height -> offset)
+
+    checkpoints/: contract state of every checkpoint_interval-th block (see Checkpoint.py)
+
+    Blocks are stored without their contract state. The state of a block is rebuilt from the closest
+    checkpoint below it by replaying the transactions of the following blocks, so that opening a store
+    (restore_tip) costs at most checkpoint_interval blocks, whatever the length of the chain.
+    The last cache_size blocks are kept in memory with their state, older ones are decoded from disk
+    when accessed.
+    """
+
+    def __init__(self, path, cache_size=CACHE_SIZE, checkpoint_interval=CHECKPOINT_INTERVAL):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.cache_size = cache_size
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_dir = os.path.join(path, 'checkpoints')
+
+        self._lock = threading.RLock()
+        self._cache = {}
+        # Last block rebuilt outside of the cache, to replay sequential reads one block at a time
+        self._replayed = None
+
+        self._blocks = open(os.path.join(path, 'blocks.dat'), 'a+b')
+        self._txids = open(os.path.join(path, 'txids.dat'), 'a+b')
+
+        index_path = os.path.join(path, 'index.dat')
+        new = not os.path.exists(index_path) or os.path.getsize(index_path) < _HEADER.size
+        self._index_file = open(index_path, 'w+b' if new else 'r+b')
+        if new:
+            self._index_file.truncate(_HEADER.size + INITIAL_CAPACITY * _RECORD.size)
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+        if new:
+            _HEADER.pack_into(self._index, 0, INDEX_MAGIC, INDEX_VERSION, 0)
+
+        magic, version, count = _HEADER.unpack_from(self._index, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{index_path} is not a block index")
+        self._count = count
+        self._recover()
+
+        # Checkpoints of blocks that were not indexed (interrupted append) are discarded
+        remove_checkpoints(self.checkpoint_dir, self._count)
+        self._checkpoints = list_checkpoints(self.checkpoint_dir)
+
+    def _recover(self):
+        """
+        Drops the last indexed blocks whose data is not entirely on disk (the index was flushed before
+        the data), then the data written after the last indexed block (interrupted append or truncation)
+        """
+        self._blocks.flush()
+        self._txids.flush()
+        blocks_size = os.path.getsize(self._blocks.name)
+        txids_size = os.path.getsize(self._txids.name)
+        count = self._count
+        while count > 0 and any(end > size for end, size in zip(self._ends(count - 1), (blocks_size, txids_size))):
+            count -= 1
+        if count < self._count:
+            logger.warning(f"Dropping {self._count - count} indexed blocks missing from {self._blocks.name}")
+            self._set_count(count)
+
+        block_end, txids_end = self._ends(self._count - 1)
+        if blocks_size > block_end:
+            logger.warning(f"Dropping unindexed data at the end of {self._blocks.name}")
+            self._blocks.truncate(block_end)
+        if txids_size > txids_end:
+            self._txids.truncate(txids_end)
+
+    def _ends(self, height):
+        if height < 0:
+            return 0, 0
+        return _RECORD.unpack_from(self._index, _HEADER.size + height * _RECORD.size)
+
+    def _capacity(self):
+        return (len(self._index) - _HEADER.size) // _RECORD.size
+
+    def _set_count(self, count):
+        self._count = count
+        _HEADER.pack_into(self._index, 0, INDEX_MAGIC, INDEX_VERSION, count)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(self._count))]
+        if key < 0:
+            key += self._count
+        if not 0 <= key < self._count:
+            raise IndexError("block height out of range")
+        block = self._cache.get(key)
+        if block is None:
+            with self._lock:
+                block = self._cache.get(key)
+                if block is None:
+                    block = self._load_block(key)
+        return block
+
+    def __iter__(self):
+        for height in range(self._count):
+            yield self[height]
+
+    def __reversed__(self):
+        """
+        Blocks from the last one, the states of the blocks between two checkpoints are rebuilt in one
+        replay from the lower one, rather than from the checkpoint for every block
+        """
+        height = self._count - 1
+        while height >= 0:
+            block = self._cache.get(height)
+            if block is not None:
+                yield block
+                height -= 1
+                continue
+            with self._lock:
+                start = self._checkpoints[max(bisect_right(self._checkpoints, height) - 1, 0)] if self._checkpoints else 0
+                start = min(start, height)
+                # Sequential reads, each state is replayed from the previous one
+                blocks = [self[h] for h in range(start, height + 1)]
+            yield from reversed(blocks)
+            height = start - 1
+
+    def __delitem__(self, key):
+        if not isinstance(key, slice) or key.stop is not None or key.step not in (None, 1):
+            raise TypeError("Only the end of a block store can be deleted (del store[height:])")
+        start = key.start or 0
+        if start < 0:
+            start = max(0, start + self._count)
+        self.truncate(start)
+
+    def header(self, height):
+        """
+        Stored block decoded from disk without rebuilding its state if it is not cached, for its header
+        fields (hash, miner_id...) and transactions only
+        """
+        block = self._cache.get(height)
+        if block is None:
+            block = self._read_block(height)
+        return block
+
+    def block_hash(self, height):
+        """
+        Hash of a stored block, decoded from disk without rebuilding its state if it is not cached
+        """
+        return self.header(height).hash
+
+    def _read_block(self, height):
+        with self._lock:
+            start = self._ends(height - 1)[0]
+            end = self._ends(height)[0]
+        data = os.pread(self._blocks.fileno(), end - start, start)
+        return decode(memoryview(data))
+
+    def _load_block(self, height):
+        """
+        Decodes a block and rebuilds its state, from the previous block when it was the last one
+        rebuilt (sequential reads), otherwise from the closest checkpoint
+        """
+        block = self._read_block(height)
+        if self._replayed is not None and self._replayed.height == height - 1:
+            block.state = self._next_state(self._replayed, block)
+        else:
+            block.state = self._rebuild_state(block)
+
+        if height >= self._count - self.cache_size:
+            self._cache[height] = block
+        self._replayed = block
+        return block
+
+    def _rebuild_state(self, block):
+        """
+        Replays the blocks from the closest valid checkpoint below the block. A corrupt checkpoint
+        (truncated, unreadable, or whose state does not match the stored chain) is skipped for the
+        previous one, and written again from the replayed state
+        """
+        i = bisect_right(self._checkpoints, block.height) - 1
+        corrupt = set()
+        while True:
+            if i < 0:
+                raise ValueError(f"No valid checkpoint below block {block.height} in {self.checkpoint_dir}")
+            checkpoint_height = self._checkpoints[i]
+            if checkpoint_height == block.height:
+                previous = block
+            else:
+                previous = self._read_block(checkpoint_height)
+            try:
+                checkpoint_hash, state = read_checkpoint(self.checkpoint_dir, checkpoint_height)
+                if previous.hash != checkpoint_hash or state.state_hash != previous.state_root:
+                    raise ValueError(f"Checkpoint {checkpoint_height} does not match the stored chain")
+                break
+            except (OSError, ValueError) as e:
+                logger.warning(f"{e}, replaying from the previous checkpoint")
+                corrupt.add(checkpoint_height)
+                i -= 1
+        previous.state = state
+
+        for height in range(checkpoint_height + 1, block.height):
+            current = self._read_block(height)
+            current.state = self._next_state(previous, current)
+            if height in corrupt:
+                write_checkpoint(self.checkpoint_dir, current)
+            previous = current
+        if previous is not block:
+            block.state = self._next_state(previous, block)
+            if block.height in corrupt:
+                write_checkpoint(self.checkpoint_dir, block)
+        return block.state
+
+    @staticmethod
+    def _next_state(previous, block):
+        state = previous.state.fork()
+        state.apply_transactions(block.data, block)
+        if state.state_hash != block.state_root:
+            raise ValueError(f"Replayed state of block {block.height} does not match its state root")
+        return state
+
+    def restore_tip(self):
+        """
+        Rebuilds the state of the last block from the newest checkpoint
+        :return: number of blocks replayed
+        """
+        if self._count == 0:
+            return 0
+        tip = self[-1]
+        return tip.height - self._checkpoints[bisect_right(self._checkpoints, tip.height) - 1]
+
+    def append(self, block):
+        """
+        Writes a block at the end of the chain
+        """
+        with self._lock:
+            height = self._count
+            if block.height != height:
+                raise ValueError(f"Block {block.height} cannot be appended at height {height}")
+
+            data = encode_block(block, with_state=False)
+            txids = encode([tx.id for tx in block.data])
+            block_end, txids_end = self._ends(height - 1)
+            self._blocks.write(data)
+            self._txids.write(txids)
+            self._blocks.flush()
+            self._txids.flush()
+
+            # The index is only updated once the data is written
+            if height >= self._capacity():
+                self._grow()
+            _RECORD.pack_into(self._index, _HEADER.size + height * _RECORD.size,
+                              block_end + len(data), txids_end + len(txids))
+            self._set_count(height + 1)
+
+            self._cache[height] = block
+            self._cache.pop(height - self.cache_size, None)
+
+            if height % self.checkpoint_interval == 0:
+                write_checkpoint(self.checkpoint_dir, block)
+                self._checkpoints.append(height)
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+
+    def truncate(self, height):
+        """
+        Removes the blocks from the given height to the end of the chain
+        """
+        with self._lock:
+            if height >= self._count:
+                return
+            block_end, txids_end = self._ends(height - 1)
+            self._set_count(height)
+            self._blocks.truncate(block_end)
+            self._txids.truncate(txids_end)
+            for cached in [h for h in self._cache if h >= height]:
+                del self._cache[cached]
+            if self._replayed is not None and self._replayed.height >= height:
+                self._replayed = None
+
+            remove_checkpoints(self.checkpoint_dir, height)
+            del self._checkpoints[bisect_right(self._checkpoints, height - 1):]
+
+    def _grow(self):
+        capacity = 2 * self._capacity()
+        self._index.flush()
+        self._index.close()
+        self._index_file.truncate(_HEADER.size + capacity * _RECORD.size)
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+
+    def transaction_locations(self):
+        """
+        Yields (tx_id, (height, index in block)) for every stored transaction, without decoding the blocks
+        """
+        for height in range(self._count):
+            with self._lock:
+                start = self._ends(height - 1)[1]
+                end = self._ends(height)[1]
+            txids = decode(memoryview(os.pread(self._txids.fileno(), end - start, start)))
+            for index, tx_id in enumerate(txids):
+                yield tx_id, (height, index)
+
+    def sync(self):
+        """
+        Forces the chain to be written on disk
+        """
+        with self._lock:
+            self._index.flush()
+            for f in (self._blocks, self._txids):
+                f.flush()
+                os.fsync(f.fileno())
+
+    def close(self):
+        with self._lock:
+            self._index.flush()
+            self._index.close()
+            self._index_file.close()
+            self._blocks.close()
+            self._txids.close()
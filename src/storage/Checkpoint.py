@@ -0,0 +1,81 @@
+import os
+import re
+
+from toychain.src.Block import State
+from toychain.src.utils.codec import encode, decode
+
+import logging
+logger = logging.getLogger('store')
+
+_FILENAME = "checkpoint-{:012d}.dat"
+_PATTERN = re.compile(r"^checkpoint-(\d{12})\.dat$")
+
+
+def checkpoint_path(directory, height):
+    return os.path.join(directory, _FILENAME.format(height))
+
+
+def list_checkpoints(directory):
+    """
+    Returns the sorted heights of the checkpoints found in the directory
+    """
+    if not os.path.isdir(directory):
+        return []
+    heights = []
+    for name in os.listdir(directory):
+        match = _PATTERN.match(name)
+        if match:
+            heights.append(int(match.group(1)))
+    return sorted(heights)
+
+
+def write_checkpoint(directory, block):
+    """
+    Writes the contract state of a block atomically: the file is fully written and synced under a
+    temporary name before being renamed, so a crash never leaves a partial checkpoint
+    """
+    os.makedirs(directory, exist_ok=True)
+    variables = {k: v for k, v in vars(block.state).items() if k != 'msg' and k != 'block'}
+    data = encode([block.height, block.hash, variables])
+
+    path = checkpoint_path(directory, block.height)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # Make the rename itself durable
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def read_checkpoint(directory, height):
+    """
+    Returns the hash of the block and the contract state stored in the checkpoint of the given height
+    Raises ValueError if the checkpoint is truncated or corrupt
+    """
+    with open(checkpoint_path(directory, height), 'rb') as f:
+        data = f.read()
+    try:
+        stored_height, block_hash, variables = decode(data)
+        state = State(variables)
+    except (AttributeError, TypeError, ValueError) as e:
+        raise ValueError(f"Checkpoint {height} is corrupt: {e}")
+    if stored_height != height:
+        raise ValueError(f"Checkpoint {height} contains the state of block {stored_height}")
+    return block_hash, state
+
+
+def remove_checkpoints(directory, from_height):
+    """
+    Removes the checkpoints of the blocks at and above the given height (chain reorganisation)
+    """
+    for height in list_checkpoints(directory):
+        if height >= from_height:
+            os.remove(checkpoint_path(directory, height))
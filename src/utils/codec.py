@@ -0,0 +1,375 @@
+"""
+Deterministic binary encoding of the values exchanged between nodes and hashed in blocks
+
+Every encoded message starts with the codec VERSION byte, followed by one tagged value:
+    N, T, F            None, True, False
+    i <q>              64 bits signed integer
+    I <H> bytes        arbitrary size signed integer (big endian)
+    f <d>              64 bits float
+    s <I> bytes        utf-8 string
+    b <I> bytes        raw bytes
+    l/t <I> values     list/tuple
+    d <I> key value    dictionary, items sorted by encoded key
+    X transaction      sender, receiver, value, data, timestamp, nonce, id
+    B block            header fields, state root, transactions, state variables
+    S                  Stream, its items are sent separately (see Stream)
+All lengths and counts are little endian. Decoding works on a memoryview of the received
+buffer and never copies it. Values nested deeper than MAX_DEPTH are rejected.
+"""
+import threading
+from collections.abc import Mapping
+from struct import Struct, error as StructError
+
+from toychain.src.Transaction import Transaction
+from toychain.src.utils.constants import ENCODING
+
+VERSION = 2
+
+_U8 = Struct('<B')
+_U16 = Struct('<H')
+_U32 = Struct('<I')
+_I64 = Struct('<q')
+_F64 = Struct('<d')
+
+_I64_MIN = -(1 << 63)
+_I64_MAX = (1 << 63) - 1
+
+# Nesting of the values (lists, tuples, dictionaries, transactions, blocks) accepted by decode
+MAX_DEPTH = 100
+
+_Block = None
+
+# Streams of the value being encoded or decoded by the current thread
+_context = threading.local()
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class Stream:
+    """
+    Sequence of a message sent after it in chunks, so that neither side holds the whole encoding
+    (see connections/Framing.py). The items can be any iterable, they are consumed while sending.
+
+    encode(message, streams) writes the tag S in place of the items and appends the Stream to streams,
+    without streams the items are encoded in place as a list. decode(data, streams) returns an empty
+    list for every S, appended to streams to be filled with the received items.
+    """
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def _block_class():
+    # Block depends on this module for hashing, it is only imported once needed
+    global _Block
+    if _Block is None:
+        from toychain.src.Block import Block
+        _Block = Block
+    return _Block
+
+
+# Encoding
+
+def _encode_str(out, value):
+    raw = value.encode(ENCODING)
+    out += _U32.pack(len(raw))
+    out += raw
+
+
+def _encode_int(out, value):
+    if _I64_MIN <= value <= _I64_MAX:
+        out += b'i'
+        out += _I64.pack(value)
+    else:
+        raw = value.to_bytes((value.bit_length() + 8) // 8, 'big', signed=True)
+        out += b'I'
+        out += _U16.pack(len(raw))
+        out += raw
+
+
+def _encode_sequence(out, value, tag):
+    out += tag
+    out += _U32.pack(len(value))
+    for item in value:
+        _encode_value(out, item)
+
+
+def _encode_dict(out, value):
+    if not value:
+        out += b'd\x00\x00\x00\x00'
+        return
+    items = []
+    for key, item in value.items():
+        encoded_key = bytearray()
+        _encode_value(encoded_key, key)
+        items.append((bytes(encoded_key), item))
+    items.sort(key=lambda pair: pair[0])
+
+    out += b'd'
+    out += _U32.pack(len(items))
+    for encoded_key, item in items:
+        out += encoded_key
+        _encode_value(out, item)
+
+
+def _encode_transaction(out, tx):
+    sender = tx.sender.encode(ENCODING)
+    receiver = tx.receiver.encode(ENCODING)
+    out += b'X'
+    out += _U32.pack(len(sender))
+    out += sender
+    out += _U32.pack(len(receiver))
+    out += receiver
+    for value in (tx.value, tx.data, tx.timestamp, tx.nonce):
+        # Fast path for the common small integer fields
+        if type(value) is int and _I64_MIN <= value <= _I64_MAX:
+            out += b'i'
+            out += _I64.pack(value)
+        elif value is None:
+            out += b'N'
+        else:
+            _encode_value(out, value)
+    _encode_str(out, tx.id)
+
+
+def _encode_block(out, block, with_state=True):
+    out += b'B'
+    for field in (block.height, block.parent_hash, block.miner_id, block.timestamp, block.difficulty,
+                  block.total_difficulty, block.nonce, block.state_root):
+        _encode_value(out, field)
+    out += _U32.pack(len(block.data))
+    for tx in block.data:
+        _encode_transaction(out, tx)
+    if with_state:
+        _encode_dict(out, block.state.state_variables)
+    else:
+        out += b'N'
+
+
+def _encode_value(out, value):
+    kind = type(value)
+    if kind is str:
+        out += b's'
+        _encode_str(out, value)
+    elif kind is int:
+        _encode_int(out, value)
+    elif value is None:
+        out += b'N'
+    elif kind is bool:
+        out += b'T' if value else b'F'
+    elif kind is float:
+        out += b'f'
+        out += _F64.pack(value)
+    elif kind is list:
+        _encode_sequence(out, value, b'l')
+    elif kind is tuple:
+        _encode_sequence(out, value, b't')
+    elif kind is dict or isinstance(value, Mapping):
+        _encode_dict(out, value)
+    elif kind is Transaction:
+        _encode_transaction(out, value)
+    elif kind is bytes or kind is bytearray or kind is memoryview:
+        out += b'b'
+        out += _U32.pack(len(value))
+        out += value
+    elif isinstance(value, _block_class()):
+        _encode_block(out, value)
+    elif kind is Stream:
+        streams = getattr(_context, 'streams', None)
+        if streams is None:
+            _encode_sequence(out, list(value), b'l')
+        else:
+            streams.append(value)
+            out += b'S'
+    else:
+        raise TypeError(f"Cannot encode object of type {kind.__name__}")
+
+
+def encode(value, streams=None):
+    """
+    Encodes a value (message, transaction, block, ...) prefixed by the codec version
+
+    Args:
+        streams(list): if given, receives the Streams found in the value instead of encoding their items
+    """
+    out = bytearray(_U8.pack(VERSION))
+    if streams is None:
+        _encode_value(out, value)
+    else:
+        _context.streams = streams
+        try:
+            _encode_value(out, value)
+        finally:
+            _context.streams = None
+    return bytes(out)
+
+
+def encode_block(block, with_state=True):
+    """
+    Encodes a block, without its contract state if with_state is False (the decoded block then holds
+    a fresh default state, to be replaced by the owner)
+    """
+    out = bytearray(_U8.pack(VERSION))
+    _encode_block(out, block, with_state)
+    return bytes(out)
+
+
+def encode_header(block):
+    """
+    Encoding of the block header, the block hash is computed over it
+    """
+    return encode([block.height, block.parent_hash, block.transactions_root, block.miner_id, block.timestamp,
+                   block.difficulty, block.total_difficulty, block.nonce, block.state_root])
+
+
+# Decoding
+
+def _decode_str(buf, pos):
+    size = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    return str(buf[pos:pos + size], ENCODING), pos + size
+
+
+def _decode_sequence(buf, pos, depth):
+    count = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    items = []
+    for _ in range(count):
+        item, pos = _decode_value(buf, pos, depth + 1)
+        items.append(item)
+    return items, pos
+
+
+def _decode_dict(buf, pos, depth):
+    count = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    value = {}
+    for _ in range(count):
+        key, pos = _decode_value(buf, pos, depth + 1)
+        item, pos = _decode_value(buf, pos, depth + 1)
+        try:
+            value[key] = item
+        except TypeError:
+            raise DecodeError(f"Unhashable dictionary key at offset {pos}")
+    return value, pos
+
+
+def _decode_transaction(buf, pos, depth):
+    sender, pos = _decode_str(buf, pos)
+    receiver, pos = _decode_str(buf, pos)
+    fields = []
+    for _ in range(4):
+        # Fast path for the common small integer fields
+        if buf[pos] == 0x69:  # i
+            fields.append(_I64.unpack_from(buf, pos + 1)[0])
+            pos += 9
+        else:
+            field, pos = _decode_value(buf, pos, depth + 1)
+            fields.append(field)
+    value, data, timestamp, nonce = fields
+    tx_id, pos = _decode_str(buf, pos)
+    return Transaction(sender, receiver, value, data, timestamp, nonce, tx_id), pos
+
+
+def _decode_block(buf, pos, depth):
+    fields = []
+    for _ in range(8):
+        field, pos = _decode_value(buf, pos, depth + 1)
+        fields.append(field)
+    height, parent_hash, miner_id, timestamp, difficulty, total_difficulty, nonce, state_root = fields
+
+    count = _U32.unpack_from(buf, pos)[0]
+    pos += 4
+    data = []
+    for _ in range(count):
+        if buf[pos] != 0x58:  # b'X'
+            raise DecodeError(f"Expected a transaction at offset {pos}")
+        tx, pos = _decode_transaction(buf, pos + 1, depth)
+        data.append(tx)
+
+    state_variables, pos = _decode_value(buf, pos, depth + 1)
+    try:
+        block = _block_class()(height, parent_hash, data, miner_id, timestamp, difficulty,
+                               total_difficulty - difficulty, nonce, state_var=state_variables, state_root=state_root)
+    except TypeError:
+        raise DecodeError(f"Invalid block fields {fields}")
+    return block, pos
+
+
+def _decode_value(buf, pos, depth=0):
+    if depth > MAX_DEPTH:
+        raise DecodeError(f"Values nested deeper than {MAX_DEPTH} at offset {pos}")
+    tag = buf[pos]
+    pos += 1
+    if tag == 0x73:  # s
+        return _decode_str(buf, pos)
+    elif tag == 0x69:  # i
+        return _I64.unpack_from(buf, pos)[0], pos + 8
+    elif tag == 0x4e:  # N
+        return None, pos
+    elif tag == 0x54:  # T
+        return True, pos
+    elif tag == 0x46:  # F
+        return False, pos
+    elif tag == 0x66:  # f
+        return _F64.unpack_from(buf, pos)[0], pos + 8
+    elif tag == 0x6c:  # l
+        return _decode_sequence(buf, pos, depth)
+    elif tag == 0x74:  # t
+        items, pos = _decode_sequence(buf, pos, depth)
+        return tuple(items), pos
+    elif tag == 0x64:  # d
+        return _decode_dict(buf, pos, depth)
+    elif tag == 0x58:  # X
+        return _decode_transaction(buf, pos, depth)
+    elif tag == 0x42:  # B
+        return _decode_block(buf, pos, depth)
+    elif tag == 0x49:  # I
+        size = _U16.unpack_from(buf, pos)[0]
+        pos += 2
+        return int.from_bytes(buf[pos:pos + size], 'big', signed=True), pos + size
+    elif tag == 0x62:  # b
+        size = _U32.unpack_from(buf, pos)[0]
+        pos += 4
+        return bytes(buf[pos:pos + size]), pos + size
+    elif tag == 0x53:  # S
+        streams = getattr(_context, 'streams', None)
+        if streams is None:
+            raise DecodeError(f"Unexpected stream at offset {pos - 1}")
+        items = []
+        streams.append(items)
+        return items, pos
+    raise DecodeError(f"Unknown tag {tag} at offset {pos - 1}")
+
+
+def decode(data, streams=None):
+    """
+    Decodes a buffer produced by encode
+
+    Args:
+        data(bytes, bytearray or memoryview): encoded value
+        streams(list): if given, receives the lists standing for the Streams of the value
+    """
+    buf = data if isinstance(data, memoryview) else memoryview(data)
+    if len(buf) < 2:
+        raise DecodeError("Empty message")
+    if buf[0] != VERSION:
+        raise DecodeError(f"Unsupported codec version {buf[0]}")
+    _context.streams = streams
+    try:
+        value, pos = _decode_value(buf, 1)
+    except (IndexError, StructError):
+        raise DecodeError("Truncated message")
+    except UnicodeDecodeError:
+        raise DecodeError("Invalid utf-8 string")
+    finally:
+        _context.streams = None
+    if pos != len(buf):
+        raise DecodeError(f"{len(buf) - pos} trailing bytes")
+    return value
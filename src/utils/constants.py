@@ -6,8 +6,37 @@ ENCODING = "utf-8"
 MEMPOOL_SYNC_TAG = "mempool_sync"
 CHAIN_SYNC_TAG = "chain_sync"
 BLOCK_REQUEST_TAG = "block_request"
+MEMPOOL_GET_TAG = "mempool_get"
+BLOCK_TXS_TAG = "block_txs"
+HEADERS_TAG = "headers"
+ANNOUNCE_TAG = "announce"
 
 # Options
 MEMPOOL_SYNC_INTERVAL = 20
 CHAIN_SYNC_INTERVAL = 20
+# Seconds to wait for the answer of a peer
+REQUEST_TIMEOUT = 50
+# Seconds to wait for the answer of a peer to a chain or mempool sync
+SYNC_REQUEST_TIMEOUT = 10
+# Blocks of a locator listed one by one below the tip, the following ones are exponentially sparser
+LOCATOR_DENSE = 10
+# Headers per answer to a headers request of the chain download
+HEADERS_BATCH = 500
+# Blocks per request of the chain download, and requests in flight at once, spread over the peers
+BODY_RANGE = 32
+BODY_WINDOW = 8
+# Failed block requests in a row after which a peer is no longer a source of the chain download
+BODY_FAILURES = 3
+# Block hashes and transaction short ids announced to a node that it remembers, to relay them once
+ANNOUNCE_MEMORY = 10000
+# Announcements received and waiting for the node to handle them, the next ones are dropped
+ANNOUNCE_QUEUE = 1000
+# Threads sending the background requests of the nodes of a process
+REQUEST_WORKERS = 32
+# Answer requests with an asyncio server instead of a thread per connection
+ASYNC_SERVER = False
+# Transport between nodes: "tcp" (persistent connections) or "udp" (acknowledged datagrams)
+TRANSPORT = "tcp"
 DEBUG = False
+# Collect the counters, gauges and histograms of utils/metrics.py
+METRICS = False
@@ -1,30 +1,30 @@
 from hashlib import sha256
 
 from toychain.src.Transaction import Transaction
+from toychain.src.utils.codec import encode
 
-def compute_hash(list):
+def compute_hash(_list):
     """
-    Computes the hash of all the elements contained in the list by putting them in a string
+    Computes the hash of the canonical binary encoding of all the elements contained in the list
     """
-    if len(list) < 1:
+    if len(_list) < 1:
         return
-    hash_string = ""
-    for elem in list:
-        hash_string += str(elem)
-
-    return sha256(hash_string.encode()).hexdigest()
+    return sha256(encode(list(_list))).hexdigest()
 
 
 def transaction_to_dict(transaction):
-    return vars(transaction)
+    return transaction.to_dict()
+
 
-    # return {"source": transaction.source, "destination": transaction.destination, "data": transaction.data,
-    #         "value": transaction.value, "timestamp": transaction.timestamp, "nonce": transaction.nonce,
-    #         "id": transaction.id}
+def encode_transaction(transaction):
+    """
+    Canonical encoding of a transaction, used for the leaves of the transactions Merkle tree
+    """
+    return encode(transaction)
 
 
 def dict_to_transaction(_dict):
-    return Transaction(_dict["source"], _dict["destination"], _dict["value"], _dict["data"],_dict["timestamp"], _dict["nonce"], _dict["id"])
+    return Transaction.from_dict(_dict)
 
 def block_to_list(block):
     """
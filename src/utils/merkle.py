@@ -0,0 +1,76 @@
+from hashlib import sha256
+
+# Domain separation between leaves and inner nodes (prevents passing an inner node off as a leaf)
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+EMPTY_ROOT = sha256(b'').hexdigest()
+
+
+def hash_leaf(data):
+    """
+    Hashes the canonical encoding of one element of the tree
+    """
+    return sha256(LEAF_PREFIX + data).digest()
+
+
+def hash_node(left, right):
+    return sha256(NODE_PREFIX + left + right).digest()
+
+
+def merkle_levels(leaves):
+    """
+    Builds the binary Merkle tree over a list of leaf hashes
+
+    Args:
+        leaves(list[bytes]): hashes of the leaves, see hash_leaf
+    Returns:
+        the levels of the tree, from the leaves (first) to the root (last)
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [hash_node(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            # An odd node is promoted to the next level as is
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def merkle_root(levels):
+    """
+    Returns the hex root of a tree built by merkle_levels
+    """
+    if not levels[0]:
+        return EMPTY_ROOT
+    return levels[-1][0].hex()
+
+
+def merkle_proof(levels, index):
+    """
+    Returns the inclusion proof of the leaf at the given index
+
+    The proof is the list of (sibling hash, sibling is on the left) pairs from the leaf up to the root,
+    so its size is O(log n) in the number of leaves
+    """
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append((level[sibling].hex(), sibling < index))
+        index //= 2
+    return proof
+
+
+def verify_merkle_proof(data, proof, root):
+    """
+    Checks that the element whose canonical encoding is data is included in the tree of the given root
+    """
+    node = hash_leaf(data)
+    for sibling, is_left in proof:
+        if is_left:
+            node = hash_node(bytes.fromhex(sibling), node)
+        else:
+            node = hash_node(node, bytes.fromhex(sibling))
+    return node.hex() == root
@@ -0,0 +1,225 @@
+"""
+Metrics of the nodes of a process: counters, gauges and histograms, identified by a name and labels
+
+They are off unless METRICS is set (constants.py) or enable() is called: the instrumented code then
+only checks metrics.enabled. snapshot() returns their values, prometheus_text() (or dump) formats
+them for Prometheus. The mempool size and chain height of the nodes (watch) are read at that time,
+labelled by enode as the ids of the nodes of different swarms of a process can be the same.
+
+    from toychain.src.utils import metrics
+    metrics.inc("toychain_invalid_messages_total")
+    metrics.observe("toychain_request_bytes", size, SIZE_BUCKETS, type=message_type)
+    with metrics.timer("toychain_block_production_seconds", consensus="poa"):
+        ...
+"""
+import bisect
+import contextlib
+import functools
+import threading
+import time
+import weakref
+
+from toychain.src.utils.constants import METRICS
+
+# Upper bounds of the buckets of the histograms, in seconds and in bytes
+LATENCY_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1, 5)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+enabled = METRICS
+
+_lock = threading.Lock()
+# {(name, labels): value}, labels are sorted (key, value) tuples
+_counters = {}
+_gauges = {}
+# {(name, labels): Histogram}
+_histograms = {}
+# Nodes whose mempool size and chain height are reported
+_nodes = weakref.WeakSet()
+_NODE_GAUGES = ("toychain_mempool_size", "toychain_chain_height")
+_disabled_timer = contextlib.nullcontext()
+
+
+class Histogram:
+    """
+    Number of values observed in each bucket, with their count and sum
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last one counts the values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exception):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+def timer(name, **labels):
+    """
+    Context manager observing the duration of its block in the histogram name, if the metrics are enabled
+    """
+    if not enabled:
+        return _disabled_timer
+    return _Timer(name, labels)
+
+
+def timed(name, labels=None):
+    """
+    Decorator observing the duration of the calls of a function in the histogram name, if the metrics
+    are enabled. labels(*args, **kwargs) gives the labels of a call.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start, **(labels(*args, **kwargs) if labels else {}))
+        return wrapper
+    return decorator
+
+
+def watch(node):
+    """
+    Reports the mempool size and chain height of a node, until it is unwatched or garbage collected
+    """
+    _nodes.add(node)
+
+
+def unwatch(node):
+    """
+    Stops reporting the mempool size and chain height of a node, and removes their last values
+    """
+    _nodes.discard(node)
+    with _lock:
+        for name in _NODE_GAUGES:
+            _gauges.pop(_key(name, {"enode": node.enode}), None)
+
+
+def _format(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _order(item):
+    # By name, so that the series of a metric follow each other
+    (name, labels), _ = item
+    return name, str(labels)
+
+
+def snapshot():
+    """
+    :return: {"counters": {metric: value}, "gauges": {metric: value}, "histograms": {metric: {"buckets":
+        {upper bound: count}, "sum": sum, "count": count}}}, metrics are named as in Prometheus: name{label="value"}
+    """
+    if enabled:
+        for node in list(_nodes):
+            set_gauge("toychain_mempool_size", len(node.mempool), enode=node.enode)
+            set_gauge("toychain_chain_height", node.get_block_number(), enode=node.enode)
+    with _lock:
+        counters = {_format(*key): value for key, value in sorted(_counters.items(), key=_order)}
+        gauges = {_format(*key): value for key, value in sorted(_gauges.items(), key=_order)}
+        histograms = {_format(*key): {"buckets": dict(zip(histogram.buckets + ("+Inf",), histogram.counts)),
+                                      "sum": histogram.sum, "count": histogram.count}
+                      for key, histogram in sorted(_histograms.items(), key=_order)}
+    return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+
+def prometheus_text():
+    """
+    Metrics in the Prometheus text exposition format, the buckets of the histograms are cumulative
+    """
+    values = snapshot()
+    lines = []
+    for kind, metric_type in (("counters", "counter"), ("gauges", "gauge")):
+        typed = set()
+        for metric, value in values[kind].items():
+            name = metric.split("{")[0]
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{metric} {value}")
+
+    typed = set()
+    for metric, histogram in values["histograms"].items():
+        name, _, labels = metric.partition("{")
+        labels = labels.rstrip("}")
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in histogram["buckets"].items():
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(f"{name}_bucket{{{labels + ',' if labels else ''}{le}}} {cumulative}")
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {histogram['sum']}")
+        lines.append(f"{name}_count{suffix} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    """
+    Writes the metrics in the Prometheus text format, for the textfile collector of node_exporter for instance
+    """
+    with open(path, "w") as file:
+        file.write(prometheus_text())
@@ -0,0 +1,95 @@
+"""
+Announcements: a node announces its new tip to its peers, which download the chain from it, an
+announcement in the name of another node than the one it comes from is dropped, and so are the
+announcements received once ANNOUNCE_QUEUE are waiting.
+Run with pytest from the folder containing the repository.
+"""
+import time
+
+from builders import extend
+from toychain.src.Node import Node
+from toychain.src.connections.ConnectionPool import ConnectionPool
+from toychain.src.connections.Loopback import LoopbackNetwork
+from toychain.src.consensus.ProofOfWork import ProofOfWork
+from toychain.src.utils.constants import ANNOUNCE_QUEUE, ANNOUNCE_TAG, LOCALHOST
+
+BASE_PORT = 25300
+
+
+def make_nodes(network, count=2):
+    nodes = [Node(i + 1, LOCALHOST, BASE_PORT + i, ProofOfWork(), transport=network) for i in range(count)]
+    for node in nodes:
+        node.start_tcp()
+        for peer in nodes:
+            if peer is not node:
+                node.add_peer(peer.enode)
+    return nodes
+
+
+def announcement(node, block_hash, total_difficulty):
+    handler = node.message_handler
+    return handler.construct_message([[block_hash, 1, total_difficulty], []], ANNOUNCE_TAG)
+
+
+def test_tip_announced_and_downloaded():
+    network = LoopbackNetwork()
+    first, second = make_nodes(network)
+    first.message_handler.announcer.flush()
+    tip = extend([first], first.get_block('last'), 5, 'miner')
+
+    first.message_handler.announcer.flush()
+    second.message_handler.announcer.process()
+    assert second.message_handler.download.candidates == {first.enode: tip.total_difficulty}
+
+    for _ in range(20):
+        network.step()
+        for node in (first, second):
+            node.node_server_thread.process_answers()
+            node.message_handler.announcer.process()
+            node.message_handler.download.start()
+        if second.get_block('last').hash == tip.hash:
+            break
+    assert second.get_block('last').hash == tip.hash
+
+
+def test_sender_taken_from_the_connection():
+    network = LoopbackNetwork()
+    first, second, third = make_nodes(network, 3)
+    announcer = second.message_handler.announcer
+
+    # On a loopback network, requests come with the enode of their sender
+    announcer.handle_request(announcement(third, "forged", 100), first.enode)
+    announcer.handle_request(announcement(first, "announced", 100), first.enode)
+    announcer.process()
+    assert second.message_handler.download.candidates == {first.enode: 100}
+
+    # Over TCP, the host of the enode must be the one of the connection
+    node = Node(4, LOCALHOST, BASE_PORT + 10, ProofOfWork())
+    node.start_tcp()
+    pool = ConnectionPool(5)
+    try:
+        time.sleep(0.2)
+        for sender in ["enode://5@10.0.0.5:30303", "enode://6@127.0.0.1:30303", "enode://7@127.0.0.1:99999"]:
+            message = dict(announcement(first, sender, 100), sender=sender)
+            pool.request((LOCALHOST, node.port), message)
+        node.message_handler.announcer.process()
+        assert node.message_handler.download.candidates == {"enode://6@127.0.0.1:30303": 100}
+    finally:
+        pool.close()
+        node.stop_tcp()
+
+
+def test_queue_bounded():
+    network = LoopbackNetwork()
+    first, second = make_nodes(network)
+    announcer = second.message_handler.announcer
+    for i in range(ANNOUNCE_QUEUE + 10):
+        announcer.handle_request(announcement(first, f"block{i}", i + 1), first.enode)
+    assert announcer.received.qsize() == ANNOUNCE_QUEUE
+
+    # The announcements queued are handled, the next ones are queued again
+    announcer.process()
+    assert second.message_handler.download.candidates == {first.enode: ANNOUNCE_QUEUE}
+    announcer.handle_request(announcement(first, "next", ANNOUNCE_QUEUE + 100), first.enode)
+    announcer.process()
+    assert second.message_handler.download.candidates == {first.enode: ANNOUNCE_QUEUE + 100}
@@ -0,0 +1,86 @@
+"""
+asyncio server: nodes sharing one event loop converge to the heaviest chain, and a request long to
+answer does not hold the other connections of the loop.
+Run with pytest from the folder containing the repository.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from builders import extend
+from toychain.src.Node import Node
+from toychain.src.connections.AsyncNodeServer import EventLoopThread
+from toychain.src.connections.ConnectionPool import ConnectionPool
+from toychain.src.consensus.ProofOfWork import ProofOfWork
+from toychain.src.utils.constants import LOCALHOST
+
+BASE_PORT = 25000
+COMMON_BLOCKS = 50
+# Blocks of the own fork of every node, the last one has the heaviest chain
+FORK_LENGTHS = [10, 60, 30, 80]
+SYNC_SECONDS = 60
+
+
+def test_swarm_converges():
+    consensus = ProofOfWork()
+    event_loop = EventLoopThread()
+    event_loop.start()
+    nodes = [Node(i + 1, LOCALHOST, BASE_PORT + i, consensus, event_loop=event_loop)
+             for i in range(len(FORK_LENGTHS))]
+    common = extend(nodes, nodes[0].get_block('last'), COMMON_BLOCKS, 'common')
+    for node, length in zip(nodes, FORK_LENGTHS):
+        extend([node], common, length, f'miner{node.id}')
+    heaviest = nodes[-1].get_block('last')
+
+    for node in nodes:
+        node.start_tcp()
+    try:
+        time.sleep(0.2)
+        for node in nodes:
+            for peer in nodes:
+                if peer is not node:
+                    node.add_peer(peer.enode)
+
+        start = time.time()
+        while time.time() - start < SYNC_SECONDS:
+            for node in nodes:
+                node.step()
+            if all(node.get_block('last').hash == heaviest.hash for node in nodes):
+                break
+            time.sleep(0.001)
+
+        assert all(node.get_block('last').hash == heaviest.hash for node in nodes)
+    finally:
+        for node in nodes:
+            node.stop_tcp()
+        event_loop.stop()
+
+
+def test_slow_request_spares_loop():
+    event_loop = EventLoopThread()
+    event_loop.start()
+    node = Node(1, LOCALHOST, BASE_PORT + 10, ProofOfWork(), event_loop=event_loop)
+
+    def handle_request(request, peer=None):
+        time.sleep(request["delay"])
+        return {"data": request["data"]}
+    node.message_handler.handle_request = handle_request
+
+    node.start_tcp()
+    # One pool per request, so that they do not share a connection
+    slow_pool, fast_pool = ConnectionPool(5), ConnectionPool(5)
+    address = (LOCALHOST, BASE_PORT + 10)
+    try:
+        time.sleep(0.2)
+        with ThreadPoolExecutor(1) as executor:
+            slow = executor.submit(slow_pool.request, address, {"delay": 1, "data": "slow"})
+            time.sleep(0.1)
+            start = time.time()
+            assert fast_pool.request(address, {"delay": 0, "data": "fast"}) == {"data": "fast"}
+            assert time.time() - start < 0.5
+            assert not slow.done()
+            assert slow.result() == {"data": "slow"}
+    finally:
+        slow_pool.close()
+        fast_pool.close()
+        node.stop_tcp()
+        event_loop.stop()
@@ -0,0 +1,92 @@
+"""
+On-disk block store: reading the chain backwards gives the same blocks and states as reading it
+forwards, a store whose index was flushed before its data reopens at the last complete block, and a
+node whose newest checkpoints are corrupt restores the state of its tip from an older one.
+Run with pytest from the folder containing the repository.
+"""
+import logging
+import os
+
+from builders import build_chain, funded_genesis
+from toychain.src.Node import Node
+from toychain.src.consensus.ProofOfWork import ProofOfWork
+from toychain.src.storage.BlockStore import BlockStore
+from toychain.src.storage.Checkpoint import checkpoint_path, list_checkpoints, write_checkpoint
+from toychain.src.utils.constants import LOCALHOST
+
+BASE_PORT = 25700
+HEIGHT = 250
+CHECKPOINT_INTERVAL = 20
+
+
+def test_reversed_matches_forward(tmp_path):
+    build_chain(str(tmp_path), HEIGHT, CHECKPOINT_INTERVAL)
+    store = BlockStore(str(tmp_path), cache_size=8, checkpoint_interval=CHECKPOINT_INTERVAL)
+    try:
+        forward = [(block.hash, block.state.state_hash) for block in store]
+        backward = [(block.hash, block.state.state_hash) for block in reversed(store)]
+        assert backward[::-1] == forward
+        assert [store.header(height).hash for height in range(len(store))] == [hash for hash, _ in forward]
+    finally:
+        store.close()
+
+
+def test_index_past_data_recovered(tmp_path):
+    build_chain(str(tmp_path), HEIGHT, CHECKPOINT_INTERVAL)
+    store = BlockStore(str(tmp_path), checkpoint_interval=CHECKPOINT_INTERVAL)
+    hashes = [store.block_hash(height) for height in range(len(store))]
+    store.close()
+
+    # Crash after the index was flushed, before the end of the last block was written
+    blocks = os.path.join(str(tmp_path), 'blocks.dat')
+    with open(blocks, 'r+b') as file:
+        file.truncate(os.path.getsize(blocks) - 10)
+
+    store = BlockStore(str(tmp_path), checkpoint_interval=CHECKPOINT_INTERVAL)
+    try:
+        assert len(store) == HEIGHT
+        assert store[-1].hash == hashes[-2]
+        store.restore_tip()
+        assert [block.hash for block in reversed(store)][::-1] == hashes[:-1]
+    finally:
+        store.close()
+
+
+def test_corrupt_checkpoints_skipped(tmp_path, caplog):
+    path = str(tmp_path)
+    build_chain(path, HEIGHT, CHECKPOINT_INTERVAL)
+    store = BlockStore(path, checkpoint_interval=CHECKPOINT_INTERVAL)
+    tip = store[-1]
+    balances = dict(tip.state.balances)
+    checkpoints = list_checkpoints(store.checkpoint_dir)
+    # The newest checkpoint is truncated, the one before holds the state of another block
+    previous, newest = [checkpoint_path(store.checkpoint_dir, height) for height in checkpoints[-2:]]
+    with open(newest, 'r+b') as file:
+        file.truncate(os.path.getsize(newest) // 2)
+    block = store[checkpoints[-2]]
+    block.state.balances[block.miner_id] += 1
+    write_checkpoint(store.checkpoint_dir, block)
+    store.close()
+
+    with caplog.at_level(logging.WARNING, logger='store'):
+        node = Node(1, LOCALHOST, BASE_PORT, ProofOfWork(genesis=funded_genesis()), chain_dir=path)
+    try:
+        last = node.get_block('last')
+        assert last.hash == tip.hash
+        assert dict(last.state.balances) == balances
+        assert last.state.state_hash == tip.state_root
+        assert [record.getMessage().split(",")[0] for record in caplog.records] == [
+            f"Checkpoint {checkpoints[-1]} is corrupt: Truncated message",
+            f"Checkpoint {checkpoints[-2]} does not match the stored chain"]
+    finally:
+        node.chain.close()
+
+    # The corrupt checkpoints were written again from the replayed states
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger='store'):
+        store = BlockStore(path, checkpoint_interval=CHECKPOINT_INTERVAL)
+        try:
+            assert store[-1].state.state_hash == tip.state_root
+        finally:
+            store.close()
+    assert not caplog.records
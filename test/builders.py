@@ -0,0 +1,68 @@
+"""
+Chains and blocks shared by the tests and benchmarks
+"""
+from toychain.src.Block import Block, State
+from toychain.src.Transaction import Transaction
+from toychain.src.storage.BlockStore import BlockStore
+from toychain.src.utils.helpers import gen_enode
+
+N_ROBOTS = 25
+TRANSACTIONS_PER_BLOCK = 10
+
+
+def extend(nodes, parent, length, miner):
+    """
+    Adds length blocks after parent to the chains of the nodes
+    """
+    for i in range(length):
+        transactions = [Transaction(miner, 'b', 0, timestamp=parent.height, nonce=j) for j in range(3)]
+        block = Block(parent.height + 1, parent.hash, transactions, miner, parent.timestamp + 1, 5,
+                      parent.total_difficulty, nonce=0, state=parent.state.fork())
+        block.state.apply_transactions(transactions, block)
+        block.update_state_root()
+        for node in nodes:
+            node.add_block(block)
+        parent = block
+    return parent
+
+
+def funded_genesis():
+    """
+    Genesis block of the chains of build_chain, N_ROBOTS addresses funded
+    """
+    state = State()
+    state.balances.update({gen_enode(i): 1000 for i in range(1, N_ROBOTS + 1)})
+    return Block(0, "0", [], 0, 0, 0, 0, nonce=1, state=state)
+
+
+def build_chain(path, height, checkpoint_interval):
+    """
+    Writes a chain of the given height, TRANSACTIONS_PER_BLOCK transfers per block, in a BlockStore
+    """
+    store = BlockStore(path, checkpoint_interval=checkpoint_interval)
+    block = funded_genesis()
+    store.append(block)
+    for h in range(1, height + 1):
+        data = [Transaction(gen_enode((h + i) % N_ROBOTS + 1), gen_enode((h + i + 1) % N_ROBOTS + 1), 1,
+                            timestamp=h, nonce=i) for i in range(TRANSACTIONS_PER_BLOCK)]
+        block = Block(h, block.hash, data, gen_enode(1), h, 1, block.total_difficulty, state=block.state.fork())
+        for tx in data:
+            block.state.apply_transaction(tx, block)
+        block.update_state_root()
+        store.append(block)
+    store.close()
+
+
+def make_block(size):
+    """
+    Block of size transfers after a funded genesis state
+    :return: the block and the state of its parent
+    """
+    transactions = [Transaction(gen_enode(i % N_ROBOTS + 1), gen_enode((i + 1) % N_ROBOTS + 1), i % 7,
+                                timestamp=i, nonce=i) for i in range(size)]
+    parent_state = State()
+    parent_state.balances.update({gen_enode(i): 1000 for i in range(1, N_ROBOTS + 1)})
+    block = Block(1, "0" * 64, transactions, gen_enode(1), 1, 1, 0, state=parent_state.fork())
+    block.state.apply_transactions(transactions, block)
+    block.update_state_root()
+    return block, parent_state
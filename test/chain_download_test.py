@@ -0,0 +1,108 @@
+"""
+Chain download: a node whose header source disconnects once the headers are complete finishes the
+download from another peer ahead of it, although that peer is behind the header source, and the
+blocks whose missing transactions could not be fetched are requested again.
+Run with pytest from the folder containing the repository.
+"""
+import socket
+import time
+from concurrent.futures import Future
+
+from builders import extend
+from toychain.src.Mempool import short_id
+from toychain.src.Node import Node
+from toychain.src.connections.Loopback import LoopbackNetwork
+from toychain.src.consensus.ProofOfWork import ProofOfWork
+from toychain.src.utils.constants import LOCALHOST, BLOCK_REQUEST_TAG, BLOCK_TXS_TAG, CHAIN_SYNC_INTERVAL
+
+BASE_PORT = 24700
+COMMON_BLOCKS = 100
+# Blocks of the header source after the common ones, and those the other peer has
+SOURCE_BLOCKS = 1000
+PEER_BLOCKS = 990
+SYNC_SECONDS = 60
+
+
+def step_until(nodes, condition):
+    start = time.time()
+    while time.time() - start < SYNC_SECONDS and not condition():
+        for node in nodes:
+            node.step()
+        time.sleep(0.001)
+    return condition()
+
+
+def test_header_source_disconnects():
+    consensus = ProofOfWork()
+    local, source, peer = [Node(i + 1, LOCALHOST, BASE_PORT + i, consensus) for i in range(3)]
+    common = extend([local, source, peer], local.get_block('last'), COMMON_BLOCKS, 'common')
+    tip = extend([source, peer], common, PEER_BLOCKS, 'miner')
+    extend([source], tip, SOURCE_BLOCKS - PEER_BLOCKS, 'miner')
+
+    # The block requests to the header source get no answer until it leaves
+    held = []
+
+    def submit(enode, request, timeout=None, _submit=local.node_server_thread.submit):
+        if enode == source.enode and request["type"] == BLOCK_REQUEST_TAG:
+            held.append(Future())
+            return held[-1]
+        return _submit(enode, request, timeout)
+    local.node_server_thread.submit = submit
+
+    def leave():
+        for future in held:
+            if not future.done():
+                future.set_exception(ConnectionError("peer left"))
+
+    for node in (local, source, peer):
+        node.start_tcp()
+    try:
+        time.sleep(0.2)
+        local.add_peer(source.enode)
+        download = local.message_handler.download
+        assert step_until([local, source], lambda: download.headers_complete)
+
+        assert local.get_block_number() == common.height
+        local.remove_peer(source.enode)
+        source.stop_tcp()
+        leave()
+        local.add_peer(peer.enode)
+
+        assert step_until([local, peer], lambda: local.get_block('last').hash == tip.hash)
+    finally:
+        leave()
+        for node in (local, source, peer):
+            node.stop_tcp()
+
+
+def test_lost_transactions_request_sent_again():
+    network = LoopbackNetwork()
+    consensus = ProofOfWork()
+    local, source = [Node(i + 1, LOCALHOST, BASE_PORT + 10 + i, consensus, transport=network) for i in range(2)]
+    common = extend([local, source], local.get_block('last'), 5, 'common')
+    tip = extend([source], common, 20, 'miner')
+    # The source believes that the local node holds the transactions of its blocks, they are left out
+    source.message_handler.known.add(local.enode, [short_id(tx.id) for height in range(common.height + 1, tip.height + 1)
+                                                   for tx in source.get_block(height).data])
+
+    # The first request of the missing transactions is lost
+    lost = []
+
+    def submit(enode, request, timeout=None, _submit=local.node_server_thread.submit):
+        if request["type"] == BLOCK_TXS_TAG and not lost:
+            lost.append(Future())
+            lost[-1].set_exception(socket.timeout("lost"))
+            return lost[-1]
+        return _submit(enode, request, timeout)
+    local.node_server_thread.submit = submit
+
+    for node in (local, source):
+        node.start_tcp()
+    local.add_peer(source.enode)
+    source.add_peer(local.enode)
+    for _ in range(3 * CHAIN_SYNC_INTERVAL):
+        network.step()
+        local.step()
+        source.step()
+    assert lost
+    assert local.get_block('last').hash == tip.hash
@@ -0,0 +1,64 @@
+"""
+Benchmark of the binary codec against the former pickle + str path, for blocks of 10 to 100k transactions.
+    wire:  pickle.dumps(block_to_list(block)) / Block(*create_block_from_list(pickle.loads(data)))
+           against encode(block) / decode(data)
+    hash:  sha256 of the concatenated str() of the transaction dicts against sha256 of their encoding
+"""
+import os
+import pickle
+import sys
+import time
+from hashlib import sha256
+
+# The repository folder must be importable as the 'toychain' package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from toychain.src.Block import Block, State
+from toychain.src.Transaction import Transaction
+from toychain.src.utils.codec import encode, decode
+from toychain.src.utils.helpers import block_to_list, create_block_from_list, transaction_to_dict, gen_enode
+
+BLOCK_SIZES = [10, 100, 1000, 10000, 100000]
+
+
+def str_hash(_list):
+    hash_string = ""
+    for elem in _list:
+        hash_string += str(elem)
+    return sha256(hash_string.encode()).hexdigest()
+
+
+def make_block(n_transactions):
+    state = State()
+    state.balances.update({gen_enode(i): 1000 for i in range(1, 26)})
+    data = [Transaction(gen_enode(i % 25 + 1), gen_enode((i + 1) % 25 + 1), i % 7, timestamp=i, nonce=i)
+            for i in range(n_transactions)]
+    return Block(1, sha256(b'parent').hexdigest(), data, gen_enode(1), 100, 2, 0, state=state)
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return 1000 * (time.perf_counter() - start) / repeat, result
+
+
+if __name__ == '__main__':
+    print(f"{'txs':>7} | {'pickle KB':>9} {'enc ms':>8} {'dec ms':>8} {'str-hash ms':>11} | "
+          f"{'codec KB':>8} {'enc ms':>8} {'dec ms':>8} {'hash ms':>8}")
+
+    for size in BLOCK_SIZES:
+        block = make_block(size)
+        repeat = max(1, 2000 // size)
+
+        pickle_enc, pickled = timed(lambda: pickle.dumps(block_to_list(block)), repeat)
+        pickle_dec, _ = timed(lambda: Block(*create_block_from_list(pickle.loads(pickled))), repeat)
+        str_hashing, _ = timed(lambda: str_hash([transaction_to_dict(t) for t in block.data]), repeat)
+
+        codec_enc, encoded = timed(lambda: encode(block), repeat)
+        codec_dec, decoded = timed(lambda: decode(encoded), repeat)
+        codec_hashing, _ = timed(lambda: sha256(encode(block.data)).hexdigest(), repeat)
+        assert decoded.hash == block.hash
+
+        print(f"{size:>7} | {len(pickled) / 1024:>9.1f} {pickle_enc:>8.2f} {pickle_dec:>8.2f} {str_hashing:>11.2f} | "
+              f"{len(encoded) / 1024:>8.1f} {codec_enc:>8.2f} {codec_dec:>8.2f} {codec_hashing:>8.2f}")
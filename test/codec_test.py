@@ -0,0 +1,80 @@
+"""
+Binary codec: values, transactions and blocks decode to what was encoded, and malformed buffers
+(truncated, trailing bytes, unknown tag or version, invalid text or block, unhashable keys, nested
+too deep) raise a DecodeError.
+Run with pytest from the folder containing the repository.
+"""
+from hashlib import sha256
+
+import pytest
+
+from toychain.src.Block import Block, State
+from toychain.src.Transaction import Transaction
+from toychain.src.utils.codec import DecodeError, MAX_DEPTH, Stream, VERSION, decode, encode
+from toychain.src.utils.helpers import gen_enode
+
+VALUES = [None, True, False, 0, -1, 1 << 63, -(1 << 70), 1.5, "", "été", b"\x00\xff",
+          [1, [2, "a"]], (1, None), {"b": 1, "a": [True]}, {1: "x", "k": {}}]
+
+
+def make_transaction(nonce=0):
+    return Transaction(gen_enode(1), gen_enode(2), 3, {"function": "Hello", "inputs": ["x"]}, timestamp=1,
+                       nonce=nonce)
+
+
+def test_values_round_trip():
+    for value in VALUES:
+        assert decode(encode(value)) == value
+    # Dictionaries are encoded whatever the insertion order of their keys
+    assert encode({"a": 1, "b": 2}) == encode({"b": 2, "a": 1})
+    # Without a destination for streams, their items are encoded in place
+    assert decode(encode(Stream(iter([1, 2])))) == [1, 2]
+
+
+def test_transaction_and_block_round_trip():
+    tx = make_transaction()
+    decoded = decode(encode(tx))
+    assert decoded.to_dict() == tx.to_dict()
+
+    state = State()
+    state.balances[gen_enode(1)] = 10
+    block = Block(1, sha256(b'parent').hexdigest(), [make_transaction(i) for i in range(3)], gen_enode(1), 1, 2, 0,
+                  state=state)
+    decoded = decode(encode(block))
+    assert decoded.hash == block.hash
+    assert [tx.id for tx in decoded.data] == [tx.id for tx in block.data]
+    assert decoded.state.state_variables == block.state.state_variables
+
+
+def test_nesting_limit():
+    nested = None
+    for _ in range(MAX_DEPTH):
+        nested = [nested]
+    assert decode(encode(nested)) == nested
+    with pytest.raises(DecodeError):
+        decode(encode([nested]))
+
+
+def test_malformed_rejected():
+    encoded = encode([make_transaction(), "text", 1 << 80, {"a": b"\x01"}])
+    # Every truncation of a valid message
+    for end in range(len(encoded)):
+        with pytest.raises(DecodeError):
+            decode(encoded[:end])
+
+    malformed = [
+        encoded + b'\x00',                                  # trailing byte
+        bytes([VERSION + 1]) + encoded[1:],                 # other codec version
+        bytes([VERSION]) + b'?',                            # unknown tag
+        bytes([VERSION]) + b's\x02\x00\x00\x00\xff\xfe',    # invalid utf-8
+        bytes([VERSION]) + b'S',                            # stream outside of a streamed message
+        bytes([VERSION]) + b'l\xff\xff\xff\xff',            # count past the end
+        bytes([VERSION]) + b'B' + b'N' * 8 + b'\x00' * 4 + b'N',  # block without its header fields
+        bytes([VERSION]) + b'd\x01\x00\x00\x00' + encode([1])[1:] + b'N',  # list as a dictionary key
+        bytes([VERSION]) + b'l\x01\x00\x00\x00' * 100000 + b'N',  # nested 100000 levels deep
+    ]
+    for data in malformed:
+        with pytest.raises(DecodeError):
+            decode(data)
+    with pytest.raises(TypeError):
+        encode(object())
@@ -0,0 +1,46 @@
+"""
+Bytes sent to relay one block of 100 to 1000 transactions to a peer holding 0 to 100% of them in its
+mempool: the full block against the compact block (header, short ids and the transactions the sender
+does not know the peer holds), plus the round trip for the transactions the peer misses.
+The sender is assumed to know 90% of what the peer holds.
+"""
+import os
+import sys
+
+# The repository folder must be importable as the 'toychain' package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from builders import make_block
+from toychain.src.CompactBlock import CompactBlock
+from toychain.src.utils.codec import encode
+
+BLOCK_SIZES = [100, 1000]
+HELD = [0, 0.5, 0.9, 1]
+KNOWN = 0.9
+
+
+def compact_relay(block, parent_state, held, known):
+    compact = CompactBlock.from_block(block, known)
+    size = len(encode(compact.to_list()))
+    received = CompactBlock.from_list(compact.to_list())
+    missing = received.fill(lambda short: held.get(short))
+    if missing:
+        size += len(encode([[block.height, block.hash, missing]]))
+        size += len(encode([[block.hash, [block.data[index] for index in missing]]]))
+        for index in missing:
+            received.data[index] = block.data[index]
+    assert received.to_block(parent_state).hash == block.hash
+    return size
+
+
+if __name__ == '__main__':
+    print(f"{'txs':>5} {'held':>5} | {'full KB':>8} | {'compact KB':>10}")
+    for block_size in BLOCK_SIZES:
+        block, parent_state = make_block(block_size)
+        full = len(encode(block))
+        compact = CompactBlock.from_block(block)
+        for fraction in HELD:
+            n_held = int(block_size * fraction)
+            held = {short: tx for short, tx in zip(compact.short_ids[:n_held], block.data[:n_held])}
+            known = set(compact.short_ids[:int(n_held * KNOWN)])
+            print(f"{block_size:>5} {fraction:>5.0%} | {full / 1024:>8.1f} | {compact_relay(block, parent_state, held, known) / 1024:>10.1f}")
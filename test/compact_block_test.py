@@ -0,0 +1,45 @@
+"""
+Compact blocks: the receiver rebuilds the block and its state from the state of the parent block,
+and rejects a state that does not match the state root or a malformed compact block.
+Run with pytest from the folder containing the repository.
+"""
+import pytest
+
+from builders import make_block
+from toychain.src.CompactBlock import CompactBlock
+from toychain.src.Mempool import short_id
+
+
+def test_state_rebuilt_from_parent():
+    block, parent_state = make_block(20)
+    held = {short_id(tx.id): tx for tx in block.data[:10]}
+    received = CompactBlock.from_list(CompactBlock.from_block(block, set(held)).to_list())
+    assert received.fill(held.get) == []
+
+    rebuilt = received.to_block(parent_state)
+    assert rebuilt.hash == block.hash
+    assert rebuilt.state.state_hash == block.state_root
+    assert dict(rebuilt.state.balances.items()) == dict(block.state.balances.items())
+
+    # Applied on another parent state, the state root does not match
+    other = parent_state.fork()
+    other.balances[block.miner_id] = 0
+    assert received.to_block(other) is None
+
+
+def test_malformed_rejected():
+    block, _ = make_block(20)
+    fields = CompactBlock.from_block(block, {short_id(tx.id) for tx in block.data[:10]}).to_list()
+    packed_ids, bitmap, transactions = fields[-3:]
+    malformed = [
+        fields[:-1],
+        fields[:-3] + [packed_ids[:-1], bitmap, transactions],
+        fields[:-3] + [packed_ids, bitmap[:-1], transactions],
+        fields[:-3] + [packed_ids, bitmap + b'\0', transactions],
+        fields[:-3] + [packed_ids, bytes(len(bitmap)), transactions],
+        fields[:-3] + [packed_ids, bitmap, transactions[:-1]],
+        fields[:-3] + [packed_ids, bitmap, transactions[:-1] + ["transaction"]],
+    ]
+    for compact in malformed:
+        with pytest.raises(ValueError):
+            CompactBlock.from_list(compact)
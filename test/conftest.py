@@ -0,0 +1,9 @@
+"""
+The repository folder must be importable as the 'toychain' package, and the builders of this folder
+(builders.py) importable by the tests
+"""
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+sys.path.append(os.path.dirname(__file__))
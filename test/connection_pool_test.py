@@ -0,0 +1,109 @@
+"""
+Multiplexed connections: a request giving up on its deadline leaves the connection and the other
+requests in flight on it untouched, its late answer is dropped. A malformed answer closes the
+connection, the next request opens a new one.
+Run with pytest from the folder containing the repository.
+"""
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from toychain.src.connections.ConnectionPool import ConnectionPool
+from toychain.src.connections.Framing import MORE, FrameReader, MessageAssembler, frame, send_message
+from toychain.src.utils.codec import Stream, encode
+from toychain.src.utils.constants import LOCALHOST
+
+PORT = 24800
+
+
+def serve(server):
+    """
+    Answers every request with its data after its delay, each one from its own thread, the requests
+    marked malformed with a stream whose chunk is not a list
+    """
+    while True:
+        try:
+            connection, _ = server.accept()
+        except OSError:
+            break
+        threading.Thread(target=serve_connection, args=(connection,), daemon=True).start()
+
+
+def serve_connection(connection):
+    reader = FrameReader(connection)
+    assembler = MessageAssembler()
+    lock = threading.Lock()
+
+    def answer(request_id, message):
+        time.sleep(message["delay"])
+        with lock:
+            if message.get("malformed"):
+                connection.sendall(frame(request_id, encode({"data": Stream([])}, []), MORE))
+                connection.sendall(frame(request_id, encode(5)))
+            else:
+                send_message(connection, request_id, {"data": message["data"]})
+
+    while True:
+        received = reader.read_frame()
+        if received is None:
+            break
+        complete, message = assembler.feed(*received)
+        if complete:
+            threading.Thread(target=answer, args=(received[0], message), daemon=True).start()
+    connection.close()
+
+
+def start_server(port):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((LOCALHOST, port))
+    server.listen()
+    threading.Thread(target=serve, args=(server,), daemon=True).start()
+    return server
+
+
+def test_timeout_spares_other_requests():
+    server = start_server(PORT)
+    address = (LOCALHOST, PORT)
+    pool = ConnectionPool(5)
+    try:
+        assert pool.request(address, {"delay": 0, "data": "first"}) == {"data": "first"}
+        connection = pool._connections[address]
+
+        with ThreadPoolExecutor(2) as executor:
+            slow = executor.submit(pool.request, address, {"delay": 0.6, "data": "slow"}, 0.2)
+            other = executor.submit(pool.request, address, {"delay": 0.4, "data": "other"}, 2)
+            with pytest.raises(socket.timeout):
+                slow.result()
+            assert other.result() == {"data": "other"}
+
+        # The late answer of the slow request is dropped, the connection is still the same
+        time.sleep(0.4)
+        assert pool.request(address, {"delay": 0, "data": "last"}) == {"data": "last"}
+        assert pool._connections[address] is connection and not connection.closed
+    finally:
+        pool.close()
+        server.close()
+
+
+def test_malformed_answer_closes_connection():
+    server = start_server(PORT + 1)
+    address = (LOCALHOST, PORT + 1)
+    pool = ConnectionPool(5)
+    try:
+        with pytest.raises(ConnectionResetError):
+            pool.request(address, {"delay": 0, "data": None, "malformed": True})
+        connection = pool._connections.get(address)
+        assert connection is None
+
+        # The next request does not wait for the timeout of a dead connection
+        start = time.time()
+        assert pool.request(address, {"delay": 0, "data": "next"}) == {"data": "next"}
+        assert time.time() - start < 1
+        assert not pool._connections[address].closed
+    finally:
+        pool.close()
+        server.close()
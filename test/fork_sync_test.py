@@ -0,0 +1,88 @@
+"""
+Chain sync across deep forks: the common block is found from a block locator in one round trip, and
+nodes whose chains forked hundreds of blocks ago all converge to the heaviest chain.
+Run with pytest from the folder containing the repository.
+"""
+import time
+
+from builders import extend
+from toychain.src.Node import Node
+from toychain.src.consensus.ProofOfWork import ProofOfWork
+from toychain.src.utils.constants import LOCALHOST, HEADERS_TAG, LOCATOR_DENSE
+
+BASE_PORT = 24600
+COMMON_BLOCKS = 300
+# Blocks of the own fork of every node, the last one has the heaviest chain
+FORK_LENGTHS = [40, 700, 250, 5, 900]
+SYNC_SECONDS = 60
+
+
+def test_common_block_deep_fork():
+    consensus = ProofOfWork()
+    local = Node(1, LOCALHOST, BASE_PORT, consensus)
+    peer = Node(2, LOCALHOST, BASE_PORT + 1, consensus)
+    common = extend([local, peer], local.get_block('last'), 100, 'common')
+
+    local_tip = peer_tip = common
+    for depth in [1, 10, 100, 1000, 3000]:
+        local_tip = extend([local], local_tip, depth, 'local')
+        peer_tip = extend([peer], peer_tip, depth, 'peer')
+
+        locator = local.message_handler.locator()
+        height, found = peer.message_handler.common_block(locator)
+        assert found
+        # The block found is the highest block of the locator at or below the fork
+        assert height == max(h for _, h in locator if h <= common.height)
+        if depth < LOCATOR_DENSE:
+            assert height == common.height
+        # The locator is dense near the tip and sparse below, it stays short
+        assert len(locator) < 40
+
+        # The block found is at most as far below the fork as the tip is above it, the headers
+        # between them are skipped by the node
+        assert common.height - height <= local.get_block_number() - common.height
+
+
+def test_deep_forks_converge():
+    consensus = ProofOfWork()
+    # The states of the blocks received are replayed from the common block
+    consensus.trust = False
+    nodes = [Node(i + 1, LOCALHOST, BASE_PORT + 10 + i, consensus) for i in range(len(FORK_LENGTHS))]
+    headers_requests = []
+    common = extend(nodes, nodes[0].get_block('last'), COMMON_BLOCKS, 'common')
+    for node, length in zip(nodes, FORK_LENGTHS):
+        extend([node], common, length, f'miner{node.id}')
+
+        def submit(enode, request, timeout=None, _submit=node.node_server_thread.submit):
+            if request["type"] == HEADERS_TAG:
+                headers_requests.append(request["data"][0])
+            return _submit(enode, request, timeout)
+        node.node_server_thread.submit = submit
+
+    heaviest = nodes[-1].get_block('last')
+    for node in nodes:
+        node.start_tcp()
+    try:
+        time.sleep(0.2)
+        for node in nodes:
+            for peer in nodes:
+                if peer is not node:
+                    node.add_peer(peer.enode)
+
+        start = time.time()
+        while time.time() - start < SYNC_SECONDS:
+            for node in nodes:
+                node.step()
+            if all(node.get_block('last').hash == heaviest.hash for node in nodes):
+                break
+            time.sleep(0.001)
+
+        assert all(node.get_block('last').hash == heaviest.hash for node in nodes)
+        assert common.hash == nodes[0].get_block(COMMON_BLOCKS).hash
+        # One locator per download, the other requests continue from the last header received. Every
+        # node but the heaviest downloads once, from the heaviest peer of its chain sync
+        locators = [locator for locator in headers_requests if len(locator) > 1]
+        assert len(locators) == len(nodes) - 1
+    finally:
+        for node in nodes:
+            node.stop_tcp()
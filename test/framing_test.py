@@ -0,0 +1,78 @@
+"""
+Framing: a frame longer than MAX_FRAME_SIZE is refused before its payload is allocated, the threaded
+and asyncio servers close the connection that sent it, and a connection cannot keep more than
+MAX_PARTIAL_MESSAGES streamed messages in progress.
+Run with pytest from the folder containing the repository.
+"""
+import contextlib
+import io
+import socket
+import time
+
+import pytest
+
+from toychain.src.Node import Node
+from toychain.src.connections.AsyncNodeServer import EventLoopThread
+from toychain.src.connections.Framing import BUFFER_SIZE, FRAME_HEADER, MAX_FRAME_SIZE, MAX_PARTIAL_MESSAGES, MORE, \
+    FrameReader, MessageAssembler
+from toychain.src.consensus.ProofOfWork import ProofOfWork
+from toychain.src.utils.codec import DecodeError, Stream, encode
+from toychain.src.utils.constants import LOCALHOST
+
+BASE_PORT = 25200
+
+
+def test_oversized_frame_refused():
+    sender, receiver = socket.socketpair()
+    try:
+        sender.sendall(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1, 0, 0))
+        reader = FrameReader(receiver)
+        with pytest.raises(DecodeError):
+            reader.read_frame()
+        assert len(reader.buffer) == BUFFER_SIZE
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def closed_by_server(port):
+    """
+    Whether the server closes a connection once it announced a frame over MAX_FRAME_SIZE
+    """
+    with socket.create_connection((LOCALHOST, port), timeout=5) as sock:
+        sock.sendall(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1, 0, 0))
+        return sock.recv(1) == b''
+
+
+def test_servers_close_oversized_frames():
+    event_loop = EventLoopThread()
+    event_loop.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        nodes = [Node(1, LOCALHOST, BASE_PORT, ProofOfWork()),
+                 Node(2, LOCALHOST, BASE_PORT + 1, ProofOfWork(), event_loop=event_loop)]
+        for node in nodes:
+            node.start_tcp()
+    try:
+        time.sleep(0.2)
+        for node in nodes:
+            assert closed_by_server(node.port)
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for node in nodes:
+                node.stop_tcp()
+        event_loop.stop()
+
+
+def test_partial_messages_bounded():
+    assembler = MessageAssembler()
+    head = encode({"data": Stream([])}, [])
+    for request_id in range(MAX_PARTIAL_MESSAGES):
+        assert assembler.feed(request_id, MORE, memoryview(head)) == (False, None)
+    with pytest.raises(DecodeError):
+        assembler.feed(MAX_PARTIAL_MESSAGES, MORE, memoryview(head))
+
+    # Messages completed free their place
+    assert assembler.feed(0, 0, memoryview(encode([]))) == (True, {"data": []})
+    assert assembler.feed(MAX_PARTIAL_MESSAGES, MORE, memoryview(head)) == (False, None)
+    with pytest.raises(DecodeError):
+        assembler.feed(1, 0, memoryview(encode(5)))
@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of the header hashing done on the chain synchronisation path.
+Compares the cached header hash of a sealed block with a recomputation on every call,
+which is what every CHAIN_SYNC request and block request used to cost.
+"""
+import os
+import sys
+import timeit
+
+# The repository folder must be importable as the 'toychain' package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from toychain.src.Node import Node
+from toychain.src.consensus.ProofOfAuth import ProofOfAuthority
+from toychain.src.Block import Block
+from toychain.src.Transaction import Transaction
+from toychain.src.utils.constants import LOCALHOST, CHAIN_SYNC_TAG, BLOCK_REQUEST_TAG
+from toychain.src.utils.helpers import compute_hash, gen_enode
+
+BLOCK_SIZES = [10, 100, 1000, 10000]
+REPEAT = 200
+
+
+def uncached_header_hash(block):
+    header = [block.parent_hash, block.compute_transactions_root(), block.timestamp, block.difficulty, block.nonce]
+    return compute_hash(header)
+
+
+def make_node(n_transactions):
+    consensus = ProofOfAuthority()
+    node = Node(1, LOCALHOST, 1234, consensus)
+    genesis = node.get_block('first')
+    data = [Transaction(gen_enode(1), gen_enode(2), 0, timestamp=i, nonce=i) for i in range(n_transactions)]
+    block = Block(1, genesis.hash, data, gen_enode(1), 100, 1, genesis.total_difficulty, state=genesis.state)
+    node.chain.append(block)
+    return node
+
+
+def sync_path(node, header_hash):
+    """
+    Hashing work of one sync interval with one peer: answer a CHAIN_SYNC request,
+    compare the answer and search the common block of a block request
+    """
+    last_block = node.get_block('last')
+    answer = (header_hash(last_block), last_block.total_difficulty)
+    assert answer == (header_hash(last_block), last_block.total_difficulty)
+    return [header_hash(block) for block in node.chain[-5:]]
+
+
+if __name__ == '__main__':
+    print(f"{'txs/block':>10} {'uncached (ms)':>15} {'cached (ms)':>13} {'speedup':>9}")
+    for size in BLOCK_SIZES:
+        node = make_node(size)
+        handler = node.message_handler
+
+        # Sanity check: both paths agree and the real handlers answer from the cache
+        assert uncached_header_hash(node.get_block('last')) == node.get_block('last').get_header_hash()
+        handler.handle_request(handler.construct_message("", CHAIN_SYNC_TAG))
+        handler.handle_request(handler.construct_message([(node.get_block('last').get_header_hash(), 1)], BLOCK_REQUEST_TAG))
+
+        uncached = timeit.timeit(lambda: sync_path(node, uncached_header_hash), number=REPEAT)
+        cached = timeit.timeit(lambda: sync_path(node, Block.get_header_hash), number=REPEAT)
+        print(f"{size:>10} {1000 * uncached / REPEAT:>15.3f} {1000 * cached / REPEAT:>13.4f} {uncached / cached:>8.0f}x")
@@ -0,0 +1,97 @@
+"""
+Benchmark of a swarm of Proof-of-Authority nodes stepped in one process: time per round of Node.step
+of all the nodes over TCP sockets against the in-memory LoopbackNetwork, and against a Simulator that
+only steps the nodes with something to do (node steps), and whether the nodes agree on the chain at
+the end. Every node has PEERS random peers and transactions are sent by the nodes in turn, as robots
+of a simulation would, or none at all: the nodes then only sync periodically with their peers.
+"""
+import contextlib
+import io
+import logging
+import os
+import random
+import sys
+import time
+
+# The repository folder must be importable as the 'toychain' package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from toychain.src.Block import Block, State
+from toychain.src.Node import Node
+from toychain.src.Simulator import Simulator
+from toychain.src.Transaction import Transaction
+from toychain.src.connections.Loopback import LoopbackNetwork
+from toychain.src.consensus.ProofOfAuth import ProofOfAuthority
+from toychain.src.utils.constants import LOCALHOST
+from toychain.src.utils.helpers import gen_enode
+
+# (transport, nodes, a transaction is sent every ... rounds, None for no transactions)
+SWARMS = [("tcp", 25, 3), ("tcp", 50, 3), ("loopback", 50, 3), ("loopback", 1000, 3), ("simulator", 50, 3),
+          ("simulator", 1000, 3), ("loopback", 1000, None), ("simulator", 1000, None)]
+ROUNDS = 300
+PEERS = 8
+# Every swarm listens on its own ports, those of the previous one may not be released yet
+BASE_PORT = 25000
+
+
+def swarm(transport, size, base_port):
+    signers = [gen_enode(i, port=base_port + i) for i in range(1, size + 1)]
+    state = State()
+    state.balances.update({signer: 1000 for signer in signers})
+    consensus = ProofOfAuthority(genesis=Block(0, 0000, [], signers, 0, 0, 0, nonce=1, state=state))
+
+    if transport == "simulator":
+        network = Simulator()
+        nodes = [network.add_node(i, LOCALHOST, base_port + i, consensus) for i in range(1, size + 1)]
+        network.start()
+    else:
+        network = LoopbackNetwork() if transport == "loopback" else None
+        nodes = [Node(i, LOCALHOST, base_port + i, consensus, transport=network or transport) for i in range(1, size + 1)]
+        for node in nodes:
+            node.start_tcp()
+            node.start_mining()
+        time.sleep(0.2)
+
+    generator = random.Random(0)
+    for node in nodes:
+        for peer in generator.sample(nodes, PEERS):
+            if peer is not node:
+                node.add_peer(peer.enode)
+                peer.add_peer(node.enode)
+    return network, nodes
+
+
+def run(transport, size, transaction_interval, base_port):
+    network, nodes = swarm(transport, size, base_port)
+    try:
+        start = time.perf_counter()
+        for step in range(ROUNDS):
+            if not isinstance(network, Simulator):
+                for node in nodes:
+                    node.step()
+            if network is not None:
+                network.step()
+            if transaction_interval and step % transaction_interval == 0:
+                sender, receiver = nodes[step % size], nodes[(step + 1) % size]
+                sender.send_transaction(Transaction(sender.enode, receiver.enode, 1, timestamp=step, nonce=step))
+        elapsed = time.perf_counter() - start
+    finally:
+        for node in nodes:
+            node.stop_tcp()
+
+    node_steps = network.node_steps if isinstance(network, Simulator) else ROUNDS * size
+    height = min(node.get_block_number() for node in nodes)
+    agreed = len({node.get_block(height).hash for node in nodes}) == 1
+    return 1000 * elapsed / ROUNDS, 1e6 * elapsed / ROUNDS / size, node_steps, height, agreed
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)
+    print(f"{ROUNDS} rounds, {PEERS} peers per node")
+    print(f"{'transport':>9} {'nodes':>6} {'tx every':>8} | {'ms/round':>9} {'us/node':>8} {'node steps':>10} | "
+          f"{'height':>6} {'agreed':>6}")
+    for i, (transport, size, transaction_interval) in enumerate(SWARMS):
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = run(transport, size, transaction_interval, BASE_PORT + 1000 * i)
+        print(f"{transport:>9} {size:>6} {str(transaction_interval or '-'):>8} | {result[0]:>9.2f} {result[1]:>8.1f} "
+              f"{result[2]:>10} | {result[3]:>6} {str(result[4]):>6}")
@@ -0,0 +1,91 @@
+"""
+Loopback transport: requests, sent in the background or blocking, are answered after the latency of
+the network each way, lost with its loss probability (the same ones for a same seed) and fail after
+their timeout, counted in steps.
+Run with pytest from the folder containing the repository.
+"""
+import contextlib
+import io
+import socket
+
+import pytest
+
+from toychain.src.Node import Node
+from toychain.src.connections.Loopback import LoopbackNetwork
+from toychain.src.consensus.ProofOfWork import ProofOfWork
+from toychain.src.utils.constants import CHAIN_SYNC_TAG, LOCALHOST
+
+BASE_PORT = 25500
+LATENCY = 3
+TIMEOUT = 20
+
+
+def make_nodes(network):
+    with contextlib.redirect_stdout(io.StringIO()):
+        nodes = [Node(i + 1, LOCALHOST, BASE_PORT + i, ProofOfWork(), transport=network) for i in range(2)]
+        for node in nodes:
+            node.start_tcp()
+    return nodes
+
+
+def chain_sync(sender, receiver):
+    return sender.message_handler.construct_message("", CHAIN_SYNC_TAG, receiver.enode)
+
+
+def test_latency_each_way():
+    network = LoopbackNetwork(latency=LATENCY)
+    first, second = make_nodes(network)
+    server = first.node_server_thread
+
+    future = server.submit(second.enode, chain_sync(first, second), TIMEOUT)
+    for _ in range(2 * LATENCY - 1):
+        network.step()
+        assert not future.done()
+    network.step()
+    assert future.result()["sender"] == second.enode
+    assert server.answers.get_nowait() == (second.enode, future)
+
+    # A blocking request steps the network until its answer, which is not queued
+    start = network.timer.time()
+    server.send_request(second.enode, chain_sync(first, second))
+    assert network.timer.time() - start == 2 * LATENCY
+    assert server.answers.empty()
+
+
+def test_lost_requests_fail_after_their_timeout():
+    network = LoopbackNetwork(latency=LATENCY, loss=1)
+    first, second = make_nodes(network)
+    server = first.node_server_thread
+
+    future = server.submit(second.enode, chain_sync(first, second), TIMEOUT)
+    for _ in range(TIMEOUT):
+        assert not future.done()
+        network.step()
+    assert isinstance(future.exception(), socket.timeout)
+
+    start = network.timer.time()
+    with pytest.raises(socket.timeout):
+        network.request(server, second.enode, chain_sync(first, second), TIMEOUT)
+    assert network.timer.time() - start == TIMEOUT
+    with pytest.raises(ConnectionRefusedError):
+        network.request(server, "enode://3@127.0.0.1:1", chain_sync(first, second), TIMEOUT)
+
+
+def outcomes(seed):
+    network = LoopbackNetwork(latency=1, loss=0.5, seed=seed)
+    first, second = make_nodes(network)
+    answered = []
+    for _ in range(50):
+        try:
+            network.request(first.node_server_thread, second.enode, chain_sync(first, second), TIMEOUT)
+            answered.append(True)
+        except socket.timeout:
+            answered.append(False)
+    return answered
+
+
+def test_losses_repeat_with_the_seed():
+    answered = outcomes(1)
+    assert outcomes(1) == answered
+    # Each way, half of the messages are lost
+    assert 0 < answered.count(True) < len(answered) / 2
@@ -0,0 +1,64 @@
+"""
+Bandwidth of one mempool sync between two nodes, for mempools of 100 to 10k transactions differing by
+0 to 100 transactions: the former full transfer of the peer mempool against the reconciliation
+(digest, sketch or inventory of short ids if the digests differ, then only the missing transactions).
+Sizes are the encoded request and answer messages, as sent on the wire.
+"""
+import os
+import sys
+
+# The repository folder must be importable as the 'toychain' package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from toychain.src.Mempool import Mempool, SKETCH_CELLS, SKETCH_GROWTH
+from toychain.src.Transaction import Transaction
+from toychain.src.utils.codec import encode
+from toychain.src.utils.helpers import gen_enode
+
+POOL_SIZES = [100, 1000, 10000]
+DIFFERENCES = [0, 10, 100]
+N_ROBOTS = 25
+
+
+def message(data, msg_type, receiver=None):
+    return {"type": msg_type, "receiver": receiver, "sender": gen_enode(1), "data": data}
+
+
+def full_sync(local, peer):
+    return len(encode(message("", "mempool_sync"))) + len(encode(message(list(peer.values()), "mempool_sync")))
+
+
+def reconciliation(local, peer):
+    cells = SKETCH_CELLS
+    size = 0
+    while True:
+        size += len(encode(message([local.digest, cells], "mempool_sync")))
+        answer = None if local.digest == peer.digest else peer.reconcile(cells)
+        size += len(encode(message(answer, "mempool_sync")))
+        if answer is None:
+            return size
+        kind, content = answer
+        if kind == "inventory":
+            missing = local.missing(content)
+            break
+        missing = local.missing_from_sketch(content)
+        if missing is not None:
+            break
+        cells *= SKETCH_GROWTH
+
+    if missing:
+        size += len(encode(message(missing, "mempool_get")))
+        size += len(encode(message(peer.get_short(missing), "mempool_get")))
+    return size
+
+
+if __name__ == '__main__':
+    print(f"{'pool':>6} {'diff':>5} | {'full KB':>8} | {'reconciliation KB':>17}")
+    for pool_size in POOL_SIZES:
+        transactions = [Transaction(gen_enode(i % N_ROBOTS + 1), gen_enode((i + 1) % N_ROBOTS + 1), i % 7,
+                                    timestamp=i, nonce=i) for i in range(pool_size)]
+        for difference in DIFFERENCES:
+            peer = Mempool({tx.id: tx for tx in transactions})
+            local = Mempool({tx.id: tx for tx in transactions[difference:]})
+            print(f"{pool_size:>6} {difference:>5} | {full_sync(local, peer) / 1024:>8.1f} | "
+                  f"{reconciliation(local, peer) / 1024:>17.1f}")
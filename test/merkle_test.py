@@ -0,0 +1,57 @@
+"""
+Merkle transactions root: the proof of every transaction of a block verifies against the root of its
+header, and proofs of another transaction, another block, altered or truncated are rejected.
+Run with pytest from the folder containing the repository.
+"""
+from hashlib import sha256
+
+from toychain.src.Block import Block, State
+from toychain.src.Transaction import Transaction
+from toychain.src.utils.helpers import encode_transaction, gen_enode
+from toychain.src.utils.merkle import EMPTY_ROOT, hash_leaf, merkle_levels, verify_merkle_proof
+
+# Odd sizes promote a node at some level
+SIZES = [1, 2, 3, 5, 8, 13]
+
+
+def make_block(size, value=1):
+    data = [Transaction(gen_enode(1), gen_enode(2), value, timestamp=i, nonce=i) for i in range(size)]
+    return Block(1, sha256(b'parent').hexdigest(), data, gen_enode(1), 1, 2, 0, state=State())
+
+
+def test_proofs_verify():
+    assert make_block(0).transactions_root == EMPTY_ROOT
+    for size in SIZES:
+        block = make_block(size)
+        for transaction in block.data:
+            proof = block.get_transaction_proof(transaction.id)
+            assert len(proof) <= size.bit_length()
+            assert Block.verify_transaction_proof(transaction, proof, block.transactions_root)
+    assert make_block(3).get_transaction_proof('unknown') is None
+
+
+def test_invalid_proofs_rejected():
+    for size in SIZES[1:]:
+        block = make_block(size)
+        root = block.transactions_root
+        first, last = block.data[0], block.data[-1]
+        proof = block.get_transaction_proof(first.id)
+
+        # Proof of another transaction, or against the root of another block
+        assert not Block.verify_transaction_proof(last, proof, root)
+        assert not Block.verify_transaction_proof(first, proof, make_block(size, value=2).transactions_root)
+        # Transaction altered, proof truncated or with a sibling on the wrong side
+        altered = Transaction(first.sender, first.receiver, first.value + 1, timestamp=first.timestamp,
+                              nonce=first.nonce, id=first.id)
+        assert not Block.verify_transaction_proof(altered, proof, root)
+        assert not Block.verify_transaction_proof(first, proof[:-1], root)
+        flipped = [(sibling, not is_left) for sibling, is_left in proof]
+        assert not Block.verify_transaction_proof(first, flipped, root)
+
+
+def test_inner_node_not_a_leaf():
+    block = make_block(4)
+    levels = merkle_levels([hash_leaf(encode_transaction(t)) for t in block.data])
+    # The children of an inner node do not pass for a leaf, the proof of their parent being the rest of the tree
+    right = levels[1][1]
+    assert not verify_merkle_proof(levels[0][0] + levels[0][1], [(right.hex(), False)], block.transactions_root)
@@ -0,0 +1,70 @@
+"""
+Malformed messages: requests whose data does not have the expected shape, or with negative heights
+and indexes, are not answered, and an answer that cannot be handled does not stop the answers
+queued after it.
+Run with pytest from the folder containing the repository.
+"""
+from concurrent.futures import Future
+
+from toychain.src.Block import Block, State
+from toychain.src.Node import Node
+from toychain.src.Transaction import Transaction
+from toychain.src.consensus.ProofOfAuth import ProofOfAuthority
+from toychain.src.utils.constants import LOCALHOST, MEMPOOL_SYNC_TAG, MEMPOOL_GET_TAG, BLOCK_REQUEST_TAG, \
+    BLOCK_TXS_TAG, HEADERS_TAG, ANNOUNCE_TAG
+from toychain.src.utils.helpers import gen_enode
+
+BASE_PORT = 24900
+
+
+def make_node():
+    enodes = [gen_enode(i + 1, port=BASE_PORT + i) for i in range(2)]
+    state = State()
+    state.balances.update({enode: 1000 for enode in enodes})
+    consensus = ProofOfAuthority(genesis=Block(0, 0000, [], enodes, 0, 0, 0, nonce=1, state=state))
+    node = Node(1, LOCALHOST, BASE_PORT, consensus)
+    parent = node.get_block('last')
+    transactions = [Transaction(enodes[0], enodes[1], 1, timestamp=1, nonce=i) for i in range(3)]
+    block = Block(1, parent.hash, transactions, enodes[0], 1, 1, parent.total_difficulty, state=parent.state.fork())
+    block.state.apply_transactions(transactions, block)
+    block.update_state_root()
+    node.add_block(block)
+    return node, enodes[1]
+
+
+def test_malformed_requests_not_answered():
+    node, peer = make_node()
+    handler = node.message_handler
+    block = node.get_block('last')
+
+    def request(msg_type, data):
+        return handler.handle_request(dict(handler.construct_message(data, msg_type, peer), sender=peer))
+
+    malformed = [
+        (MEMPOOL_SYNC_TAG, None), (MEMPOOL_SYNC_TAG, [1]), (MEMPOOL_SYNC_TAG, [1, -3]),
+        (MEMPOOL_GET_TAG, [[1]]), (ANNOUNCE_TAG, [[None], []]), (ANNOUNCE_TAG, [None, [[1]]]),
+        (HEADERS_TAG, [[("hash", -1)], 10]), (HEADERS_TAG, ["locator", 10]),
+        (BLOCK_REQUEST_TAG, [-1, block.hash, 1]), (BLOCK_REQUEST_TAG, [1, block.hash]),
+        (BLOCK_TXS_TAG, [[1, block.hash, [-1]]]), (BLOCK_TXS_TAG, [[1, block.hash, 0]]),
+    ]
+    for msg_type, data in malformed:
+        assert request(msg_type, data) is None, (msg_type, data)
+
+    answer = request(BLOCK_TXS_TAG, [[1, block.hash, [0, 3]], [1, block.hash, [2]]])
+    assert answer["data"] == [[block.hash, None], [block.hash, [block.data[2]]]]
+    assert request(BLOCK_REQUEST_TAG, [1, block.hash, 1])["data"][0] == 1
+    assert request(MEMPOOL_SYNC_TAG, [node.mempool.digest, 48])["data"] is None
+
+
+def test_malformed_answer_spares_the_next_ones():
+    node, peer = make_node()
+    handler = node.message_handler
+    server = node.node_server_thread
+    transaction = Transaction(peer, node.enode, 1, timestamp=2, nonce=0)
+    for data, msg_type in [(["sketch"], MEMPOOL_SYNC_TAG), ([transaction], MEMPOOL_GET_TAG)]:
+        future = Future()
+        future.set_result(dict(handler.construct_message(data, msg_type, node.enode), sender=peer))
+        server.answers.put((peer, future))
+
+    server.process_answers()
+    assert transaction.id in node.mempool
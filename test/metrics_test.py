@@ -0,0 +1,108 @@
+"""
+Metrics of the nodes: nothing is recorded while they are disabled, and once enabled the requests,
+answers, chain syncs and block productions of a simulated swarm are counted and exported in the
+Prometheus text format. Messages of unknown types share one label.
+Run with pytest from the folder containing the repository.
+"""
+import contextlib
+import io
+
+from toychain.src.Block import Block, State
+from toychain.src.Simulator import Simulator
+from toychain.src.Transaction import Transaction
+from toychain.src.consensus.ProofOfAuth import ProofOfAuthority
+from toychain.src.utils import metrics
+from toychain.src.utils.constants import LOCALHOST
+from toychain.src.utils.helpers import gen_enode
+
+BASE_PORT = 26500
+NODES = 5
+
+
+def simulate(steps, stop=True):
+    enodes = [gen_enode(i + 1, port=BASE_PORT + i) for i in range(NODES)]
+    state = State()
+    state.balances.update({enode: 1000 for enode in enodes})
+    consensus = ProofOfAuthority(genesis=Block(0, 0000, [], enodes, 0, 0, 0, nonce=1, state=state))
+    simulator = Simulator(latency=1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        nodes = [simulator.add_node(i + 1, LOCALHOST, BASE_PORT + i, consensus) for i in range(NODES)]
+        for node in nodes:
+            for peer in nodes:
+                if peer is not node:
+                    node.add_peer(peer.enode)
+        simulator.start()
+        for step in range(steps):
+            simulator.step()
+            if step % 10 == 0:
+                sender = nodes[step % NODES]
+                sender.send_transaction(Transaction(sender.enode, enodes[0], 1, timestamp=step, nonce=step))
+        if stop:
+            simulator.stop()
+    return simulator, nodes
+
+
+def test_disabled_records_nothing():
+    metrics.reset()
+    metrics.enable(False)
+    simulate(200)
+    values = metrics.snapshot()
+    assert not values["counters"] and not values["gauges"] and not values["histograms"]
+
+
+def test_swarm_metrics():
+    metrics.reset()
+    metrics.enable()
+    try:
+        _, nodes = simulate(400)
+        values = metrics.snapshot()
+    finally:
+        metrics.enable(False)
+
+    histograms = values["histograms"]
+    requests = histograms['toychain_request_seconds{type="chain_sync"}']
+    assert requests["count"] > 0 and sum(requests["buckets"].values()) == requests["count"]
+    assert histograms['toychain_answer_seconds{type="mempool_sync"}']["count"] > 0
+    assert histograms["toychain_block_production_seconds"]["count"] > 0
+    assert histograms["toychain_sync_chain_seconds"]["count"] > 0
+    assert histograms["toychain_verify_chain_seconds"]["count"] > 0
+    assert histograms["toychain_apply_transactions_seconds"]["count"] > 0
+    text = metrics.prometheus_text()
+    assert "# TYPE toychain_request_seconds histogram" in text
+    assert f'toychain_request_seconds_count{{type="chain_sync"}} {requests["count"]}' in text
+    assert f'toychain_request_seconds_bucket{{type="chain_sync",le="+Inf"}} {requests["count"]}' in text
+
+    # The nodes stopped are no longer reported, those of a running swarm are, by enode
+    assert not any(node.enode in metric for metric in values["gauges"] for node in nodes)
+
+    metrics.enable()
+    try:
+        simulator, nodes = simulate(100, stop=False)
+        values = metrics.snapshot()
+    finally:
+        metrics.enable(False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator.stop()
+    for node in nodes:
+        assert values["gauges"][f'toychain_chain_height{{enode="{node.enode}"}}'] == node.get_block_number()
+        assert values["gauges"][f'toychain_mempool_size{{enode="{node.enode}"}}'] == len(node.mempool)
+
+
+def test_unknown_types_share_a_label():
+    metrics.reset()
+    metrics.enable()
+    try:
+        _, nodes = simulate(0)
+        handler = nodes[0].message_handler
+        for kind in ["junk1", "junk2", "junk3", [1], {"a": 1}, None]:
+            message = handler.construct_message(None, kind, nodes[0].enode)
+            assert handler.handle_request(message) is None
+            handler.handle_answer(message)
+        handler.handle_request(["not", "a", "message"])
+        values = metrics.snapshot()
+    finally:
+        metrics.enable(False)
+
+    for name in ["toychain_request_seconds", "toychain_answer_seconds"]:
+        series = [key for key in values["histograms"] if key.startswith(name)]
+        assert series == [f'{name}{{type="unknown"}}']
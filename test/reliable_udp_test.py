@@ -0,0 +1,152 @@
+"""
+Reliable UDP transport: lost chunks are sent again, chunks received out of order or twice give the
+message once, an answer is only taken from the peer requested, and requests complete over lossy links.
+Chunks announcing too many chunks, or another count than their message, are dropped, and messages
+left incomplete are forgotten under steady traffic.
+Run with pytest from the folder containing the repository.
+"""
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from toychain.src.connections.ReliableUDP import ReliableUDP, PACKET_HEADER, MESSAGE_HEADER, CHUNK_SIZE, \
+    MAX_CHUNKS, PURGE_INTERVAL, DATA, REQUEST, ANSWER
+from toychain.src.utils.codec import encode
+from toychain.src.utils.constants import LOCALHOST
+
+BASE_PORT = 25100
+TIMEOUT = 10
+
+
+class Endpoints:
+    """
+    UDP endpoints serving on their own threads, the requests are answered with their data
+    """
+
+    def __init__(self, count, loss=0, timeout=TIMEOUT):
+        self.requests = []
+        self.terminate = threading.Event()
+        self.endpoints = [ReliableUDP(LOCALHOST, BASE_PORT + i, self.handle, timeout, loss=loss) for i in range(count)]
+        self.addresses = [endpoint.sock.getsockname() for endpoint in self.endpoints]
+        self.threads = [threading.Thread(target=endpoint.serve, args=(self.terminate,), daemon=True)
+                        for endpoint in self.endpoints]
+        for thread in self.threads:
+            thread.start()
+
+    def handle(self, request, address):
+        self.requests.append(request)
+        return request
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        # The ports are free once the threads reading them are done
+        self.terminate.set()
+        for thread in self.threads:
+            thread.join()
+        for endpoint in self.endpoints:
+            endpoint.stop()
+
+
+def chunks(message_id, kind, data):
+    message = MESSAGE_HEADER.pack(0, kind) + encode(data)
+    parts = [message[i:i + CHUNK_SIZE] for i in range(0, len(message), CHUNK_SIZE)]
+    return [PACKET_HEADER.pack(DATA, message_id, seq, len(parts), 0) + part for seq, part in enumerate(parts)]
+
+
+def feed(endpoint, address, packet):
+    header = PACKET_HEADER.unpack_from(packet)
+    endpoint._handle_data(address, *header[1:], packet[PACKET_HEADER.size:])
+
+
+def test_lost_chunk_sent_again():
+    with Endpoints(2) as endpoints:
+        client, server = endpoints.endpoints
+        # The first transmission of every chunk of the request after the first one is lost
+        sent = []
+        _sendto = client._sendto
+
+        def sendto(data, address):
+            kind, _, seq, _, _ = PACKET_HEADER.unpack_from(data)
+            if kind == DATA:
+                sent.append(seq)
+                if seq > 0 and sent.count(seq) == 1:
+                    return
+            _sendto(data, address)
+        client._sendto = sendto
+
+        data = os.urandom(10 * CHUNK_SIZE)
+        assert client.request(endpoints.addresses[1], data) == data
+        count = len(set(sent))
+        assert count > 10 and all(sent.count(seq) >= 2 for seq in range(1, count))
+
+
+def test_out_of_order_and_duplicates():
+    with Endpoints(2) as endpoints:
+        server = endpoints.endpoints[1]
+        data = os.urandom(20 * CHUNK_SIZE)
+        packets = chunks(7, REQUEST, data)
+        shuffled = packets[:]
+        random.Random(1).shuffle(shuffled)
+
+        for packet in shuffled + packets:
+            feed(server, endpoints.addresses[0], packet)
+        # The chunks sent again once the message is complete are only acknowledged
+        time.sleep(0.2)
+        assert endpoints.requests == [data]
+
+
+def test_answer_from_requested_peer_only():
+    with Endpoints(3) as endpoints:
+        client = endpoints.endpoints[0]
+        server_address, other_address = endpoints.addresses[1:]
+        # Request 0 of the client was sent to the server, the other peer answers it first
+        future = Future()
+        client._pending[(server_address, 0)] = future
+        for packet in chunks(1, ANSWER, "forged"):
+            feed(client, other_address, packet)
+        assert not future.done()
+        for packet in chunks(1, ANSWER, "answer"):
+            feed(client, server_address, packet)
+        assert future.done()
+
+
+def test_round_trip_over_lossy_link():
+    random.seed(1)
+    with Endpoints(2, loss=0.2) as endpoints:
+        client = endpoints.endpoints[0]
+        for size in [10, 5 * CHUNK_SIZE, 100 * CHUNK_SIZE]:
+            data = os.urandom(size)
+            assert client.request(endpoints.addresses[1], data) == data
+        assert len(endpoints.requests) == 3
+
+
+def test_chunk_counts_checked():
+    with Endpoints(2) as endpoints:
+        server = endpoints.endpoints[1]
+        address = endpoints.addresses[0]
+        server._handle_data(address, 1, 0, MAX_CHUNKS + 1, 0, b'x')
+        server._handle_data(address, 2, 5, 5, 0, b'x')
+        assert not server._incoming
+
+        # The count of the first chunk of a message holds for the next ones
+        server._handle_data(address, 3, 0, 4, 0, b'x')
+        server._handle_data(address, 3, 1, 1 << 20, 0, b'x')
+        assert list(server._incoming[(address, 3)].chunks) == [0]
+
+
+def test_incomplete_messages_forgotten():
+    with Endpoints(2, timeout=0.2) as endpoints:
+        client, server = endpoints.endpoints
+        server._handle_data(("127.0.0.1", 1), 1, 0, 4, 0, b'x')
+        assert server._incoming
+
+        # The server keeps receiving, its socket never waits long enough to time out
+        start = time.time()
+        while time.time() - start < 2 * PURGE_INTERVAL + 0.5:
+            client._sendto(PACKET_HEADER.pack(DATA, 9, 0, 2, 0), endpoints.addresses[1])
+            time.sleep(0.05)
+        assert not any(address == ("127.0.0.1", 1) for address, _ in server._incoming)
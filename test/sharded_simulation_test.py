@@ -0,0 +1,121 @@
+"""
+Sharded simulation: a swarm of Proof-of-Authority nodes split over processes ends with the same
+chains, mempools and logs as when it is stepped in a single process, with latency and losses, and
+the death of the process of a shard stops the simulation with an error naming the shard.
+Run with pytest from the folder containing the repository, or as a script to time the shards.
+"""
+import contextlib
+import io
+import logging
+import os
+import random
+import sys
+import time
+
+import pytest
+
+# The repository folder must be importable as the 'toychain' package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from toychain.src.Block import Block, State
+from toychain.src.ShardedSimulator import Scenario, ShardedSimulator
+from toychain.src.Transaction import Transaction
+from toychain.src.consensus.ProofOfAuth import ProofOfAuthority
+from toychain.src.utils.constants import LOCALHOST
+from toychain.src.utils.helpers import gen_enode
+
+BASE_PORT = 26000
+PEERS = 5
+
+
+class Swarm(Scenario):
+    """
+    Nodes with PEERS random peers each, a transaction is sent every transaction_interval steps by the nodes in turn
+    """
+
+    def __init__(self, size, transaction_interval=7):
+        self.size = size
+        self.transaction_interval = transaction_interval
+        self.enodes = [gen_enode(i + 1, port=BASE_PORT + i) for i in range(size)]
+        state = State()
+        state.balances.update({enode: 1000 for enode in self.enodes})
+        self.consensus = ProofOfAuthority(genesis=Block(0, 0000, [], self.enodes, 0, 0, 0, nonce=1, state=state))
+
+        generator = random.Random(0)
+        self.links = {index: set() for index in range(size)}
+        for index in range(size):
+            for peer in generator.sample(range(size), PEERS):
+                if peer != index:
+                    self.links[index].add(peer)
+                    self.links[peer].add(index)
+
+    def create_node(self, simulator, index):
+        return simulator.add_node(index + 1, LOCALHOST, BASE_PORT + index, self.consensus)
+
+    def peers(self, index):
+        return sorted(self.links[index])
+
+    def control(self, nodes, time):
+        index = time // self.transaction_interval % self.size
+        if time % self.transaction_interval == 0 and index in nodes:
+            sender = nodes[index]
+            sender.send_transaction(Transaction(sender.enode, self.enodes[(index + 1) % self.size], 1,
+                                                timestamp=time, nonce=time, id=f"{time}"))
+
+    def result(self, node):
+        return [block.hash for block in node.chain], sorted(node.mempool.keys())
+
+
+def simulate(size, steps, shards, latency=3, loss=0.1):
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator = ShardedSimulator(Swarm(size), shards, latency, loss, seed=1)
+        simulator.start()
+        simulator.run(steps)
+        simulator.stop()
+    return simulator
+
+
+def test_shards_match_single_process():
+    single = simulate(30, 1500, 1)
+    sharded = simulate(30, 1500, 3)
+    assert sharded.remote_events > 0
+    assert sharded.node_steps == single.node_steps
+    assert sharded.results == single.results
+    assert min(len(chain) for chain, _ in single.results.values()) > 5
+
+
+def logs(shards):
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator = ShardedSimulator(Swarm(12), shards, latency=2, log_level=logging.INFO)
+        simulator.start()
+        simulator.run(600)
+        simulator.stop()
+    return simulator.logs
+
+
+def test_logs_identical_to_single_process():
+    merged = logs(2)
+    times = [record[0] for record in merged]
+    assert times and times == sorted(times)
+    assert merged == logs(1)
+
+
+def test_dead_shard_reported():
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator = ShardedSimulator(Swarm(12), 2, latency=2)
+        simulator.start()
+        simulator._processes[1].kill()
+        with pytest.raises(RuntimeError, match="shard 1"):
+            simulator.run(10)
+    assert not any(process.is_alive() for process in simulator._processes)
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)
+    print(f"{'nodes':>6} {'shards':>6} | {'s':>7} {'node steps':>10} {'remote events':>13}")
+    for size, steps in [(1000, 300), (2000, 300)]:
+        for shards in [1, 2, 4]:
+            start = time.perf_counter()
+            simulator = simulate(size, steps, shards)
+            print(f"{size:>6} {shards:>6} | {time.perf_counter() - start:>7.2f} {simulator.node_steps:>10} "
+                  f"{simulator.remote_events:>13}")
@@ -0,0 +1,119 @@
+"""
+Simulator: a swarm stepped by a Simulator ends with the same chains and mempools as the same swarm,
+with the same seed, stepped with Node.step at every step, and the nodes with nothing to do are not stepped.
+Run with pytest from the folder containing the repository.
+"""
+import contextlib
+import io
+import random
+
+from toychain.src.Block import Block, State
+from toychain.src.Node import Node
+from toychain.src.Simulator import Simulator
+from toychain.src.Transaction import Transaction
+from toychain.src.connections.Loopback import LoopbackNetwork
+from toychain.src.consensus.ProofOfAuth import ProofOfAuthority
+from toychain.src.utils.constants import LOCALHOST
+from toychain.src.utils.helpers import gen_enode
+
+BASE_PORT = 25400
+SIZE = 12
+PEERS = 3
+SEED = 5
+STEPS = 1000
+
+
+class SteppedNetwork(LoopbackNetwork):
+    """
+    Loopback network of nodes stepped with Node.step, the messages are lost as on a Simulator
+    """
+    lost = Simulator.lost
+
+
+def make_consensus():
+    enodes = [gen_enode(i + 1, port=BASE_PORT + i) for i in range(SIZE)]
+    state = State()
+    state.balances.update({enode: 1000 for enode in enodes})
+    return ProofOfAuthority(genesis=Block(0, 0000, [], enodes, 0, 0, 0, nonce=1, state=state))
+
+
+def run_swarm(nodes, step, steps):
+    generator = random.Random(0)
+    for index, node in enumerate(nodes):
+        for peer in generator.sample(range(SIZE), PEERS):
+            if peer != index:
+                node.add_peer(nodes[peer].enode)
+                nodes[peer].add_peer(node.enode)
+
+    for time in range(steps):
+        step()
+        if time % 7 == 0:
+            sender = nodes[time // 7 % SIZE]
+            sender.send_transaction(Transaction(sender.enode, nodes[(time + 1) % SIZE].enode, 1,
+                                                timestamp=time, nonce=time, id=f"{time}"))
+    return [([block.hash for block in node.chain], sorted(node.mempool.keys())) for node in nodes]
+
+
+def simulate(steps, latency=2, loss=0.1):
+    consensus = make_consensus()
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator = Simulator(latency, loss, seed=SEED)
+        nodes = [simulator.add_node(i + 1, LOCALHOST, BASE_PORT + i, consensus) for i in range(SIZE)]
+        simulator.start()
+        results = run_swarm(nodes, simulator.step, steps)
+        simulator.stop()
+    return results, simulator
+
+
+def step_every_node(steps, latency=2, loss=0.1):
+    consensus = make_consensus()
+    with contextlib.redirect_stdout(io.StringIO()):
+        network = SteppedNetwork(latency, loss)
+        nodes = [Node(i + 1, LOCALHOST, BASE_PORT + i, consensus, transport=network) for i in range(SIZE)]
+        for node in nodes:
+            node.random.seed(f"{SEED}/{node.enode}")
+            node.start()
+
+        def step():
+            network.step()
+            for node in nodes:
+                node.step()
+        results = run_swarm(nodes, step, steps)
+        for node in nodes:
+            node.stop()
+    return results
+
+
+def test_same_chains_as_node_step():
+    results, simulator = simulate(STEPS)
+    assert results == step_every_node(STEPS)
+    # A block is produced every BLOCK_PERIOD steps
+    assert min(len(chain) for chain, _ in results) > 5
+    assert simulator.node_steps < SIZE * STEPS
+
+
+def test_idle_nodes_not_stepped():
+    consensus = make_consensus()
+    stepped = []
+
+    class Recording(Simulator):
+        def step_node(self, node):
+            stepped.append(node)
+            super().step_node(node)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator = Recording()
+        nodes = [simulator.add_node(i + 1, LOCALHOST, BASE_PORT + i, consensus) for i in range(3)]
+        # The last node is never started, the second one stops after a while
+        for node in nodes[:2]:
+            simulator.start_node(node)
+        simulator.run(50)
+        simulator.stop_node(nodes[1])
+        before = stepped.count(nodes[1])
+        simulator.run(200)
+        simulator.stop_node(nodes[0])
+
+    assert nodes[2] not in stepped
+    assert stepped.count(nodes[1]) == before
+    # A node without peers is only stepped when its pingers or its block generation are due
+    assert 0 < stepped.count(nodes[0]) < 250 / 2
@@ -0,0 +1,58 @@
+"""
+Mempool sketches: the difference of the sketches of two sets gives back the ids only in one of them,
+and a difference too large for the sketch, sketches of other sizes or a forged sketch give None.
+Run with pytest from the folder containing the repository.
+"""
+import random
+
+from toychain.src.Mempool import Mempool, SKETCH_CELLS, SKETCH_HASHES, _cells_of, _check, sketch, sketch_difference
+
+COMMON = 1000
+
+
+def make_sets(only_first, only_second, seed=1):
+    rng = random.Random(seed)
+    shorts = list({rng.getrandbits(64) for _ in range(COMMON + only_first + only_second)})
+    common, first, second = shorts[:COMMON], shorts[COMMON:COMMON + only_first], shorts[COMMON + only_first:]
+    return common + first, common + second, first, second
+
+
+def test_difference_decoded():
+    # Decoding is probabilistic, the sets of the seed decode (differences up to SKETCH_CELLS / 4)
+    for only_first, only_second in [(0, 0), (1, 0), (0, 1), (5, 3), (6, 6)]:
+        first_set, second_set, first, second = make_sets(only_first, only_second)
+        difference = sketch_difference(sketch(first_set, SKETCH_CELLS), sketch(second_set, SKETCH_CELLS))
+        assert difference is not None
+        assert sorted(difference[0]) == sorted(first) and sorted(difference[1]) == sorted(second)
+
+
+def test_missing_from_sketch():
+    local, remote = Mempool(), Mempool()
+    for i in range(200):
+        remote[f"tx{i}"] = i
+        if i % 10:
+            local[f"tx{i}"] = i
+    missing = local.missing_from_sketch(remote.sketch(SKETCH_CELLS))
+    assert sorted(local.get_short(missing) + remote.get_short(missing)) == [i for i in range(200) if i % 10 == 0]
+
+
+def test_decoding_fails():
+    first_set, second_set, _, _ = make_sets(150, 150)
+    assert sketch_difference(sketch(first_set, SKETCH_CELLS), sketch(second_set, SKETCH_CELLS)) is None
+    # A larger sketch decodes the same sets
+    size = SKETCH_CELLS * 16
+    assert sketch_difference(sketch(first_set, size), sketch(second_set, size)) is not None
+
+    # Sketches of other sizes, or not made of whole cells
+    assert sketch_difference(sketch(first_set, SKETCH_CELLS), sketch(second_set, 2 * SKETCH_CELLS)) is None
+    assert sketch_difference([1, 2], [1, 2]) is None
+
+
+def test_forged_sketch_rejected():
+    # An id in one of its cells only would be peeled back and forth
+    short = 12345
+    part_size = SKETCH_CELLS // SKETCH_HASHES
+    forged = [0] * (3 * SKETCH_CELLS)
+    cell = _cells_of(short, part_size)[0]
+    forged[3 * cell:3 * cell + 3] = [1, short, _check(short)]
+    assert sketch_difference(forged, sketch([], SKETCH_CELLS)) is None
@@ -0,0 +1,48 @@
+"""
+Benchmark of the startup of a node on a stored chain against its height: time to open the BlockStore
+and rebuild the state of the last block, with periodic state checkpoints (default interval) against
+a single genesis checkpoint, which replays the whole chain as a restart without checkpoints would.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# The repository folder must be importable as the 'toychain' package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from builders import TRANSACTIONS_PER_BLOCK, build_chain
+from toychain.src.storage.BlockStore import BlockStore, CHECKPOINT_INTERVAL
+
+# One block short of a checkpoint: worst case of the checkpointed store
+HEIGHTS = [599, 2099, 8099]
+NO_CHECKPOINTS = 10 ** 12
+
+
+def startup(path, checkpoint_interval):
+    start = time.perf_counter()
+    store = BlockStore(path, checkpoint_interval=checkpoint_interval)
+    replayed = store.restore_tip()
+    elapsed = 1000 * (time.perf_counter() - start)
+    store.close()
+    return elapsed, replayed
+
+
+if __name__ == '__main__':
+    print(f"{TRANSACTIONS_PER_BLOCK} transactions per block")
+    print(f"{'height':>7} | {'interval':>8} {'replayed':>8} {'ms':>8} | {'no ckpt':>8} {'replayed':>8} {'ms':>8}")
+
+    folder = tempfile.mkdtemp()
+    try:
+        for height in HEIGHTS:
+            results = []
+            for interval in (CHECKPOINT_INTERVAL, NO_CHECKPOINTS):
+                path = os.path.join(folder, f"{height}-{interval}")
+                build_chain(path, height, interval)
+                results.append(startup(path, interval))
+            (ckpt_ms, ckpt_replayed), (full_ms, full_replayed) = results
+            print(f"{height:>7} | {CHECKPOINT_INTERVAL:>8} {ckpt_replayed:>8} {ckpt_ms:>8.1f} | "
+                  f"{'':>8} {full_replayed:>8} {full_ms:>8.1f}")
+    finally:
+        shutil.rmtree(folder)
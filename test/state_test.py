@@ -0,0 +1,139 @@
+"""
+Contract state: transfers applied in a batch by apply_transactions leave the same balances, counter
+and state root as apply_transaction on each one, overdrafts, self-transfers and repeated senders included,
+the digest of a StateMap updated incrementally is the one of its content hashed from scratch, and the
+writes to a fork of a StateMap, deletes and nested forks included, leave its parent and sibling forks unchanged.
+Run with pytest from the folder containing the repository.
+"""
+import random
+
+from toychain.src.Block import Block, State
+from toychain.src.State import MAX_DEPTH, StateMap
+from toychain.src.Transaction import Transaction
+from toychain.src.utils.helpers import gen_enode
+
+# Addresses funded in the parent state, the next ones start without balance
+FUNDED = 5
+ADDRESSES = 8
+BATCHES = 200
+
+
+def make_transfers(rng, size):
+    transfers = []
+    for i in range(size):
+        sender = gen_enode(rng.randint(1, ADDRESSES))
+        # Self-transfers, and values over most balances
+        receiver = sender if rng.random() < 0.2 else gen_enode(rng.randint(1, ADDRESSES))
+        value = rng.choice([0, 1, rng.randint(1, 50), rng.randint(50, 500)])
+        transfers.append(Transaction(sender, receiver, value, timestamp=i, nonce=i))
+    return transfers
+
+
+def apply_both_ways(transfers, parent):
+    block = Block(1, "0" * 64, transfers, gen_enode(1), 1, 1, 0, state=parent.fork())
+    batched, sequential = parent.fork(), parent.fork()
+    batched.apply_transactions(transfers, block)
+    for tx in transfers:
+        sequential.apply_transaction(tx, block)
+    return batched, sequential
+
+
+def test_batched_transfers_match_sequential():
+    rng = random.Random(1)
+    for _ in range(BATCHES):
+        parent = State()
+        parent.balances.update({gen_enode(i): rng.randint(0, 100) for i in range(1, FUNDED + 1)})
+        batched, sequential = apply_both_ways(make_transfers(rng, rng.randint(1, 30)), parent)
+
+        assert list(batched.balances.items()) == list(sequential.balances.items())
+        assert batched.state_variables == sequential.state_variables
+        assert batched.state_hash == sequential.state_hash
+
+
+def test_edge_cases():
+    a, b = gen_enode(1), gen_enode(2)
+    parent = State()
+    parent.balances.update({a: 10})
+    cases = [
+        [Transaction(a, b, 11, nonce=0)],                                   # overdraft
+        [Transaction(a, a, 10, nonce=0), Transaction(a, a, 11, nonce=1)],   # self-transfers
+        [Transaction(a, b, 6, nonce=0), Transaction(a, b, 6, nonce=1), Transaction(b, a, 6, nonce=2),
+         Transaction(a, b, 10, nonce=3)],                                   # repeated senders
+        [Transaction(b, a, 0, nonce=0)],                                    # unfunded sender
+    ]
+    for transfers in cases:
+        batched, sequential = apply_both_ways(transfers, parent)
+        assert list(batched.balances.items()) == list(sequential.balances.items())
+        assert batched.n == sequential.n
+        assert batched.state_hash == sequential.state_hash
+    # The parent state is left as it was
+    assert dict(parent.balances) == {a: 10}
+
+
+def test_incremental_digest_matches_recomputation():
+    rng = random.Random(2)
+    state = StateMap({f"k{i}": i for i in range(20)})
+    # {content: digest}
+    digests = {}
+    for generation in range(3 * MAX_DEPTH):
+        state = state.fork()
+        for _ in range(rng.randint(1, 5)):
+            key = f"k{rng.randrange(30)}"
+            action = rng.random()
+            if action < 0.3 and key in state:
+                del state[key]
+            elif action < 0.5:
+                # Mutable values are copied on access and modified in place
+                state.setdefault(key, [])
+                if isinstance(state[key], list):
+                    state[key].append(generation)
+            else:
+                state[key] = rng.randrange(100)
+        assert state.digest() == StateMap(dict(state)).digest()
+        digests[repr(sorted(state.items()))] = state.digest()
+
+    # Different contents give different digests
+    assert len(set(digests.values())) == len(digests) > 2 * MAX_DEPTH
+    assert StateMap().digest() == 0 and StateMap({"k": 1}).digest() != 0
+    emptied = StateMap({"k": 1}).fork()
+    del emptied["k"]
+    assert emptied.digest() == 0
+
+
+def test_forks_isolated():
+    parent = StateMap({"x": 1, "y": [1]}).fork()
+    sibling = parent.fork()
+    nested = sibling.fork()
+    del sibling["x"]
+    sibling["y"].append(2)
+    nested["x"] = 3
+    del nested["y"]
+    assert dict(parent) == {"x": 1, "y": [1]}
+    assert dict(sibling) == {"y": [1, 2]}
+    assert dict(nested) == {"x": 3}
+
+    rng = random.Random(3)
+    # [(map, content expected, forks since the root)], maps are forked from any of them, the last one most
+    maps = [(StateMap({f"k{i}": [i] for i in range(10)}), {f"k{i}": [i] for i in range(10)}, 0)]
+    for _ in range(1000):
+        index = len(maps) - 1 if rng.random() < 0.9 else rng.randrange(len(maps))
+        state, expected, generation = maps[index]
+        key = f"k{rng.randrange(15)}"
+        action = rng.random()
+        if action < 0.2:
+            maps.append((state.fork(), {k: list(v) for k, v in expected.items()}, generation + 1))
+        elif action < 0.4:
+            if key in expected:
+                del state[key], expected[key]
+            else:
+                assert key not in state
+        elif action < 0.7 and key in expected:
+            state[key].append(index)
+            expected[key].append(index)
+        else:
+            state[key] = expected[key] = [rng.randrange(100)]
+        for state, expected, _ in maps:
+            assert dict(state) == expected
+    assert max(generation for _, _, generation in maps) > MAX_DEPTH
+    for state, expected, _ in maps:
+        assert state.digest() == StateMap(expected).digest()
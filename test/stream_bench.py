@@ -0,0 +1,82 @@
+"""
+Benchmark of the memory used to receive a range of blocks (an answer to a block request), streamed
+in frames of STREAM_CHUNK blocks against encoded in a single frame.
+    received:  size of the decoded blocks, which the chain download keeps until the range is merged
+    buffer:    largest receive buffer of the FrameReader
+    peak:      peak of the memory allocated while receiving (tracemalloc), decoded blocks included
+"""
+import os
+import socket
+import sys
+import threading
+import tracemalloc
+from hashlib import sha256
+
+# The repository folder must be importable as the 'toychain' package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from toychain.src.Block import Block, State
+from toychain.src.CompactBlock import CompactBlock
+from toychain.src.Transaction import Transaction
+from toychain.src.connections.Framing import FrameReader, MessageAssembler, frame, send_message
+from toychain.src.utils.codec import Stream, encode
+from toychain.src.utils.constants import BODY_RANGE
+from toychain.src.utils.helpers import gen_enode
+
+TRANSACTIONS_PER_BLOCK = [10, 100, 1000]
+
+
+def make_blocks(n_transactions):
+    """
+    Compact blocks of a range as answered to a peer holding none of their transactions
+    """
+    state = State()
+    blocks = []
+    parent = sha256(b'parent').hexdigest()
+    for height in range(1, BODY_RANGE + 1):
+        data = [Transaction(gen_enode(i % 25 + 1), gen_enode((i + 1) % 25 + 1), i % 7, timestamp=height, nonce=i)
+                for i in range(n_transactions)]
+        block = Block(height, parent, data, gen_enode(1), height, 2, 0, state=state)
+        blocks.append(CompactBlock.from_block(block).to_list())
+        parent = block.hash
+    return blocks
+
+
+def receive(blocks, streamed):
+    sender, receiver = socket.socketpair()
+    message = {"type": "block", "data": [1, Stream(iter(blocks)) if streamed else blocks]}
+
+    def send():
+        if streamed:
+            send_message(sender, 0, message)
+        else:
+            sender.sendall(frame(0, encode(message)))
+    thread = threading.Thread(target=send)
+
+    reader = FrameReader(receiver)
+    assembler = MessageAssembler()
+    tracemalloc.start()
+    thread.start()
+    complete = False
+    while not complete:
+        complete, answer = assembler.feed(*reader.read_frame())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    thread.join()
+    sender.close()
+    receiver.close()
+    return len(answer["data"][1]), len(reader.buffer), peak
+
+
+if __name__ == '__main__':
+    print(f"{BODY_RANGE} blocks per answer")
+    print(f"{'txs/block':>9} {'encoded KB':>10} | {'buffer KB':>9} {'peak KB':>8} | {'buffer KB':>9} {'peak KB':>8}")
+    print(f"{'':>20} | {'streamed':>18} | {'single frame':>18}")
+    for n_transactions in TRANSACTIONS_PER_BLOCK:
+        blocks = make_blocks(n_transactions)
+        encoded = len(encode(blocks))
+        count, stream_buffer, stream_peak = receive(blocks, True)
+        assert count == BODY_RANGE
+        _, frame_buffer, frame_peak = receive(blocks, False)
+        print(f"{n_transactions:>9} {encoded / 1024:>10.0f} | {stream_buffer / 1024:>9.0f} {stream_peak / 1024:>8.0f} | "
+              f"{frame_buffer / 1024:>9.0f} {frame_peak / 1024:>8.0f}")
@@ -0,0 +1,298 @@
+"""
+Benchmark of simulated swarms with parameterized scenarios, written to a JSON file to compare runs.
+
+A scenario is a swarm of nodes stepped by a Simulator (see DEFAULTS for its parameters): transactions
+are sent at tx_rate per step by the nodes in turn during steps steps, then the swarm runs without
+transactions until all the nodes have the same tip. Every scenario runs in its own process, and
+reports
+    blocks, transactions:      produced while transactions are sent, on the chain all the nodes agree
+                               on at the end, and per second of the run
+    convergence_steps/_s:      steps and seconds for all the nodes to reach the same tip at the end
+    messages:                  count and encoded bytes of the requests and answers per message type
+    cpu_ms_per_step:           CPU time per step, and per node stepped (cpu_us_per_node_step)
+    peak_memory_kb_per_node:   growth of the peak resident memory of the process, per node
+The simulation is seeded and the transactions have explicit ids: every figure but the times and the
+memory is the same from a run to the next.
+
+    python test/swarm_bench.py [scenario ...] [--output results.json] [--baseline previous.json]
+
+With --baseline, the times and memory are compared to those of a previous run, and the script exits
+with an error if one is worse by more than --tolerance. With --metrics, the counters, gauges and
+histograms of the nodes (see utils/metrics.py) are added to the results of every scenario.
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from collections import defaultdict
+
+# The repository folder must be importable as the 'toychain' package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from toychain.src.Block import Block, State
+from toychain.src.Simulator import Simulator
+from toychain.src.Transaction import Transaction
+from toychain.src.connections.Loopback import REQUEST, ANSWER
+from toychain.src.consensus.ProofOfAuth import ProofOfAuthority
+from toychain.src.consensus.ProofOfWork import ProofOfWork
+from toychain.src.utils.codec import encode
+from toychain.src.utils.constants import LOCALHOST
+from toychain.src.utils import metrics
+from toychain.src.utils.helpers import gen_enode
+
+DEFAULTS = {
+    "nodes": 25,
+    # "full", "ring", or "random" with peers random peers per node
+    "topology": "random",
+    "peers": 5,
+    # Transactions sent per step, fractions spread them over several steps
+    "tx_rate": 1.0,
+    "consensus": "poa",
+    "trust": True,
+    # Maximum number of transactions per block, None for no limit
+    "block_size": None,
+    "steps": 1000,
+    # Steps to reach the same tip once the transactions stop
+    "max_convergence_steps": 2000,
+    "latency": 1,
+    "loss": 0.0,
+    "seed": 0,
+}
+
+SCENARIOS = {
+    "poa-full-10": {"nodes": 10, "topology": "full"},
+    "poa-ring-50": {"nodes": 50, "topology": "ring"},
+    "poa-random-100": {"nodes": 100, "tx_rate": 2.0},
+    "poa-untrusted": {"trust": False},
+    "poa-block-size": {"block_size": 50},
+    "poa-lossy": {"latency": 3, "loss": 0.1},
+    "pow-random-50": {"nodes": 50, "consensus": "pow"},
+}
+
+# Results compared to a baseline, and whether a higher value is better
+GATED = {"blocks_per_s": True, "transactions_per_s": True, "cpu_ms_per_step": False, "peak_memory_kb_per_node": False}
+BASE_PORT = 27000
+BALANCE = 10 ** 9
+
+
+class MeteredSimulator(Simulator):
+    """
+    Simulator counting the requests and answers sent per message type with their encoded size
+    The time spent encoding them is kept apart, it is not part of the simulation
+    """
+
+    def __init__(self, latency=0, loss=0, seed=0):
+        super().__init__(latency, loss, seed)
+        # {(kind, message type): [count, bytes]}
+        self.messages = defaultdict(lambda: [0, 0])
+        self.metering_time = 0
+
+    def send_event(self, delay, origin, enode, event):
+        if event[0] == REQUEST or event[0] == ANSWER:
+            message = event[2]
+            if message is not None:
+                start = time.process_time()
+                counter = self.messages[("requests" if event[0] == REQUEST else "answers", message["type"])]
+                counter[0] += 1
+                counter[1] += len(encode(message))
+                self.metering_time += time.process_time() - start
+        super().send_event(delay, origin, enode, event)
+
+
+def links(parameters):
+    """
+    Peers of every node {index: set of indices}
+    """
+    size = parameters["nodes"]
+    peers = {index: set() for index in range(size)}
+    generator = random.Random(parameters["seed"])
+    for index in range(size):
+        if parameters["topology"] == "full":
+            others = range(size)
+        elif parameters["topology"] == "ring":
+            others = [(index + 1) % size]
+        elif parameters["topology"] == "random":
+            others = generator.sample(range(size), min(parameters["peers"], size))
+        else:
+            raise ValueError(f"Unknown topology {parameters['topology']}")
+        for other in others:
+            if other != index:
+                peers[index].add(other)
+                peers[other].add(index)
+    return peers
+
+
+def swarm(parameters):
+    size = parameters["nodes"]
+    enodes = [gen_enode(i + 1, port=BASE_PORT + i) for i in range(size)]
+    state = State()
+    state.balances.update({enode: BALANCE for enode in enodes})
+    if parameters["consensus"] == "poa":
+        consensus = ProofOfAuthority(genesis=Block(0, 0000, [], enodes, 0, 0, 0, nonce=1, state=state))
+    elif parameters["consensus"] == "pow":
+        consensus = ProofOfWork(genesis=Block(0, 0000, [], 0, 0, 0, 0, nonce=1, state=state))
+    else:
+        raise ValueError(f"Unknown consensus {parameters['consensus']}")
+    consensus.trust = parameters["trust"]
+    consensus.block_size = parameters["block_size"]
+
+    simulator = MeteredSimulator(parameters["latency"], parameters["loss"], parameters["seed"])
+    nodes = [simulator.add_node(i + 1, LOCALHOST, BASE_PORT + i, consensus) for i in range(size)]
+    for index, peers in links(parameters).items():
+        for peer in sorted(peers):
+            nodes[index].add_peer(nodes[peer].enode)
+    simulator.start()
+    return simulator, nodes
+
+
+def agreed_height(nodes):
+    """
+    Height of the last block all the nodes have
+    """
+    height = min(node.get_block_number() for node in nodes)
+    while height > 0 and len({node.get_block(height).hash for node in nodes}) > 1:
+        height -= 1
+    return height
+
+
+def run(parameters, with_metrics=False):
+    """
+    Runs a scenario and returns its results, with the metrics of the nodes (utils/metrics.py) if with_metrics
+    """
+    metrics.enable(with_metrics)
+    memory_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with contextlib.redirect_stdout(io.StringIO()):
+        simulator, nodes = swarm(parameters)
+    size = len(nodes)
+
+    sent = 0
+    owed = 0.0
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for step in range(parameters["steps"]):
+            simulator.step()
+            owed += parameters["tx_rate"]
+            while owed >= 1:
+                owed -= 1
+                sender = nodes[sent % size]
+                receiver = nodes[(sent + 1) % size]
+                sender.send_transaction(Transaction(sender.enode, receiver.enode, 1, timestamp=step, nonce=sent,
+                                                    id=f"{sent}"))
+                sent += 1
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        node_steps = simulator.node_steps
+        metering_time = simulator.metering_time
+
+        convergence_start = time.perf_counter()
+        convergence_steps = None
+        for step in range(parameters["max_convergence_steps"] + 1):
+            if len({node.get_block('last').hash for node in nodes}) == 1:
+                convergence_steps = step
+                break
+            simulator.step()
+        convergence_time = time.perf_counter() - convergence_start
+        simulator.stop()
+
+    # Blocks produced while the transactions were sent, among those all the nodes have
+    blocks = [nodes[0].get_block(h) for h in range(1, agreed_height(nodes) + 1)]
+    blocks = [block for block in blocks if block.timestamp <= parameters["steps"]]
+    transactions = sum(len(block.data) for block in blocks)
+    cpu -= metering_time
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory_start
+    results = {
+        "blocks": len(blocks),
+        "blocks_per_s": len(blocks) / wall,
+        "transactions_sent": sent,
+        "transactions": transactions,
+        "transactions_per_s": transactions / wall,
+        "convergence_steps": convergence_steps,
+        "convergence_s": convergence_time if convergence_steps is not None else None,
+        "messages": {f"{kind} {message_type}": {"count": count, "bytes": length}
+                     for (kind, message_type), (count, length) in sorted(simulator.messages.items())},
+        "wall_s": wall,
+        "cpu_ms_per_step": 1000 * cpu / parameters["steps"],
+        "cpu_us_per_node_step": 1e6 * cpu / max(node_steps, 1),
+        "node_steps": node_steps,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_memory_kb_per_node": memory / size,
+    }
+    if with_metrics:
+        results["metrics"] = metrics.snapshot()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Figures missing from the baseline (added since it was run) are not compared
+    :return: regressions of the results against those of the baseline, as messages
+    """
+    regressions = []
+    for name, scenario in results.items():
+        previous = baseline.get(name)
+        if previous is None or previous["parameters"] != scenario["parameters"]:
+            continue
+        for key, higher_is_better in GATED.items():
+            old, new = previous["results"].get(key), scenario["results"][key]
+            if not old:
+                continue
+            change = (new - old) / old
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(f"{name}: {key} {old:.4g} -> {new:.4g} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run among {', '.join(SCENARIOS)}, all by default")
+    parser.add_argument("--output", default="swarm_bench.json", help="JSON file of the results")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative regression accepted against the baseline")
+    parser.add_argument("--metrics", action="store_true", help="collect the metrics of the nodes in the results, "
+                                                                "their cost is part of the times")
+    arguments = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    names = arguments.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+
+    results = {}
+    print(f"{'scenario':>16} | {'blocks':>6} {'blocks/s':>9} {'txs':>6} {'txs/s':>9} {'converge':>8} | "
+          f"{'ms/step':>8} {'us/node':>8} {'KB/node':>8}")
+    for name in names:
+        parameters = dict(DEFAULTS, **SCENARIOS[name])
+        # A new process for every scenario, for its peak memory
+        with multiprocessing.Pool(1) as pool:
+            result = pool.apply(run, (parameters, arguments.metrics))
+        results[name] = {"parameters": parameters, "results": result}
+        print(f"{name:>16} | {result['blocks']:>6} {result['blocks_per_s']:>9.1f} {result['transactions']:>6} "
+              f"{result['transactions_per_s']:>9.1f} {str(result['convergence_steps']):>8} | "
+              f"{result['cpu_ms_per_step']:>8.2f} {result['cpu_us_per_node_step']:>8.1f} "
+              f"{result['peak_memory_kb_per_node']:>8.1f}")
+
+    with open(arguments.output, "w") as file:
+        json.dump({"python": platform.python_version(), "platform": platform.platform(), "time": time.time(),
+                   "scenarios": results}, file, indent=2)
+    print(f"Results written to {arguments.output}")
+
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)["scenarios"]
+        regressions = compare(results, baseline, arguments.tolerance)
+        for regression in regressions:
+            print(f"Regression {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
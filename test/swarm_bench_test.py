@@ -0,0 +1,82 @@
+"""
+Swarm benchmark: the comparison against a baseline skips the figures it lacks, and the block_size of
+a consensus caps the transactions of the blocks produced, the others staying in the mempool for the
+next blocks, with Proof-of-Authority and Proof-of-Work.
+Run with pytest from the folder containing the repository.
+"""
+import contextlib
+import io
+
+from swarm_bench import GATED, compare
+from toychain.src.Block import Block, State
+from toychain.src.Node import Node
+from toychain.src.Transaction import Transaction
+from toychain.src.consensus.ProofOfAuth import ProofOfAuthority
+from toychain.src.consensus.ProofOfWork import ProofOfWork
+from toychain.src.utils.constants import LOCALHOST
+from toychain.src.utils.helpers import gen_enode
+
+BASE_PORT = 25600
+BLOCK_SIZE = 4
+TRANSACTIONS = 10
+
+
+def scenario(**results):
+    return {"parameters": {"nodes": 10}, "results": dict({key: 100 for key in GATED}, **results)}
+
+
+def test_compare_skips_new_figures():
+    baseline = {"swarm": scenario()}
+    del baseline["swarm"]["results"]["peak_memory_kb_per_node"]
+    assert compare({"swarm": scenario()}, baseline, 0.2) == []
+    # The other figures are still compared
+    regressions = compare({"swarm": scenario(blocks_per_s=50, peak_memory_kb_per_node=500)}, baseline, 0.2)
+    assert len(regressions) == 1 and regressions[0].startswith("swarm: blocks_per_s")
+
+
+def fill_mempool(node):
+    receiver = gen_enode(2, port=BASE_PORT + 1)
+    transactions = [Transaction(node.enode, receiver, 1, timestamp=i, nonce=i, id=f"{i}") for i in range(TRANSACTIONS)]
+    for transaction in transactions:
+        node.mempool[transaction.id] = transaction
+    return transactions
+
+
+def check_blocks(node, produce_block):
+    transactions = fill_mempool(node)
+    sizes = []
+    while len(node.mempool):
+        produce_block()
+        sizes.append(len(node.get_block('last').data))
+        # The transactions left out are the next ones
+        assert list(node.mempool.keys()) == [tx.id for tx in transactions[sum(sizes):]]
+    assert sizes == [BLOCK_SIZE, BLOCK_SIZE, TRANSACTIONS - 2 * BLOCK_SIZE]
+    included = [tx.id for block in node.chain[1:] for tx in block.data]
+    assert included == [tx.id for tx in transactions]
+    assert node.get_block('last').state.n == TRANSACTIONS
+
+
+def funded_genesis(miner):
+    state = State()
+    state.balances.update({gen_enode(1, port=BASE_PORT): 1000})
+    return Block(0, 0000, [], miner, 0, 0, 0, nonce=1, state=state)
+
+
+def test_block_size_proof_of_authority():
+    consensus = ProofOfAuthority(genesis=funded_genesis([gen_enode(1, port=BASE_PORT)]))
+    consensus.block_size = BLOCK_SIZE
+    with contextlib.redirect_stdout(io.StringIO()):
+        node = Node(1, LOCALHOST, BASE_PORT, consensus)
+
+    def produce_block():
+        last = node.get_block('last')
+        node.mining_thread.produce_block(last.timestamp + 1, last.height + 1)
+    check_blocks(node, produce_block)
+
+
+def test_block_size_proof_of_work():
+    consensus = ProofOfWork(genesis=funded_genesis(0))
+    consensus.block_size = BLOCK_SIZE
+    node = Node(1, LOCALHOST, BASE_PORT, consensus)
+    with contextlib.redirect_stdout(io.StringIO()):
+        check_blocks(node, lambda: node.mining_thread.produce_block(5))
@@ -0,0 +1,58 @@
+"""
+Memory benchmark of mempool transactions: bytes per transaction of the former __dict__ based
+Transaction (duplicated source/sender and destination/receiver) against the slotted one.
+Addresses are built as new string objects for every transaction, as when they are decoded from the wire.
+"""
+import os
+import sys
+import tracemalloc
+from uuid import uuid4
+
+# The repository folder must be importable as the 'toychain' package
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from toychain.src.Transaction import Transaction
+
+N_TRANSACTIONS = 50000
+N_ROBOTS = 100
+
+
+class LegacyTransaction:
+    def __init__(self, sender, receiver = 0, value = 0, data={}, timestamp=None, nonce=None, id=None):
+        self.source = str(sender)
+        self.sender = str(sender)
+
+        self.destination = str(receiver)
+        self.receiver    = str(receiver)
+
+        self.value = value
+
+        self.data = data
+
+        self.timestamp = timestamp
+        self.nonce = nonce
+        self.id = id
+        if not id:
+            self.id = str(uuid4())
+
+
+def bytes_per_transaction(cls):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    mempool = {}
+    for i in range(N_TRANSACTIONS):
+        sender = "enode://%d@127.0.0.1:%d" % (i % N_ROBOTS, 1233 + i % N_ROBOTS)
+        receiver = "enode://%d@127.0.0.1:%d" % ((i + 1) % N_ROBOTS, 1234 + i % N_ROBOTS)
+        tx = cls(sender, receiver, i % 10, timestamp=i, nonce=i)
+        mempool[tx.id] = tx
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / N_TRANSACTIONS
+
+
+if __name__ == '__main__':
+    legacy = bytes_per_transaction(LegacyTransaction)
+    slotted = bytes_per_transaction(Transaction)
+    print(f"{N_TRANSACTIONS} transactions in a mempool dict (including ids and dict slots)")
+    print(f"legacy  __dict__ Transaction: {legacy:8.1f} bytes/tx")
+    print(f"slotted Transaction:          {slotted:8.1f} bytes/tx ({100 * (1 - slotted / legacy):.0f}% less)")